@@ -0,0 +1,276 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from speckle_generator import image_speckle, generate_speckle, speckle_geometry, MIG, density, STAMP_BANK
+from export import write_png, write_tiff, write_svg, write_pdf
+from pattern_model import SpeckleModel
+
+try:
+    # peak resident memory of the process, not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+# plate side in mm, resolution in dpi, maximum diameter in mm and grid step in diameters of every case
+FULL_MATRIX = {
+    "size_mm": (50, 100, 200),
+    "dpi": (150, 300, 600),
+    "diameter": (0.2, 0.5, 1.0),
+    "grid_step": (1, 1.5)
+}
+QUICK_MATRIX = {
+    "size_mm": (50,),
+    "dpi": (150, 300),
+    "diameter": (0.5,),
+    "grid_step": (1,)
+}
+# minimum diameter and position randomness of every case, as % of the diameter
+MIN_DIAMETER = 60
+POS_RAND = 25
+# seed of every pattern, so every run benchmarks the same patterns
+SEED = 0
+# hash grid cells of the largest plate Poisson-disk placement is benchmarked on. It is the slowest benchmark and
+# doesn't depend on the resolution, so larger plates would only make the matrix take hours
+POISSON_MAX_CELLS = 2 ** 17
+# relative slowdown over the baseline reported as a regression
+DEFAULT_THRESHOLD = 0.2
+# benchmarks faster than this in both runs are too noisy to be compared, identical runs differ by up to 2x below it
+MIN_COMPARED_SECONDS = 1e-2
+
+def measure(function, repeat:int, setup=None):
+    """
+    Times a function and measures the memory it allocates.
+    The time is the median of repeat calls, without tracemalloc since it slows allocations down. Then one more call
+    is traced to find the peak of the memory allocated by Python and numpy. The peak resident memory is reset
+    before the first call where the platform allows it, so it is the peak of these calls only.
+    :param function: callable without arguments
+    :param repeat: number of timed calls
+    :param setup: optional callable run before every call, not timed
+    :return: dictionary with seconds, best_seconds, peak_mb, rss_mb and the value returned by the last call
+    """
+    reset_peak_rss()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        value = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": statistics.median(times), "best_seconds": min(times), "peak_mb": peak / 2**20,
+            "rss_mb": rss_mb(), "value": value}
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of the process to the current one. Only Linux allows it, elsewhere the peak
+    keeps growing within the process of a case.
+    :return: True if it was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+def rss_mb():
+    """
+    Peak resident memory of the process in MB since it started or since reset_peak_rss, None where it can't be read.
+    """
+    try:
+        with open("/proc/self/status", "r") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    # kilobytes
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def record(name:str, case:dict, pixels:int, measurement:dict):
+    seconds = measurement["seconds"]
+    return {
+        "name": name,
+        "case": case,
+        "pixels": pixels,
+        "seconds": seconds,
+        "best_seconds": measurement["best_seconds"],
+        "pixels_per_second": pixels / seconds if seconds > 0 else None,
+        "peak_mb": measurement["peak_mb"],
+        "rss_mb": measurement["rss_mb"]
+    }
+
+def benchmark_case(case:dict, repeat:int, output_dir:Path):
+    """
+    Benchmarks generation, metrics and PNG, TIFF, SVG and PDF export of the pattern of one case. Patterns are
+    generated by image_speckle and, as the GUI and the command line do, by drawing a SpeckleModel with grid and
+    Poisson-disk placement and rasterizing it packed.
+    The stamp bank is cleared before every rasterization, so each one includes building its speckle buffer.
+    Poisson-disk placement is only benchmarked on plates of up to POISSON_MAX_CELLS hash grid cells.
+    :return: list of records
+    """
+    size = case["size_mm"]
+    args = (size, size, case["diameter"], case["dpi"], case["grid_step"], MIN_DIAMETER, POS_RAND)
+    model_args = (size, size, case["diameter"], case["grid_step"], MIN_DIAMETER, POS_RAND, SEED)
+    results = []
+
+    generated = measure(lambda: image_speckle(*args, seed=SEED), repeat, STAMP_BANK.clear)
+    pattern = generated["value"]
+    pixels = pattern.size
+    results.append(record("image_speckle", case, pixels, generated))
+    packed_generated = measure(lambda: image_speckle(*args, seed=SEED, packed=True), repeat, STAMP_BANK.clear)
+    packed = packed_generated["value"]
+    results.append(record("image_speckle_packed", case, pixels, packed_generated))
+
+    modelled = measure(lambda: SpeckleModel.generate(*model_args), repeat)
+    model = modelled["value"]
+    results.append(record("model", case, pixels, modelled))
+    rasterized = measure(lambda: model.rasterize(case["dpi"], packed=True), repeat, STAMP_BANK.clear)
+    results.append(record("model_rasterize_packed", case, pixels, rasterized))
+    if (size / (case["grid_step"] * case["diameter"])) ** 2 <= POISSON_MAX_CELLS:
+        poisson_modelled = measure(lambda: SpeckleModel.generate(*model_args, placement="poisson"), repeat)
+        poisson_model = poisson_modelled["value"]
+        results.append(record("model_poisson", case, pixels, poisson_modelled))
+        poisson_rasterized = measure(lambda: poisson_model.rasterize(case["dpi"], packed=True), repeat,
+                                     STAMP_BANK.clear)
+        results.append(record("model_poisson_rasterize_packed", case, pixels, poisson_rasterized))
+
+    results.append(record("MIG", case, pixels, measure(lambda: MIG(pattern), repeat)))
+    results.append(record("MIG_packed", case, pixels, measure(lambda: MIG(packed), repeat)))
+    results.append(record("density", case, pixels, measure(lambda: density(pattern), repeat)))
+    results.append(record("density_packed", case, pixels, measure(lambda: density(packed), repeat)))
+    png_path = output_dir / "benchmark.png"
+    results.append(record("export_png", case, pixels, measure(lambda: write_png(png_path, packed, case["dpi"]), repeat)))
+    tiff_path = output_dir / "benchmark.tif"
+    results.append(record("export_tiff", case, pixels, measure(lambda: write_tiff(tiff_path, packed, case["dpi"]), repeat)))
+    svg_path = output_dir / "benchmark.svg"
+    results.append(record("export_svg", case, pixels, measure(lambda: write_svg(svg_path, model), repeat)))
+    pdf_path = output_dir / "benchmark.pdf"
+    results.append(record("export_pdf", case, pixels, measure(lambda: write_pdf(pdf_path, model), repeat)))
+    return results
+
+def benchmark_generate_speckle(diameters_px:list, repeat:int):
+    """
+    Benchmarks generate_speckle filling a speckle buffer of every diameter from the minimum to the maximum one.
+    :return: list of records
+    """
+    results = []
+    for diameter_px in diameters_px:
+        min_diameter_px = max(1, int(np.ceil(diameter_px * MIN_DIAMETER / 100)))
+        diameters = range(min_diameter_px, diameter_px + 1)
+        measurement = measure(lambda: [generate_speckle(diameter_px, d) for d in diameters], repeat)
+        pixels = len(diameters) * diameter_px * diameter_px
+        results.append(record("generate_speckle", {"diameter_px": diameter_px}, pixels, measurement))
+    return results
+
+def run_isolated(function, *args):
+    """
+    Runs a function in a new process, so its memory peak and allocator state don't depend on the cases run before.
+    """
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(function, *args).result()
+
+def run(matrix:dict, repeat:int):
+    """
+    Runs every case of a matrix of parameters, each one in its own process.
+    :param matrix: dictionary of parameter values, every combination is a case
+    :param repeat: number of timed calls per benchmark
+    :return: dictionary with the environment and the records
+    """
+    keys = list(matrix)
+    cases = [dict(zip(keys, values)) for values in itertools.product(*matrix.values())]
+    results = []
+    diameters_px = set()
+    with tempfile.TemporaryDirectory() as output_dir:
+        for number, case in enumerate(cases, start=1):
+            print(f"[{number}/{len(cases)}] {case}", flush=True)
+            results.extend(run_isolated(benchmark_case, case, repeat, Path(output_dir)))
+            size = case["size_mm"]
+            geometry = speckle_geometry(size, size, case["diameter"], case["dpi"], case["grid_step"], MIN_DIAMETER, POS_RAND)
+            diameters_px.add(geometry["diameter_px"])
+    results.extend(run_isolated(benchmark_generate_speckle, sorted(diameters_px), repeat))
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count()
+        },
+        "repeat": repeat,
+        "results": results
+    }
+
+def result_key(result:dict):
+    return result["name"], json.dumps(result["case"], sort_keys=True)
+
+def compare(current:dict, baseline:dict, threshold:float):
+    """
+    Compares the times of a run against a baseline run.
+    :param current: dictionary returned by run
+    :param baseline: dictionary returned by run, loaded from a previous run
+    :param threshold: relative slowdown reported as a regression, 0.2 for 20 %
+    :return: list of (name, case, current seconds, baseline seconds, ratio) of the regressions
+    """
+    baseline_seconds = {result_key(result): result["seconds"] for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        previous = baseline_seconds.get(result_key(result))
+        if not previous or max(previous, result["seconds"]) < MIN_COMPARED_SECONDS:
+            continue
+        ratio = result["seconds"] / previous
+        if ratio > 1 + threshold:
+            regressions.append((result["name"], result["case"], result["seconds"], previous, ratio))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks pattern generation, metrics and export.")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"relative slowdown reported as a regression, default {DEFAULT_THRESHOLD}")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per benchmark, the median one is kept")
+    parser.add_argument("--quick", action="store_true", help="run a small matrix for a fast check")
+    args = parser.parse_args()
+
+    results = run(QUICK_MATRIX if args.quick else FULL_MATRIX, args.repeat)
+    with open(args.output, "w", encoding="utf8") as outfile:
+        json.dump(results, outfile, indent=2)
+    print(f"{len(results['results'])} benchmarks written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf8") as infile:
+            baseline = json.load(infile)
+        regressions = compare(results, baseline, args.threshold)
+        for name, case, seconds, previous, ratio in regressions:
+            print(f"REGRESSION {name} {case}: {seconds * 1000:.2f} ms vs {previous * 1000:.2f} ms ({ratio:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions over {args.threshold:.0%} against {args.baseline}")
@@ -0,0 +1,99 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import os
+import numpy as np
+from speckle_generator import MIG, density, GenerationCancelled
+from local_quality import subset_quality_maps
+from pattern_model import SpeckleModel
+
+# scores candidate patterns can be ranked by, the highest score wins
+CANDIDATE_SCORES = ("MIG", "density_error", "subset_sssig")
+# density in % the density_error score aims at
+DEFAULT_TARGET_DENSITY = 50
+# subset side length in pixels of the subset_sssig score
+DEFAULT_SUBSET_SIZE = 31
+
+def score_pattern(pattern, score:str, target_density:float=DEFAULT_TARGET_DENSITY, subset_size:int=DEFAULT_SUBSET_SIZE):
+    """
+    Scores a pattern, higher being better.
+    :param pattern: grayscale array or PackedPattern
+    :param score: one of CANDIDATE_SCORES. "MIG" is the mean intensity gradient, "density_error" minus the distance
+    of the density to target_density and "subset_sssig" the SSSIG of the worst subset, so no part of the pattern is
+    left without texture
+    :param target_density: in %, density aimed at by density_error
+    :param subset_size: in pixels, subset side length of subset_sssig. Subsets are evaluated every half subset
+    :return: score
+    """
+    if score == "MIG":
+        return float(MIG(pattern))
+    if score == "density_error":
+        return -abs(float(density(pattern)) - target_density)
+    if score == "subset_sssig":
+        maps = subset_quality_maps(pattern, subset_size, max(1, subset_size // 2))
+        return float(np.min(maps["sssig"]))
+    raise ValueError(f"Unknown score '{score}', expected one of {', '.join(CANDIDATE_SCORES)}")
+
+def _score_candidate(values:dict, seed:int, score:str, target_density:float, subset_size:int):
+    """
+    Process pool task of best_candidate. Only the score goes back, the pattern is dropped in the worker.
+    """
+    pattern = SpeckleModel.from_values(values, seed).rasterize(values["dpi"], packed=True)
+    return score_pattern(pattern, score, target_density, subset_size)
+
+def best_candidate(values:dict, count:int, score:str="MIG", target_density:float=DEFAULT_TARGET_DENSITY,
+                   subset_size:int=DEFAULT_SUBSET_SIZE, seed:int=None, workers:int=None, progress=None):
+    """
+    Generates count seeded candidates of a set of parameters in a process pool, scores each one and keeps the seed of
+    the best. Every worker rasterizes one candidate at a time as a PackedPattern and returns only its score, so at
+    most workers patterns are in memory at once. The best candidate is drawn again from its seed.
+    :param values: parameters as returned by ParameterWidget.get_values
+    :param count: number of candidates
+    :param score: one of CANDIDATE_SCORES
+    :param target_density: in %, density aimed at by the density_error score
+    :param subset_size: in pixels, subset side length of the subset_sssig score
+    :param seed: seed the candidate seeds are drawn from, so the search can be repeated. Random if None
+    :param workers: number of processes, all the cores by default. With 1 the candidates are scored in this process
+    :param progress: optional callable receiving the fraction of candidates scored. If it raises GenerationCancelled
+    the pending candidates are cancelled
+    :return: dictionary with the model of the best candidate, its seed and score, and the score of every candidate
+    """
+    if score not in CANDIDATE_SCORES:
+        raise ValueError(f"Unknown score '{score}', expected one of {', '.join(CANDIDATE_SCORES)}")
+    if count < 1:
+        raise ValueError("count must be at least one candidate")
+    seeds = [int(candidate_seed) for candidate_seed in np.random.default_rng(seed).integers(2 ** 63, size=count)]
+    scores = [None] * count
+    workers = min(workers or os.cpu_count() or 1, count)
+    if workers <= 1:
+        for number, candidate_seed in enumerate(seeds):
+            scores[number] = _score_candidate(values, candidate_seed, score, target_density, subset_size)
+            if progress is not None:
+                progress((number + 1) / count)
+    else:
+        # process pools are only loaded when used
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tasks = {pool.submit(_score_candidate, values, candidate_seed, score, target_density, subset_size): number
+                     for number, candidate_seed in enumerate(seeds)}
+            try:
+                for num_finished, task in enumerate(as_completed(tasks), start=1):
+                    scores[tasks[task]] = task.result()
+                    if progress is not None:
+                        progress(num_finished / count)
+            except GenerationCancelled:
+                for task in tasks:
+                    task.cancel()
+                raise
+
+    # ties go to the first candidate, so the result doesn't depend on the order the tasks finish
+    best = max(range(count), key=lambda number: (scores[number], -number))
+    return {
+        "model": SpeckleModel.from_values(values, seeds[best]),
+        "seed": seeds[best],
+        "score": scores[best],
+        "scores": scores
+    }
@@ -0,0 +1,183 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from speckle_generator import MIG, density
+from export import write_image, write_svg, write_pdf
+from pattern_model import SpeckleModel, model_path
+from candidates import best_candidate, CANDIDATE_SCORES
+
+# results that can be computed for every pattern. speckle_size is the autocorrelation FWHM in mm, which is not the
+# mean speckle diameter, and loads scipy
+METRIC_NAMES = ("density", "MIG", "speckle_size")
+# image formats, svg and pdf hold the speckles as vector circles
+IMAGE_FORMATS = ("png", "tiff", "svg", "pdf")
+# largest side in pixels the speckle size FFT runs on, larger patterns are measured on their centre
+SPECKLE_SIZE_MAX_PX = 2048
+
+def load_parameters(path):
+    """
+    Reads a parameter file as written by MainWindow.save_parameters.
+    :param path: JSON file with height, width, diameter, dpi, grid_step, min_diameter and rand_pos, and optionally the
+    placement, "grid" if missing
+    :return: dictionary of parameters
+    """
+    with open(path, "r", encoding="utf8") as infile:
+        values = json.load(infile)
+    missing = [key for key in ("height", "width", "diameter", "dpi", "grid_step", "min_diameter", "rand_pos")
+               if key not in values]
+    if missing:
+        raise ValueError(f"{path}: missing parameters {', '.join(missing)}")
+    return values
+
+def run_job(parameters_path, output_dir, metrics:tuple, seed:int=None, image_format:str="png", compression:int=6,
+            candidates:int=1, score:str="MIG", search_workers:int=1):
+    """
+    Generates the pattern of one parameter file, writes it as an image named after the file and computes its metrics.
+    If the GUI saved the speckles next to the parameter file and no seed is given, they are rasterized instead of
+    drawing a new pattern. Runs in the worker processes, so everything it needs is passed in.
+    :param parameters_path: parameter JSON file
+    :param output_dir: directory the image is written to
+    :param metrics: names from METRIC_NAMES to compute
+    :param seed: seed of the pattern, None for a random one. The seed used is recorded either way
+    :param image_format: one of IMAGE_FORMATS
+    :param compression: zlib compression level of png and tiff images, 0 to 9
+    :param candidates: number of random patterns scored by best_candidate when no saved speckles are used, the best
+    one is written. The seed then seeds the search
+    :param score: score of the candidates, one of CANDIDATE_SCORES
+    :param search_workers: number of processes scoring the candidates
+    :return: dictionary with the files, the pattern size, the seconds taken and the requested metrics, plus the score
+    of the best candidate if there was a search
+    """
+    start = time.perf_counter()
+    values = load_parameters(parameters_path)
+    saved_model = model_path(parameters_path)
+    model = SpeckleModel.load(saved_model) if seed is None and saved_model.exists() else None
+    search = None
+    if model is None or not model.matches(values):
+        saved_model = None
+        if candidates > 1:
+            search = best_candidate(values, candidates, score, seed=seed, workers=search_workers)
+            model = search["model"]
+        else:
+            # the same speckle model as the GUI, so the pattern doesn't depend on the image format
+            model = SpeckleModel.from_values(values, seed)
+    seed = model.seed
+    pattern = None
+    # vector images are written without rasterizing, unless the metrics need the pixels
+    if image_format not in ("svg", "pdf") or metrics:
+        pattern = model.rasterize(values["dpi"], packed=True)
+    image_path = Path(output_dir) / f"{Path(parameters_path).stem}.{image_format}"
+    if image_format == "svg":
+        write_svg(image_path, model)
+    elif image_format == "pdf":
+        write_pdf(image_path, model)
+    else:
+        write_image(image_path, pattern, dpi=values["dpi"], compression=compression)
+
+    height_px, width_px = pattern.shape if pattern is not None else model.shape_px(values["dpi"])
+    record = {
+        "parameters": str(parameters_path),
+        "model": None if saved_model is None else str(saved_model),
+        "image": str(image_path),
+        "seed": seed,
+        "height_px": height_px,
+        "width_px": width_px
+    }
+    if search is not None:
+        record["candidates"] = candidates
+        record[f"best_{score}"] = search["score"]
+    if "density" in metrics:
+        record["density"] = density(pattern)
+    if "MIG" in metrics:
+        record["MIG"] = MIG(pattern)
+    if "speckle_size" in metrics:
+        # imported here so scipy is only loaded when the speckle size is requested
+        from metrics import speckle_size, speckle_size_downsample
+        downsample = speckle_size_downsample(values["diameter"] * values["min_diameter"] / 100 * values["dpi"] / 25.4)
+        record["speckle_size"] = speckle_size(pattern, downsample=downsample, max_px=SPECKLE_SIZE_MAX_PX) * 25.4 / \
+                                 values["dpi"]
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+def write_summary(path, records:list):
+    """
+    Writes the records of all the jobs as a JSON list or, if path ends in .csv, as a CSV table.
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".csv":
+        fields = list(dict.fromkeys(key for record in records for key in record))
+        with open(path, "w", encoding="utf8", newline="") as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(path, "w", encoding="utf8") as outfile:
+            json.dump(records, outfile, indent=2)
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Generates speckle patterns from parameter files saved by the Speckle Pattern Generator, "
+                    "without the GUI."
+    )
+    parser.add_argument("parameters", nargs="+", help="parameter JSON files, one pattern per file")
+    parser.add_argument("-o", "--output-dir", default=".", help="directory the images and the summary are written to")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of patterns generated in parallel, default all the cores")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the first pattern, the next ones use seed + 1, seed + 2... If not given, the "
+                             "speckles saved next to a parameter file are used, otherwise the pattern is random")
+    parser.add_argument("--metrics", nargs="*", choices=METRIC_NAMES, default=["density", "MIG"],
+                        help="metrics computed for every pattern, default density and MIG. Pass none for no metrics")
+    parser.add_argument("--format", choices=IMAGE_FORMATS, default="png",
+                        help="image format, default png. svg and pdf write the speckles as vector circles")
+    parser.add_argument("--compression", type=int, choices=range(10), default=6, metavar="0-9",
+                        help="compression level of png and tiff images, default 6")
+    parser.add_argument("--candidates", type=int, default=1,
+                        help="random patterns generated per parameter file, only the best one by --score is written. "
+                             "Default 1")
+    parser.add_argument("--score", choices=CANDIDATE_SCORES, default="MIG",
+                        help="score the candidates are ranked by: highest MIG, density closest to 50 %% or highest "
+                             "SSSIG of the worst subset. Default MIG")
+    parser.add_argument("--summary", default="metrics.json",
+                        help="metrics file name inside the output directory, .json or .csv. Default metrics.json")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    metrics = tuple(args.metrics)
+    seeds = [None if args.seed is None else args.seed + i for i in range(len(args.parameters))]
+    jobs = max(1, min(args.jobs or 1, len(args.parameters)))
+
+    start = time.perf_counter()
+    if jobs == 1:
+        # no pool to start for a single job
+        # the cores score the candidates instead
+        records = [run_job(path, output_dir, metrics, seed, args.format, args.compression, args.candidates,
+                           args.score, args.jobs or 1)
+                   for path, seed in zip(args.parameters, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            records = list(pool.map(run_job, args.parameters, [output_dir] * len(seeds), [metrics] * len(seeds), seeds,
+                                    [args.format] * len(seeds), [args.compression] * len(seeds),
+                                    [args.candidates] * len(seeds), [args.score] * len(seeds)))
+    for record in records:
+        print(f"{record['image']}: {record['width_px']} x {record['height_px']} px in {record['seconds']:.2f} s")
+    write_summary(output_dir / args.summary, records)
+    print(f"{len(records)} patterns in {time.perf_counter() - start:.2f} s, metrics in {output_dir / args.summary}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
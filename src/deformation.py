@@ -0,0 +1,219 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import math
+import numpy as np
+from speckle_generator import check_out, SCATTER_CHUNK_SIZE
+from pattern_model import SpeckleModel
+
+class GridDisplacement:
+    """
+    Displacement field sampled on a regular grid covering the pattern, bilinearly interpolated. Unlike a lambda it
+    can be sent to the processes of render_sequence.
+    """
+
+    def __init__(self, ux:np.ndarray, uy:np.ndarray, width:float, height:float):
+        """
+        :param ux: in mm, x displacement of every grid node, shape (rows, columns) with at least 2 x 2 nodes. The
+        first and last nodes lie on the edges of the pattern
+        :param uy: in mm, y displacement of every grid node, same shape as ux
+        :param width: in mm, width of the pattern
+        :param height: in mm, height of the pattern
+        """
+        self.ux = np.asarray(ux, dtype=np.float64)
+        self.uy = np.asarray(uy, dtype=np.float64)
+        if self.ux.shape != self.uy.shape or self.ux.ndim != 2 or min(self.ux.shape) < 2:
+            raise ValueError("ux and uy must be 2D grids of the same shape with at least 2 x 2 nodes")
+        self.width = width
+        self.height = height
+
+    def __call__(self, x:np.ndarray, y:np.ndarray):
+        rows, cols = self.ux.shape
+        # position in grid cells, clamped to the grid so points outside it take the edge values
+        col = np.clip(x / self.width * (cols - 1), 0, cols - 1)
+        row = np.clip(y / self.height * (rows - 1), 0, rows - 1)
+        col0 = np.minimum(col.astype(np.int64), cols - 2)
+        row0 = np.minimum(row.astype(np.int64), rows - 2)
+        fx = col - col0
+        fy = row - row0
+
+        def interpolate(grid):
+            top = grid[row0, col0] * (1 - fx) + grid[row0, col0 + 1] * fx
+            bottom = grid[row0 + 1, col0] * (1 - fx) + grid[row0 + 1, col0 + 1] * fx
+            return top * (1 - fy) + bottom * fy
+
+        return interpolate(self.ux), interpolate(self.uy)
+
+def displacement_function(displacement, width:float, height:float):
+    """
+    Turns a displacement field given as a callable or as a (ux, uy) grid into a callable.
+    :param displacement: callable taking arrays of x and y in mm and returning the x and y displacements in mm, or a
+    pair of grids as taken by GridDisplacement
+    :param width: in mm, width of the pattern
+    :param height: in mm, height of the pattern
+    :return: callable
+    """
+    if callable(displacement):
+        return displacement
+    ux, uy = displacement
+    return GridDisplacement(ux, uy, width, height)
+
+def deformation_gradients(displacement, x:np.ndarray, y:np.ndarray, step:float):
+    """
+    Deformation gradient F = I + grad(u) at every point, by central differences of the displacement.
+    :param displacement: callable as returned by displacement_function
+    :param x: in mm, x of the points
+    :param y: in mm, y of the points
+    :param step: in mm, finite difference step
+    :return: F11, F12, F21 and F22 arrays, F12 being d(x + ux) / dy
+    """
+    ux_right, uy_right = displacement(x + step, y)
+    ux_left, uy_left = displacement(x - step, y)
+    ux_down, uy_down = displacement(x, y + step)
+    ux_up, uy_up = displacement(x, y - step)
+    return (1 + (np.asarray(ux_right) - ux_left) / (2 * step), (np.asarray(ux_down) - ux_up) / (2 * step),
+            (np.asarray(uy_right) - uy_left) / (2 * step), 1 + (np.asarray(uy_down) - uy_up) / (2 * step))
+
+def stamp_ellipses(image:np.ndarray, centre_y:np.ndarray, centre_x:np.ndarray, radius:np.ndarray,
+                   inverse_gradients:tuple, antialias:bool=True, progress=None):
+    """
+    Draws speckles analytically at exact sub-pixel centres, as circles or as the ellipses circles turn into under
+    a deformation gradient. A pixel is inside a speckle when its centre, mapped back to the undeformed speckle by
+    the inverse gradient, is within the radius. Anti-aliased pixels are shaded by the signed distance to the edge
+    over a one pixel wide ramp, as generate_antialiased_speckles does for circles, and min-composited.
+    :param image: C-contiguous uint8 image, modified in place. Speckles are clipped to it
+    :param centre_y: in pixels, row of every speckle centre, pixel i spanning [i, i + 1)
+    :param centre_x: in pixels, column of every speckle centre
+    :param radius: in pixels, undeformed radius of every speckle
+    :param inverse_gradients: (a, b, c, d) arrays of the inverse deformation gradient [[a, b], [c, d]] of every
+    speckle, mapping (x, y) offsets back to the undeformed speckle
+    :param antialias: shade the edge pixels, otherwise pixels are black or white
+    :param progress: optional callable receiving the fraction of speckles drawn
+    :return: None
+    """
+    if centre_y.size == 0:
+        return
+    a, b, c, d = (np.broadcast_to(np.asarray(component, dtype=np.float64), centre_y.shape) for component in inverse_gradients)
+    height, width = image.shape
+    flat_image = image.reshape(-1)
+    # half extent of every ellipse: the radius times the largest stretch, the inverse of the smallest singular
+    # value of the inverse gradient
+    frobenius = a ** 2 + b ** 2 + c ** 2 + d ** 2
+    determinant = np.abs(a * d - b * c)
+    smallest = np.sqrt(np.maximum((frobenius - np.sqrt(np.maximum(frobenius ** 2 - 4 * determinant ** 2, 0))) / 2, 1e-12))
+    side_len = 2 * int(math.ceil(np.max(radius / smallest))) + 3
+    offsets = np.arange(side_len) - side_len // 2
+    chunk_len = max(1, SCATTER_CHUNK_SIZE // (side_len * side_len))
+    for start in range(0, centre_y.size, chunk_len):
+        chunk = slice(start, start + chunk_len)
+        top = np.floor(centre_y[chunk]).astype(np.int64)[:, None] + offsets
+        left = np.floor(centre_x[chunk]).astype(np.int64)[:, None] + offsets
+        # offsets of the pixel centres from the speckle centres, shape (speckles, side_len)
+        dy = (top + 0.5 - centre_y[chunk, None])[:, :, None]
+        dx = (left + 0.5 - centre_x[chunk, None])[:, None, :]
+        ca, cb, cc, cd = (component[chunk, None, None] for component in (a, b, c, d))
+        # undeformed offsets, shape (speckles, side_len, side_len)
+        undeformed_x = ca * dx + cb * dy
+        undeformed_y = cc * dx + cd * dy
+        distance = np.hypot(undeformed_x, undeformed_y)
+        chunk_radius = radius[chunk, None, None]
+        if antialias:
+            # the gradient of the undeformed distance turns its difference to the radius into pixels
+            safe = np.maximum(distance, 1e-12)
+            slope = np.hypot((ca * undeformed_x + cc * undeformed_y) / safe, (cb * undeformed_x + cd * undeformed_y) / safe)
+            coverage = np.clip((chunk_radius - distance) / np.maximum(slope, 1e-12) + 0.5, 0, 1)
+            values = np.rint(255 * (1 - coverage)).astype(np.uint8)
+        else:
+            values = np.where(distance <= chunk_radius, 0, 255).astype(np.uint8)
+        rows = np.broadcast_to(top[:, :, None], values.shape)
+        cols = np.broadcast_to(left[:, None, :], values.shape)
+        keep = (values < 255) & (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        pixel_offsets = rows[keep] * width + cols[keep]
+        if antialias:
+            np.minimum.at(flat_image, pixel_offsets, values[keep])
+        else:
+            flat_image[pixel_offsets] = 0
+        if progress is not None:
+            progress(min(start + chunk_len, centre_y.size) / centre_y.size)
+
+def render_deformed(model:SpeckleModel, resolution:float, displacement=None, ellipses:bool=False,
+                    antialias:bool=True, out:np.ndarray=None, progress=None):
+    """
+    Renders the speckles of a model moved by a displacement field, for reference and deformed image pairs with a
+    known displacement. The speckles are drawn again at their displaced centres instead of warping a raster, so
+    they stay sharp and sub-pixel displacements are exact. The reference image is rendered with no displacement,
+    so both images of a pair share the same rasterization.
+    :param model: SpeckleModel with the speckles in their reference positions
+    :param resolution: in dot per inch
+    :param displacement: callable taking arrays of x and y in mm of the reference centres and returning their x and
+    y displacements in mm, or a (ux, uy) pair of grids as taken by GridDisplacement. None for the reference image
+    :param ellipses: deform every speckle by the local deformation gradient, turning circles into ellipses.
+    Otherwise speckles are only moved
+    :param antialias: shade the edge pixels, otherwise the image is binary
+    :param out: optional C-contiguous uint8 array of the size of the pattern to draw into
+    :param progress: optional callable receiving the fraction of speckles drawn
+    :return: grayscale array, out if given
+    """
+    height_px, width_px = model.shape_px(resolution)
+    dpmm = resolution / 25.4
+    image = check_out(out, (height_px, width_px))
+    image.fill(255)
+    x = model.speckles["x"].astype(np.float64)
+    y = model.speckles["y"].astype(np.float64)
+    radius = model.speckles["diameter"].astype(np.float64) / 2
+    inverse_gradients = (1.0, 0.0, 0.0, 1.0)
+    if displacement is not None:
+        displacement = displacement_function(displacement, model.parameters["width"], model.parameters["height"])
+        ux, uy = displacement(x, y)
+        if ellipses:
+            f11, f12, f21, f22 = deformation_gradients(displacement, x, y, model.parameters["diameter"] / 100)
+            determinant = f11 * f22 - f12 * f21
+            inverse_gradients = (f22 / determinant, -f12 / determinant, -f21 / determinant, f11 / determinant)
+        x = x + ux
+        y = y + uy
+    stamp_ellipses(image, y * dpmm, x * dpmm, radius * dpmm, inverse_gradients, antialias, progress)
+    return image
+
+def _render_frame(model:SpeckleModel, resolution:float, displacement, ellipses:bool, antialias:bool):
+    """
+    Process pool task of render_sequence.
+    """
+    return render_deformed(model, resolution, displacement, ellipses, antialias)
+
+def render_sequence(model:SpeckleModel, resolution:float, displacements:list, ellipses:bool=False,
+                    antialias:bool=True, workers:int=None, progress=None):
+    """
+    Renders a load sequence, one frame per displacement field, in parallel processes.
+    Displacement fields are sent to the processes, so they must be picklable: GridDisplacement instances, grids or
+    module level functions, not lambdas.
+    :param model: SpeckleModel with the speckles in their reference positions
+    :param resolution: in dot per inch
+    :param displacements: displacement field of every frame as taken by render_deformed, None for the reference
+    :param ellipses: deform the speckles by the local deformation gradient
+    :param antialias: shade the edge pixels, otherwise the images are binary
+    :param workers: number of processes, all the cores by default. With 1 the frames are rendered in this process
+    :param progress: optional callable receiving the fraction of frames done
+    :return: list of grayscale arrays, one per frame
+    """
+    import os
+    workers = min(workers or os.cpu_count() or 1, max(1, len(displacements)))
+    frames = [None] * len(displacements)
+    if workers <= 1:
+        for number, displacement in enumerate(displacements):
+            frames[number] = render_deformed(model, resolution, displacement, ellipses, antialias)
+            if progress is not None:
+                progress((number + 1) / len(displacements))
+        return frames
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        tasks = {pool.submit(_render_frame, model, resolution, displacement, ellipses, antialias): number
+                 for number, displacement in enumerate(displacements)}
+        for done, task in enumerate(as_completed(tasks), start=1):
+            frames[tasks[task]] = task.result()
+            if progress is not None:
+                progress(done / len(displacements))
+    return frames
@@ -0,0 +1,337 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import os
+import struct
+import zlib
+from pathlib import Path
+import numpy as np
+from speckle_generator import PackedPattern, read_rows
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# number of rows compressed at once when writing images
+EXPORT_BLOCK_ROWS = 1024
+# uncompressed size of every TIFF strip
+TIFF_STRIP_BYTES = 2 ** 20
+# TIFF field types
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_RATIONAL = 5
+TIFF_LONG8 = 16
+# number of speckles formatted at once when writing vector files
+EXPORT_BLOCK_SPECKLES = 2 ** 16
+# vector files are written in whole micrometres, much finer than any printer dot, so coordinates are short integers
+VECTOR_UNITS_PER_MM = 1000
+# distance of the Bezier control points of a quarter circle from its ends, in radii
+BEZIER_CIRCLE = 0.5522847498
+# points per mm
+PT_PER_MM = 72 / 25.4
+
+def png_chunk(kind:bytes, data:bytes):
+    """
+    Builds a PNG chunk: length, type, data and the CRC of type and data.
+    """
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+def encode_rows(array, first_row:int, last_row:int, bit_depth:int, speckle_bit:int):
+    """
+    Rows [first_row, last_row) of a grayscale array, memory map or PackedPattern as the bytes of an image row.
+    :param bit_depth: 8 for one byte per pixel, 1 for eight pixels per byte, rows padded to whole bytes
+    :param speckle_bit: value of the speckle pixels in 1 bit rows
+    :return: uint8 array of shape (last_row - first_row, bytes per row)
+    """
+    if bit_depth == 1:
+        if isinstance(array, PackedPattern):
+            bits = array.bits[first_row:last_row]
+        else:
+            bits = np.packbits(read_rows(array, first_row, last_row) < 128, axis=1)
+        # packed patterns store speckles as set bits
+        return bits if speckle_bit else ~bits
+    return np.ascontiguousarray(read_rows(array, first_row, last_row), dtype=np.uint8)
+
+def default_bit_depth(array):
+    """
+    1 bit for packed patterns, which are binary, and 8 bits for grayscale arrays.
+    """
+    return 1 if isinstance(array, PackedPattern) else 8
+
+def write_png(path, array, dpi:float=None, compression:int=6, block_rows:int=EXPORT_BLOCK_ROWS, bit_depth:int=None,
+              progress=None):
+    """
+    Writes a grayscale array, memory map or PackedPattern as a PNG file, without Qt. The rows are compressed a band
+    at a time, so only one band is ever unpacked in memory.
+    :param path: output file path
+    :param array: image to write, 0 for speckles and 255 for the background
+    :param dpi: resolution stored in the file, if given
+    :param compression: zlib compression level, 0 to 9
+    :param block_rows: number of rows compressed at once
+    :param bit_depth: 1 or 8 bits per pixel. By default 1 for packed patterns and 8 for arrays, which are thresholded
+    at 128 when written with 1 bit
+    :param progress: optional callable receiving the fraction of rows written
+    :return: None
+    """
+    height, width = array.shape
+    bit_depth = default_bit_depth(array) if bit_depth is None else bit_depth
+    # grayscale, no interlacing
+    header = struct.pack(">IIBBBBB", width, height, bit_depth, 0, 0, 0, 0)
+    compressor = zlib.compressobj(compression)
+    with open(path, "wb") as file:
+        file.write(PNG_SIGNATURE)
+        file.write(png_chunk(b"IHDR", header))
+        if dpi:
+            pixels_per_meter = round(dpi / 0.0254)
+            file.write(png_chunk(b"pHYs", struct.pack(">IIB", pixels_per_meter, pixels_per_meter, 1)))
+        for first_row in range(0, height, block_rows):
+            last_row = min(first_row + block_rows, height)
+            # speckles are black, that is 0 in a 1 bit grayscale PNG
+            rows = encode_rows(array, first_row, last_row, bit_depth, speckle_bit=0)
+            # every scanline starts with its filter type, 0 for none
+            scanlines = np.zeros((last_row - first_row, rows.shape[1] + 1), dtype=np.uint8)
+            scanlines[:, 1:] = rows
+            data = compressor.compress(scanlines.data)
+            if data:
+                file.write(png_chunk(b"IDAT", data))
+            if progress is not None:
+                progress(last_row / height)
+        file.write(png_chunk(b"IDAT", compressor.flush()))
+        file.write(png_chunk(b"IEND", b""))
+
+def tiff_rows_per_strip(bytes_per_row:int, strip_bytes:int=TIFF_STRIP_BYTES):
+    return max(1, strip_bytes // max(1, bytes_per_row))
+
+def write_tiff(path, array, dpi:float=None, compression:int=6, bit_depth:int=None, bigtiff:bool=None,
+               strip_bytes:int=TIFF_STRIP_BYTES, workers:int=None, progress=None):
+    """
+    Writes a grayscale array, memory map or PackedPattern as a TIFF file, without Qt. The image is split in strips
+    of rows that are compressed independently by a pool of threads, zlib releases the GIL, and written in order as
+    they finish, so only a few strips are in memory at once. Images too large for 32 bit offsets are written as
+    BigTIFF.
+    :param path: output file path
+    :param array: image to write, 0 for speckles and 255 for the background
+    :param dpi: resolution stored in the file, if given
+    :param compression: zlib compression level, 1 to 9, or 0 for uncompressed strips
+    :param bit_depth: 1 or 8 bits per pixel. By default 1 for packed patterns and 8 for arrays, which are thresholded
+    at 128 when written with 1 bit
+    :param bigtiff: force or prevent BigTIFF, by default only used when the image needs it
+    :param strip_bytes: uncompressed size of every strip
+    :param workers: number of compression threads, all the cores by default
+    :param progress: optional callable receiving the fraction of strips written
+    :return: None
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    height, width = array.shape
+    bit_depth = default_bit_depth(array) if bit_depth is None else bit_depth
+    bytes_per_row = (width * bit_depth + 7) // 8
+    rows_per_strip = tiff_rows_per_strip(bytes_per_row, strip_bytes)
+    strips = [(row, min(row + rows_per_strip, height)) for row in range(0, height, rows_per_strip)]
+    if bigtiff is None:
+        # deflate may grow incompressible data slightly, so the raw size is checked with some margin
+        bigtiff = height * bytes_per_row * 1.01 + 2 ** 20 >= 2 ** 32
+    workers = workers or os.cpu_count() or 1
+
+    def encode_strip(strip):
+        # 1 bit strips are WhiteIsZero, so speckles are set bits as in PackedPattern
+        data = encode_rows(array, strip[0], strip[1], bit_depth, speckle_bit=1).tobytes()
+        return zlib.compress(data, compression) if compression else data
+
+    offsets = []
+    byte_counts = []
+    with open(path, "wb") as file:
+        # the first IFD offset is patched once the strips are written
+        if bigtiff:
+            file.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+        else:
+            file.write(b"II" + struct.pack("<HI", 42, 0))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            strip_iterator = iter(strips)
+            # a bounded window of strips in flight keeps the memory bounded and the writes in order
+            for strip in strip_iterator:
+                pending.append(pool.submit(encode_strip, strip))
+                if len(pending) >= 2 * workers:
+                    break
+            while pending:
+                data = pending.pop(0).result()
+                offsets.append(file.tell())
+                byte_counts.append(len(data))
+                file.write(data)
+                # strip data starts on word boundaries
+                if file.tell() % 2:
+                    file.write(b"\0")
+                next_strip = next(strip_iterator, None)
+                if next_strip is not None:
+                    pending.append(pool.submit(encode_strip, next_strip))
+                if progress is not None:
+                    progress(len(offsets) / len(strips))
+
+        offset_type = TIFF_LONG8 if bigtiff else TIFF_LONG
+        resolution = (round(dpi * 10000), 10000) if dpi else (1, 1)
+        # tags in ascending order, with the type and values of each
+        tags = [
+            (256, TIFF_LONG, [width]),
+            (257, TIFF_LONG, [height]),
+            (258, TIFF_SHORT, [bit_depth]),
+            (259, TIFF_SHORT, [8 if compression else 1]),
+            # WhiteIsZero for 1 bit images, BlackIsZero for grayscale ones
+            (262, TIFF_SHORT, [0 if bit_depth == 1 else 1]),
+            (273, offset_type, offsets),
+            (277, TIFF_SHORT, [1]),
+            (278, TIFF_LONG, [rows_per_strip]),
+            (279, offset_type, byte_counts),
+            (282, TIFF_RATIONAL, list(resolution)),
+            (283, TIFF_RATIONAL, list(resolution)),
+            # inches, or no unit without a resolution
+            (296, TIFF_SHORT, [2 if dpi else 1]),
+        ]
+        write_tiff_ifd(file, tags, bigtiff)
+
+def write_tiff_ifd(file, tags:list, bigtiff:bool):
+    """
+    Writes the image file directory of a single image TIFF at the end of the file, the values that don't fit in
+    their entry after it, and points the header to it.
+    :param tags: list of (tag, type, values), sorted by tag
+    """
+    formats = {TIFF_SHORT: "H", TIFF_LONG: "I", TIFF_RATIONAL: "I", TIFF_LONG8: "Q"}
+    count_format, inline_bytes, entry_size, count_size = ("Q", 8, 20, 8) if bigtiff else ("I", 4, 12, 2)
+    if file.tell() % 2:
+        file.write(b"\0")
+    ifd_offset = file.tell()
+    # values that don't fit in their entry go after the entries and the next IFD offset
+    extra_offset = ifd_offset + count_size + len(tags) * entry_size + inline_bytes
+    entries = []
+    extra = []
+    for tag, kind, values in tags:
+        data = struct.pack(f"<{len(values)}{formats[kind]}", *values)
+        # rationals are pairs of numbers, counted as one value
+        count = len(values) // 2 if kind == TIFF_RATIONAL else len(values)
+        if len(data) <= inline_bytes:
+            value = data.ljust(inline_bytes, b"\0")
+        else:
+            value = struct.pack(f"<{'Q' if bigtiff else 'I'}", extra_offset + sum(len(chunk) for chunk in extra))
+            extra.append(data)
+        entries.append(struct.pack(f"<HH{count_format}", tag, kind, count) + value)
+    file.write(struct.pack("<Q" if bigtiff else "<H", len(tags)))
+    file.write(b"".join(entries))
+    # no next IFD
+    file.write(bytes(inline_bytes))
+    file.write(b"".join(extra))
+    file.seek(8 if bigtiff else 4)
+    file.write(struct.pack("<Q" if bigtiff else "<I", ifd_offset))
+
+def write_image(path, array, dpi:float=None, compression:int=6, bit_depth:int=None, progress=None):
+    """
+    Writes an image as PNG or TIFF depending on the extension of path.
+    """
+    if Path(path).suffix.lower() in (".tif", ".tiff"):
+        write_tiff(path, array, dpi, compression, bit_depth, progress=progress)
+    else:
+        write_png(path, array, dpi, compression, bit_depth=bit_depth, progress=progress)
+
+def vector_speckles(block:np.ndarray):
+    """
+    Centres and diameters of a block of SpeckleModel speckles in VECTOR_UNITS_PER_MM.
+    """
+    return np.rint(np.column_stack((block["x"], block["y"], block["diameter"])).astype(np.float64) *
+                   VECTOR_UNITS_PER_MM).astype(np.int64)
+
+def write_svg(path, model, inverted:bool=False, block_speckles:int=EXPORT_BLOCK_SPECKLES):
+    """
+    Writes the speckles of a SpeckleModel as SVG circles, so the file grows with the number of speckles and not with
+    the resolution. The speckles are written a block at a time and clipped to the pattern.
+    :param path: output file path
+    :param model: SpeckleModel to write
+    :param inverted: white speckles on a black background
+    :param block_speckles: number of speckles formatted at once
+    :return: None
+    """
+    width = model.parameters["width"]
+    height = model.parameters["height"]
+    view_width = round(width * VECTOR_UNITS_PER_MM)
+    view_height = round(height * VECTOR_UNITS_PER_MM)
+    background, foreground = ("black", "white") if inverted else ("white", "black")
+    speckles = model.speckles
+    with open(path, "w", encoding="utf8") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        # the view box is in micrometres and the document in mm
+        file.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}mm" height="{height}mm" '
+                   f'viewBox="0 0 {view_width} {view_height}">\n')
+        file.write(f'<defs><clipPath id="pattern"><rect width="{view_width}" height="{view_height}"/></clipPath></defs>\n')
+        file.write(f'<rect width="{view_width}" height="{view_height}" fill="{background}"/>\n')
+        file.write(f'<g clip-path="url(#pattern)" fill="{foreground}">\n')
+        for start in range(0, speckles.size, block_speckles):
+            circles = vector_speckles(speckles[start:start + block_speckles])
+            # radius with half units, so odd diameters stay exact
+            file.write("".join(f'<circle cx="{x}" cy="{y}" r="{d / 2:g}"/>\n' for x, y, d in circles.tolist()))
+        file.write("</g>\n</svg>\n")
+
+def write_pdf(path, model, inverted:bool=False, compression:int=6, block_speckles:int=EXPORT_BLOCK_SPECKLES):
+    """
+    Writes the speckles of a SpeckleModel as a one page vector PDF the size of the pattern, so the file grows with
+    the number of speckles and printers rasterize it at their own resolution. A unit circle is defined once and
+    every speckle draws it scaled to its diameter. The page content is compressed and written a block of speckles
+    at a time.
+    :param path: output file path
+    :param model: SpeckleModel to write
+    :param inverted: white speckles on a black background
+    :param compression: zlib compression level, 0 to 9
+    :param block_speckles: number of speckles formatted at once
+    :return: None
+    """
+    width = model.parameters["width"]
+    height = model.parameters["height"]
+    view_width = round(width * VECTOR_UNITS_PER_MM)
+    view_height = round(height * VECTOR_UNITS_PER_MM)
+    scale = PT_PER_MM / VECTOR_UNITS_PER_MM
+    speckles = model.speckles
+    k = BEZIER_CIRCLE / 2
+    # circle of diameter 1 centred on the origin, four Bezier quarters
+    unit_circle = (f"0.5 0 m 0.5 {k:.6f} {k:.6f} 0.5 0 0.5 c -{k:.6f} 0.5 -0.5 {k:.6f} -0.5 0 c "
+                   f"-0.5 -{k:.6f} -{k:.6f} -0.5 0 -0.5 c {k:.6f} -0.5 0.5 -{k:.6f} 0.5 0 c f").encode()
+    compressor = zlib.compressobj(compression)
+    with open(path, "wb") as file:
+        offsets = []
+
+        def begin_object():
+            offsets.append(file.tell())
+            file.write(f"{len(offsets)} 0 obj\n".encode())
+
+        file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        begin_object()
+        file.write(b"<< /Type /Catalog /Pages 2 0 R >>\nendobj\n")
+        begin_object()
+        file.write(b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>\nendobj\n")
+        begin_object()
+        file.write(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width * PT_PER_MM:.4f} {height * PT_PER_MM:.4f}] "
+                   f"/Resources << /XObject << /S 6 0 R >> >> /Contents 4 0 R >>\nendobj\n".encode())
+        # the stream length is only known once it's written, so it goes in the next object
+        begin_object()
+        file.write(b"<< /Length 5 0 R /Filter /FlateDecode >>\nstream\n")
+        stream_start = file.tell()
+        # micrometres with the origin at the upper left corner, as in the model, and everything clipped to the pattern
+        header = f"{scale:.8f} 0 0 {-scale:.8f} 0 {height * PT_PER_MM:.4f} cm\n0 0 {view_width} {view_height} re W n\n"
+        if inverted:
+            header += f"0 g 0 0 {view_width} {view_height} re f\n1 g\n"
+        else:
+            header += "0 g\n"
+        file.write(compressor.compress(header.encode()))
+        for start in range(0, speckles.size, block_speckles):
+            circles = vector_speckles(speckles[start:start + block_speckles])
+            content = "".join(f"q {d} 0 0 {d} {x} {y} cm /S Do Q\n" for x, y, d in circles.tolist())
+            file.write(compressor.compress(content.encode()))
+        file.write(compressor.flush())
+        stream_length = file.tell() - stream_start
+        file.write(b"\nendstream\nendobj\n")
+        begin_object()
+        file.write(f"{stream_length}\nendobj\n".encode())
+        begin_object()
+        file.write(f"<< /Type /XObject /Subtype /Form /BBox [-0.5 -0.5 0.5 0.5] /Length {len(unit_circle)} >>\n"
+                   f"stream\n".encode() + unit_circle + b"\nendstream\nendobj\n")
+
+        xref = file.tell()
+        file.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            file.write(f"{offset:010d} 00000 n \n".encode())
+        file.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
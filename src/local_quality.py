@@ -0,0 +1,184 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import numpy as np
+from speckle_generator import read_extended_rows, central_differences
+
+# number of rows processed at once when building the summed-area tables
+QUALITY_BLOCK_ROWS = 128
+# features integrated by the summed-area tables: squared x gradient, squared y gradient, gradient norm, darkness
+_FEATURES = ("grad_x2", "grad_y2", "grad_norm", "darkness")
+
+def subset_origins(length:int, subset_size:int, step:int):
+    """
+    First pixel of every subset along one axis.
+    :param length: image size along the axis in pixels
+    :param subset_size: subset side length in pixels
+    :param step: separation between consecutive subsets in pixels
+    :return: array of subset origins
+    """
+    if subset_size > length:
+        return np.zeros(0, dtype=np.int64)
+    return np.arange(0, length - subset_size + 1, step, dtype=np.int64)
+
+def sampled_integrals(array, rows:np.ndarray, cols:np.ndarray, block_rows:int=QUALITY_BLOCK_ROWS):
+    """
+    Summed-area tables of the gradient and darkness features of the image, evaluated only at the given rows and
+    columns of the table. The image is streamed in bands of rows and only the sampled entries are stored, so the
+    memory depends on the number of samples and not on the size of the image.
+    Entry [i, j] of a table is the sum of the feature over the pixels above row rows[i] and left of column cols[j].
+    :param array: grayscale array, memory map or PackedPattern
+    :param rows: sorted table rows to keep, between 0 and the image height
+    :param cols: sorted table columns to keep, between 0 and the image width
+    :param block_rows: number of image rows processed at once
+    :return: dictionary of float64 tables of shape (rows.size, cols.size), one per feature
+    """
+    height, width = array.shape
+    num_features = len(_FEATURES)
+    tables = np.zeros((num_features, rows.size, cols.size), dtype=np.float64)
+    # running sum of the column prefix sums of all the rows processed so far
+    carry = np.zeros((num_features, cols.size), dtype=np.float64)
+    # table row 0 is always zero, so the first row to fill is the first sampled row above 0
+    next_sample = int(np.searchsorted(rows, 1))
+
+    block_rows = max(1, min(block_rows, height))
+    extended = np.empty((block_rows + 2, width), dtype=np.float32)
+    diff_x = np.empty((block_rows, width), dtype=np.float32)
+    diff_y = np.empty((block_rows, width), dtype=np.float32)
+    features = np.empty((num_features, block_rows, width + 1), dtype=np.float64)
+    for first_row in range(0, height, block_rows):
+        if next_sample == rows.size:
+            break
+        last_row = min(first_row + block_rows, height)
+        num_rows = last_row - first_row
+        band_x = diff_x[:num_rows]
+        band_y = diff_y[:num_rows]
+        central_differences(read_extended_rows(array, first_row, last_row, extended), band_x, band_y)
+
+        band_features = features[:, :num_rows]
+        band_features[:, :, 0] = 0
+        # the gradient is half the difference across two pixels
+        np.multiply(band_x, band_x, out=band_features[0, :, 1:])
+        np.multiply(band_y, band_y, out=band_features[1, :, 1:])
+        band_features[0:2, :, 1:] *= 0.25
+        np.add(band_features[0, :, 1:], band_features[1, :, 1:], out=band_features[2, :, 1:])
+        np.sqrt(band_features[2, :, 1:], out=band_features[2, :, 1:])
+        np.subtract(255, extended[1:num_rows + 1], out=band_features[3, :, 1:])
+
+        # prefix sums along x, keeping only the sampled columns, then along y on top of the carried sums
+        column_sums = np.cumsum(band_features, axis=2)[:, :, cols]
+        np.cumsum(column_sums, axis=1, out=column_sums)
+        column_sums += carry[:, None, :]
+        # table row r holds the sums of image rows [0, r), that is band row r - first_row - 1
+        sample_end = int(np.searchsorted(rows, last_row, side="right"))
+        sampled = rows[next_sample:sample_end]
+        tables[:, next_sample:sample_end] = column_sums[:, sampled - first_row - 1]
+        next_sample = sample_end
+        carry = column_sums[:, -1].copy()
+
+    return dict(zip(_FEATURES, tables))
+
+def subset_quality_maps(array, subset_size:int, step:int=1, block_rows:int=QUALITY_BLOCK_ROWS):
+    """
+    Quality of every square subset of the image for DIC, each subset evaluated in O(1) from summed-area tables.
+    Subsets start every step pixels, so step > 1 gives coarser maps of huge images at a fraction of the memory.
+    :param array: grayscale array, memory map or PackedPattern
+    :param subset_size: subset side length in pixels
+    :param step: separation between consecutive subsets in pixels
+    :param block_rows: number of image rows processed at once
+    :return: dictionary of maps of shape (number of subset rows, number of subset columns):
+    "sssig_x" and "sssig_y" sum of square of subset intensity gradients along each axis, "sssig" the smaller of the
+    two, "mig" local mean intensity gradient, "density" local density in %. "rows" and "cols" hold the first pixel
+    of the subsets
+    """
+    if subset_size < 1 or step < 1:
+        raise ValueError("subset_size and step must be at least one pixel")
+    height, width = array.shape
+    subset_rows = subset_origins(height, subset_size, step)
+    subset_cols = subset_origins(width, subset_size, step)
+    if subset_rows.size == 0 or subset_cols.size == 0:
+        raise ValueError("Subset is larger than the image")
+
+    # table entries at both edges of every subset
+    table_rows = np.union1d(subset_rows, subset_rows + subset_size)
+    table_cols = np.union1d(subset_cols, subset_cols + subset_size)
+    tables = sampled_integrals(array, table_rows, table_cols, block_rows)
+
+    top = np.searchsorted(table_rows, subset_rows)
+    bottom = np.searchsorted(table_rows, subset_rows + subset_size)
+    left = np.searchsorted(table_cols, subset_cols)
+    right = np.searchsorted(table_cols, subset_cols + subset_size)
+    return _tables_to_maps(tables, (top, bottom), (left, right), subset_size, subset_rows, subset_cols)
+
+def _tables_to_maps(tables:dict, table_rows:tuple, table_cols:tuple, subset_size:int, subset_rows:np.ndarray,
+                    subset_cols:np.ndarray):
+    """
+    Quality maps of subsets from the table entries at their edges. table_rows holds the table row indices of the
+    top and bottom edges of every subset row, table_cols those of the left and right edges of every subset column.
+    """
+    top, bottom = (edge[:, None] for edge in table_rows)
+    left, right = (edge[None, :] for edge in table_cols)
+
+    def subset_sum(table):
+        return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+    subset_pixels = subset_size * subset_size
+    sssig_x = subset_sum(tables["grad_x2"])
+    sssig_y = subset_sum(tables["grad_y2"])
+    return {
+        "sssig_x": sssig_x,
+        "sssig_y": sssig_y,
+        "sssig": np.minimum(sssig_x, sssig_y),
+        "mig": subset_sum(tables["grad_norm"]) / subset_pixels,
+        "density": subset_sum(tables["darkness"]) / (255 * subset_pixels) * 100,
+        "rows": subset_rows,
+        "cols": subset_cols
+    }
+
+class SubsetQualityTables:
+    """
+    Summed-area tables of an image sampled every spacing pixels along both axes, built in one pass over the image.
+    Quality maps of any subset size are then read from them without going through the image again. Subsets start and
+    end on the sampled rows and columns, so their size and step are rounded to multiples of spacing; with spacing 1
+    the maps are those of subset_quality_maps.
+    """
+
+    def __init__(self, array, spacing:int=1, block_rows:int=QUALITY_BLOCK_ROWS):
+        """
+        :param array: grayscale array, memory map or PackedPattern
+        :param spacing: separation in pixels between the sampled rows and columns
+        :param block_rows: number of image rows processed at once
+        """
+        if spacing < 1:
+            raise ValueError("spacing must be at least one pixel")
+        height, width = array.shape
+        self.shape = array.shape
+        self.spacing = spacing
+        self.rows = np.arange(0, height + 1, spacing, dtype=np.int64)
+        self.cols = np.arange(0, width + 1, spacing, dtype=np.int64)
+        self.tables = sampled_integrals(array, self.rows, self.cols, block_rows)
+
+    def maps(self, subset_size:int, step:int=None):
+        """
+        Quality of every square subset, read from the tables.
+        :param subset_size: subset side length in pixels, rounded to the nearest multiple of spacing
+        :param step: separation between consecutive subsets in pixels, rounded to a multiple of spacing. spacing if None
+        :return: dictionary of maps as returned by subset_quality_maps, plus the "subset_size" and "step" used
+        """
+        if subset_size < 1 or (step is not None and step < 1):
+            raise ValueError("subset_size and step must be at least one pixel")
+        size = max(1, round(subset_size / self.spacing))
+        stride = 1 if step is None else max(1, round(step / self.spacing))
+        # table indices of the top and left edges of the subsets
+        top = np.arange(0, self.rows.size - size, stride)
+        left = np.arange(0, self.cols.size - size, stride)
+        if top.size == 0 or left.size == 0:
+            raise ValueError("Subset is larger than the image")
+        maps = _tables_to_maps(self.tables, (top, top + size), (left, left + size), size * self.spacing,
+                               self.rows[top], self.cols[left])
+        maps["subset_size"] = size * self.spacing
+        maps["step"] = stride * self.spacing
+        return maps
@@ -4,21 +4,33 @@ See License.txt in the root directory.
 """
 __author__ = "Rodrigo Parrilla Mesas"
 
+import time
+# startup timer, started before the heavy imports
+STARTUP_START = time.perf_counter()
 import sys
 import numpy as np
 import json
+import math
 import ctypes
 from pathlib import Path
 import os
-import webbrowser
 from PySide6.QtWidgets import (
     QApplication ,QWidget, QMainWindow, QHBoxLayout, QVBoxLayout, QFormLayout, QGridLayout,
-    QSpinBox, QDoubleSpinBox, QLabel, QPushButton, QGroupBox, QFileDialog
+    QSpinBox, QDoubleSpinBox, QLabel, QPushButton, QGroupBox, QFileDialog, QCheckBox, QProgressBar, QComboBox
 )
-from PySide6.QtGui import QImage, QPixmap, QIcon, QPainter, QPageSize
-from PySide6.QtCore import Qt, QRectF, QLocale
-from PySide6.QtPrintSupport import QPrinter, QPrintPreviewDialog
-from speckle_generator import image_speckle, MIG, density
+from PySide6.QtGui import QImage, QIcon, QPainter, QPageSize, QPen, QPolygonF, qRgb
+from PySide6.QtCore import Qt, QRectF, QPointF, QLocale, QObject, QRunnable, QThreadPool, QTimer, Signal
+from speckle_generator import density, PackedPattern, GenerationCancelled
+from metrics import stream_metrics, speckle_size, speckle_size_downsample
+from local_quality import SubsetQualityTables
+from viewer import PatternViewer
+from pattern_model import SpeckleModel, model_path
+from candidates import best_candidate, DEFAULT_SUBSET_SIZE
+from export import write_svg, write_pdf, write_image
+from profiling import Profiler, stage
+
+# seconds taken by the imports above
+IMPORT_SECONDS = time.perf_counter() - STARTUP_START
 
 GROUP_BOX_STYLESHEET = """
                    QGroupBox {
@@ -38,6 +50,18 @@ DOCUMENTATION_PATH = Path("doc/Speckle_Pattern_Generator_Documentation.pdf")
 DEFAULT_SAVE_IMAGE_PATH = Path("mySpeckle_Patterns")
 DEFAULT_SAVE_PARAMS_PATH = Path("mySpeckle_Parameters")
 SOURCE_CODE_URL = "https://github.com/rodrigoparri/Speckle_Pattern_Generator.git"
+# time in ms the live preview waits for the parameters to stop changing
+PREVIEW_DEBOUNCE_MS = 150
+# time in ms the quality map waits for the subset size to stop changing
+QUALITY_DEBOUNCE_MS = 150
+# smallest speckle diameter in pixels of the live preview, so pixel rounding doesn't change the look of the pattern
+PREVIEW_MIN_DIAMETER_PX = 3
+# largest live preview in pixels
+PREVIEW_MAX_PIXELS = 2 ** 20
+# about the most speckles drawn by a live preview, larger plates are previewed by a patch of them
+PREVIEW_MAX_SPECKLES = 2 ** 14
+# the same for Poisson-disk placement, which takes about 20 us per speckle against well under 1 us on the grid
+PREVIEW_MAX_POISSON_SPECKLES = 2 ** 10
 
 def resource_path(relative_path: Path) -> Path:
     """
@@ -61,48 +85,125 @@ class ImageWidget(QWidget):
         super().__init__()
         self.layout = QVBoxLayout()
         self.layout.setContentsMargins(1, 1, 1, 1)
-        self.render_window = QLabel()
+        self.render_window = PatternViewer()
         self.render_window.setFixedSize(self.window_side, self.window_side)
-        self.render_window.setAlignment(Qt.AlignmentFlag.AlignBottom)
-        self.render_window.setToolTip("Your image is scaled to fully fill the render window to ensure the pattern is clearly visible")
+        self.render_window.setToolTip("""Your image is scaled to fully fill the render window to ensure the pattern is
+         clearly visible. Scroll to zoom, drag to pan and double click to fit the image back""")
         #self.render_window.setStyleSheet("background-color: white")
         self.render_window.setFrameStyle(1)
         self.render_window.setLineWidth(1)
-        # initialize qimage with default values in image_speckle
-        self.qimage = self.numpy_to_image(array)
-        self.update_pixmap()
+        # subset quality overlay and the rectangle it covers in image pixels
+        self.overlay = None
+        self.overlay_rect = None
+        # empty until the first pattern is generated
+        self.set_image(array)
 
         self.layout.addWidget(self.render_window)
         self.setLayout(self.layout)
 
     @staticmethod
     def numpy_to_image(array: np.ndarray):
-        if array.ndim == 2:
+        """
+        Wraps an array in a QImage that shares its buffer, so no pixels are copied. The QImage doesn't own the buffer,
+        so the array must be kept alive and unchanged as long as the image is used
+        :param array: PackedPattern or 2D uint8 array whose rows are contiguous
+        :return: QImage
+        """
+        if isinstance(array, PackedPattern):
+            # 1 bit per pixel, set bits are speckles
+            height, width = array.shape
+            qimage = QImage(array.bits.data, width, height, array.bytes_per_line, QImage.Format.Format_Mono)
+            qimage.setColorTable([qRgb(255, 255, 255), qRgb(0, 0, 0)])
+        elif array.ndim == 2 and array.dtype == np.uint8 and array.strides[1] == 1:
             height, width = array.shape
-            qimage = QImage(array.data, width, height, width, QImage.Format.Format_Grayscale8)
+            qimage = QImage(array.data, width, height, array.strides[0], QImage.Format.Format_Grayscale8)
         else:
-            raise ValueError("Unsupported array type: expected 2D grayscale")
-        return qimage.copy()
+            raise ValueError("Unsupported array type: expected 2D grayscale or PackedPattern")
+        return qimage
 
     def set_image(self, new_array):
         """
-        Creates a new QImage from a new array and stores it in self.qimage. It´s the external interface to set a new image
-        :param new_array:
+        Creates a new QImage sharing the buffer of a new array. It´s the external interface to set a new image, which is
+        shown non-inverted
+        :param new_array: PackedPattern or 2D uint8 array, None for no image
+        :return:
+        """
+        if isinstance(new_array, np.ndarray) and new_array.strides[1] != 1:
+            new_array = np.ascontiguousarray(new_array)
+        # the QImage doesn't own its pixels, so the array is kept alive with it
+        self.array = new_array
+        with stage("numpy_to_image"):
+            self.source_qimage = QImage() if new_array is None else self.numpy_to_image(new_array)
+        self.is_inverted = False
+        # inverted copy of grayscale images, made the first time they are inverted
+        self.inverted_qimage = None
+        with stage("viewer"):
+            self.render_window.set_pattern(new_array)
+
+    @property
+    def qimage(self):
+        """
+        Image as shown, inverted or not
+        """
+        if self.is_inverted and self.inverted_qimage is not None:
+            return self.inverted_qimage
+        return self.source_qimage
+
+    def set_inverted(self, inverted: bool):
+        """
+        Shows the image inverted or not. 1 bit images are inverted by swapping their color table, grayscale ones through
+        a copy made the first time they are inverted, so the pattern itself is never modified
+        :param inverted: True to show speckles white on black
+        :return:
+        """
+        if inverted == self.is_inverted or self.array is None:
+            return
+        self.is_inverted = inverted
+        if self.source_qimage.format() == QImage.Format.Format_Mono:
+            self.source_qimage.setColorTable(self.source_qimage.colorTable()[::-1])
+        elif inverted and self.inverted_qimage is None:
+            self.inverted_qimage = self.source_qimage.copy()
+            self.inverted_qimage.invertPixels()
+        self.render_window.set_inverted(inverted)
+
+    @staticmethod
+    def quality_to_overlay(quality_map: np.ndarray):
+        """
+        Creates a translucent red image that is more opaque where the quality is lower, relative to the best subset.
+        """
+        best = quality_map.max()
+        normalized = quality_map / best if best > 0 else np.zeros_like(quality_map)
+        rgba = np.zeros(quality_map.shape + (4,), dtype=np.uint8)
+        rgba[..., 0] = 255
+        rgba[..., 3] = np.round(180 * (1 - normalized)).astype(np.uint8)
+        height, width = quality_map.shape
+        return QImage(rgba.data, width, height, 4 * width, QImage.Format.Format_RGBA8888).copy()
+
+    def set_overlay(self, quality_map: np.ndarray, rows: np.ndarray, cols: np.ndarray, subset_size: int, step: int):
+        """
+        Shows a subset quality map over the image. Each map cell is drawn as a step x step square centred in its subset
+        :param quality_map: map returned by subset_quality_maps
+        :param rows: first pixel row of the subsets
+        :param cols: first pixel column of the subsets
+        :param subset_size: subset side length in pixels
+        :param step: separation between consecutive subsets in pixels
         :return:
         """
-        self.qimage = self.numpy_to_image(new_array)
-        self.update_pixmap()
+        self.overlay = self.quality_to_overlay(quality_map)
+        offset = (subset_size - step) / 2
+        self.overlay_rect = QRectF(cols[0] + offset, rows[0] + offset, cols.size * step, rows.size * step)
+        self.render_window.set_overlay(self.overlay, self.overlay_rect)
 
-    def update_pixmap(self):
-        if self.qimage:
-            scaled_pixmap = QPixmap.fromImage(self.qimage).scaled(
-                self.render_window.width(), self.render_window.height(),
-                aspectMode=Qt.AspectRatioMode.KeepAspectRatioByExpanding, mode=Qt.TransformationMode.FastTransformation
-            )
-            self.render_window.setPixmap(scaled_pixmap)
+    def clear_overlay(self):
+        self.overlay = None
+        self.overlay_rect = None
+        self.render_window.clear_overlay()
 
 class ParameterWidget(QWidget):
 
+    # emitted whenever any parameter spinbox changes
+    values_changed = Signal()
+
     def __init__(self):
         super().__init__()
         self.main_layout = QVBoxLayout()
@@ -110,7 +211,7 @@ class ParameterWidget(QWidget):
         self.main_layout.setContentsMargins(1, 15, 1, 10)
 
         self.data_box = QGroupBox("Parameters")
-        self.data_box.setMaximumHeight(250)
+        self.data_box.setMaximumHeight(340)
         self.data_box.setStyleSheet(GROUP_BOX_STYLESHEET)
 
         self.generate_box = QGroupBox("Generate")
@@ -126,7 +227,8 @@ class ParameterWidget(QWidget):
             "min_diameter" : 60,
             "dpi" : 300,
             "grid_step" : 1,
-            "rand_pos" : 25
+            "rand_pos" : 25,
+            "placement" : "grid"
         }
         #(min value, max value)
         min_max_height = (10, 250)
@@ -176,6 +278,26 @@ class ParameterWidget(QWidget):
         self.rand_position_widget.setRange(min_max_pos_rand[0], min_max_pos_rand[1])
         self.rand_position_widget.setValue(self.default_values["rand_pos"])
         self.rand_position_widget.setToolTip(f"Random position radius as % of maximum diameter, Min: {min_max_pos_rand[0]}, Max: {min_max_pos_rand[1]}")
+        # placement parameter, the item data is the value passed to the generators
+        self.placement_widget = QComboBox()
+        self.placement_widget.addItem("Jittered grid", "grid")
+        self.placement_widget.addItem("Poisson disk", "poisson")
+        self.placement_widget.setToolTip("""Jittered grid moves every speckle randomly around a grid node. Poisson disk
+         places speckles at random keeping them at least grid step times their mean diameter apart, without clusters
+         or holes. Position randomness is not used""")
+        self.placement_widget.currentIndexChanged.connect(self.update_placement)
+        # candidate search, not a parameter of the pattern so it isn't saved with them
+        self.candidates_widget = QSpinBox()
+        self.candidates_widget.setRange(1, 256)
+        self.candidates_widget.setValue(1)
+        self.candidates_widget.setToolTip("""Number of random patterns generated in parallel on Create Pattern. Only
+         the best one by the score below is kept""")
+        self.score_widget = QComboBox()
+        self.score_widget.addItem("Highest MIG", "MIG")
+        self.score_widget.addItem("Density closest to 50 %", "density_error")
+        self.score_widget.addItem("Best worst subset SSSIG", "subset_sssig")
+        self.score_widget.setToolTip("""Score the candidates are ranked by. The subset SSSIG uses the subset size of
+         the quality map""")
         # regenerate button
         self.regen_widget = QPushButton("Create Pattern ▶")
         self.regen_widget.setFixedSize(120,30)
@@ -185,6 +307,10 @@ class ParameterWidget(QWidget):
         #Load defaults button
         self.defaults_button = QPushButton("Set defaults")
         self.defaults_button.setFixedSize(100, 30)
+        # live preview toggle
+        self.live_preview_widget = QCheckBox()
+        self.live_preview_widget.setToolTip("""Updates a low resolution preview of the pattern while the parameters
+         are edited. The full resolution pattern is generated on Create Pattern, save or print""")
 
         self.layout.addRow(f" Height (mm) [{min_max_height[0]}-{min_max_height[1]}]", self.height_widget)
         self.layout.addRow(f" Width (mm) [{min_max_width[0]}-{min_max_width[1]}]", self.width_widget)
@@ -193,6 +319,14 @@ class ParameterWidget(QWidget):
         self.layout.addRow(f" Resolution (dpi) [{min_max_dpi[0]}-{min_max_dpi[1]}]", self.dpi_widget)
         self.layout.addRow(f" Grid step (times diameter) [{min_max_grid_step[0]}-{min_max_grid_step[1]}]", self.grid_step_widget)
         self.layout.addRow(f" Position randomness (%) [{min_max_pos_rand[0]}-{min_max_pos_rand[1]}]", self.rand_position_widget)
+        self.layout.addRow(" Placement", self.placement_widget)
+        self.layout.addRow(" Candidates", self.candidates_widget)
+        self.layout.addRow(" Keep best by", self.score_widget)
+        self.layout.addRow(" Live preview", self.live_preview_widget)
+
+        for widget in (self.height_widget, self.width_widget, self.diameter_widget, self.min_diameter_widget,
+                       self.dpi_widget, self.grid_step_widget, self.rand_position_widget):
+            widget.valueChanged.connect(lambda value: self.values_changed.emit())
 
         self.generate_layout.addWidget(self.regen_widget)
         self.generate_layout.addWidget(self.defaults_button)
@@ -214,10 +348,19 @@ class ParameterWidget(QWidget):
             "dpi": self.dpi_widget.value(),
             "grid_step": self.grid_step_widget.value(),
             "min_diameter": self.min_diameter_widget.value(),
-            "rand_pos": self.rand_position_widget.value()
+            "rand_pos": self.rand_position_widget.value(),
+            "placement": self.placement_widget.currentData()
         }
         return self.values
 
+    def update_placement(self):
+        # poisson disk placement has no position randomness
+        self.rand_position_widget.setEnabled(self.placement_widget.currentData() != "poisson")
+        self.values_changed.emit()
+
+    def set_placement(self, placement:str):
+        self.placement_widget.setCurrentIndex(self.placement_widget.findData(placement))
+
     def set_default_values(self):
         self.height_widget.setValue(self.default_values["height"])
         self.width_widget.setValue(self.default_values["width"])
@@ -226,6 +369,7 @@ class ParameterWidget(QWidget):
         self.grid_step_widget.setValue(self.default_values["grid_step"])
         self.min_diameter_widget.setValue(self.default_values["min_diameter"])
         self.rand_position_widget.setValue(self.default_values["rand_pos"])
+        self.set_placement(self.default_values["placement"])
 
     def set_values(self, values:dict):
         self.height_widget.setValue(values["height"])
@@ -235,6 +379,8 @@ class ParameterWidget(QWidget):
         self.grid_step_widget.setValue(values["grid_step"])
         self.min_diameter_widget.setValue(values["min_diameter"])
         self.rand_position_widget.setValue(values["rand_pos"])
+        # parameter files saved before the placement option are on the grid
+        self.set_placement(values.get("placement", "grid"))
 
 
 class ResultsWidget(QWidget):
@@ -246,27 +392,53 @@ class ResultsWidget(QWidget):
         self.main_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
         self.main_layout.setContentsMargins(1, 1, 1, 1)
         self.results_box = QGroupBox("Results")
-        self.results_box.setMaximumHeight(150)
+        self.results_box.setMaximumHeight(195)
 
         self.results_layout = QGridLayout()
 
         self.speckle_density_label = QLabel("Speckle Density:")
         self.MIG_label = QLabel("MIG:")
+        self.speckle_size_label = QLabel("Autocorrelation FWHM:")
         self.image_size = QLabel("Image buffer size:")
         self.speckle_density_result_label = QLabel("%")
         self.speckle_density_result_label.setToolTip("Percentage of black pixels over the total pixel amount")
         self.MIG_result_label = QLabel("31")
         self.MIG_result_label.setToolTip("""Mean Intensity Gradient of the image being 0 intensity
          black pixels and 255 intensity white pixels""")
+        self.speckle_size_result_label = QLabel("---------")
+        self.speckle_size_result_label.setToolTip("""Full width at half maximum of the image autocorrelation in mm
+         and the time it took to compute it. About 0.8 times the diameter of isolated speckles and less for speckles
+         that touch, so it is not their mean diameter""")
         self.image_size_result_label = QLabel("---------")
         self.image_size_result_label.setToolTip("""Image buffer size in MB""")
+        self.timings_label = QLabel("Generation time:")
+        self.timings_result_label = QLabel("---------")
 
         self.results_layout.addWidget(self.speckle_density_label, 0, 0)
         self.results_layout.addWidget(self.MIG_label, 1, 0)
-        self.results_layout.addWidget(self.image_size, 2, 0)
+        self.results_layout.addWidget(self.speckle_size_label, 2, 0)
+        self.results_layout.addWidget(self.image_size, 3, 0)
         self.results_layout.addWidget(self.speckle_density_result_label, 0, 1)
         self.results_layout.addWidget(self.MIG_result_label, 1, 1)
-        self.results_layout.addWidget(self.image_size_result_label, 2, 1)
+        self.results_layout.addWidget(self.speckle_size_result_label, 2, 1)
+        self.results_layout.addWidget(self.image_size_result_label, 3, 1)
+        self.results_layout.addWidget(self.timings_label, 5, 0)
+        self.results_layout.addWidget(self.timings_result_label, 5, 1)
+
+        self.quality_label = QLabel("Subset quality map (px):")
+        self.subset_size_widget = QSpinBox()
+        self.subset_size_widget.setRange(5, 501)
+        self.subset_size_widget.setValue(31)
+        self.subset_size_widget.setToolTip("Side length in pixels of the DIC subsets evaluated by the quality map")
+        self.quality_checkbox = QCheckBox("Show")
+        self.quality_checkbox.setToolTip("""Shades in red the subsets with a low SSSIG (sum of square of subset
+         intensity gradients) relative to the best subset of the image""")
+        self.quality_layout = QHBoxLayout()
+        self.quality_layout.setContentsMargins(0, 0, 0, 0)
+        self.quality_layout.addWidget(self.subset_size_widget)
+        self.quality_layout.addWidget(self.quality_checkbox)
+        self.results_layout.addWidget(self.quality_label, 4, 0)
+        self.results_layout.addLayout(self.quality_layout, 4, 1)
 
         self.results_box.setLayout(self.results_layout)
         self.main_layout.addWidget(self.results_box)
@@ -276,12 +448,35 @@ class ResultsWidget(QWidget):
     def set_MIG_result(self, result):
         self.MIG_result_label.setText(f"{result:.3f}")
 
+    def set_speckle_size_result(self, result, seconds):
+        self.speckle_size_result_label.setText(f"{result:.3f} mm ({seconds * 1000:.0f} ms)")
+
     def set_density_result(self, result):
         self.speckle_density_result_label.setText(f"{result:.3f}%")
 
     def set_mem_size_result(self, result):
         self.image_size_result_label.setText(f"{result:,.3f} MB")
 
+    def set_timings_result(self, totals: dict):
+        """
+        Shows the total time of a pattern, with the time of every stage in the tooltip
+        :param totals: seconds by stage name, as returned by Profiler.totals
+        """
+        self.timings_result_label.setText(f"{sum(totals.values()) * 1000:,.0f} ms")
+        self.timings_result_label.setToolTip("\n".join(f"{name}: {seconds * 1000:,.1f} ms" for name, seconds in totals.items()))
+
+    def set_preview_results(self, density_result):
+        """
+        Shows the density of a live preview. The other results depend on the resolution and wait for the full
+        resolution pattern
+        """
+        self.speckle_density_result_label.setText(f"{density_result:.3f}% (preview)")
+        self.MIG_result_label.setText("---------")
+        self.speckle_size_result_label.setText("---------")
+        self.image_size_result_label.setText("---------")
+        self.timings_result_label.setText("---------")
+        self.timings_result_label.setToolTip("")
+
 class SaveWidget(QWidget):
     def __init__(self):
         super().__init__()
@@ -291,15 +486,32 @@ class SaveWidget(QWidget):
         self.main_layout.setContentsMargins(1, 10, 1, 10)
 
         self.save_group = QGroupBox("Save")
-        self.save_layout = QHBoxLayout()
+        self.save_layout = QVBoxLayout()
+        self.buttons_layout = QHBoxLayout()
+        self.options_layout = QHBoxLayout()
 
         self.save_button = QPushButton("Save Image as")
         self.save_params_button = QPushButton("Save Parameters")
         self.print_button = QPushButton("Print")
-
-        self.save_layout.addWidget(self.save_params_button)
-        self.save_layout.addWidget(self.save_button)
-        self.save_layout.addWidget(self.print_button)
+        # PNG and TIFF options
+        self.compression_label = QLabel("Compression")
+        self.compression_widget = QSpinBox()
+        self.compression_widget.setRange(0, 9)
+        self.compression_widget.setValue(6)
+        self.compression_widget.setToolTip("PNG and TIFF compression level, 0 for none and 9 for the smallest files")
+        self.one_bit_widget = QCheckBox("1 bit")
+        self.one_bit_widget.setChecked(True)
+        self.one_bit_widget.setToolTip("Save PNG and TIFF images with 1 bit per pixel instead of 8 bit grayscale")
+
+        self.buttons_layout.addWidget(self.save_params_button)
+        self.buttons_layout.addWidget(self.save_button)
+        self.buttons_layout.addWidget(self.print_button)
+        self.options_layout.addWidget(self.compression_label)
+        self.options_layout.addWidget(self.compression_widget)
+        self.options_layout.addWidget(self.one_bit_widget)
+        self.options_layout.addStretch()
+        self.save_layout.addLayout(self.buttons_layout)
+        self.save_layout.addLayout(self.options_layout)
 
         self.save_group.setLayout(self.save_layout)
 
@@ -308,10 +520,288 @@ class SaveWidget(QWidget):
         self.setLayout(self.main_layout)
 
 
+def generate_pattern(values: dict, speckle_size_max_px: int, progress=None, model: SpeckleModel = None,
+                     candidates: int = 1, score: str = "MIG", subset_size: int = DEFAULT_SUBSET_SIZE,
+                     quality_map: bool = False):
+    """
+    Generates the 1 bit per pixel pattern of a set of parameters and computes its results.
+    :param values: parameters as returned by ParameterWidget.get_values
+    :param speckle_size_max_px: largest side in pixels the speckle size FFT runs on, larger patterns are measured on
+    their centre
+    :param progress: optional callable receiving the fraction done, from 0 to 1. It may raise GenerationCancelled
+    :param model: speckles to rasterize at values["dpi"]. A new random model is drawn if None or if it was drawn with
+    other parameters
+    :param candidates: number of random models scored by best_candidate when a new model is drawn, the best one is kept
+    :param score: score of the candidates, one of CANDIDATE_SCORES
+    :param subset_size: in pixels, subset side length of the subset_sssig score and of the quality map
+    :param quality_map: compute the subset quality overlay of the pattern too, so it isn't computed in the GUI thread
+    :return: dictionary with the values, the model, the pattern, MIG, density, speckle size in mm, the seconds the
+    speckle size took, the candidate search, None if there was none, the quality overlay, None if not computed, and
+    the Profiler holding the time of every stage
+    """
+    report = progress if progress is not None else (lambda fraction: None)
+    profiler = Profiler()
+    with profiler:
+        result = _generate_pattern(values, speckle_size_max_px, report, model, candidates, score, subset_size,
+                                   quality_map)
+    result["profile"] = profiler
+    return result
+
+def _generate_pattern(values: dict, speckle_size_max_px: int, report, model: SpeckleModel, candidates: int,
+                      score: str, subset_size: int, quality_map: bool):
+    search = None
+    if (model is None or not model.matches(values)) and candidates > 1:
+        # the search takes the first half of the progress bar
+        with stage("candidates"):
+            search = best_candidate(values, candidates, score, subset_size=subset_size,
+                                    progress=lambda fraction: report(0.5 * fraction))
+        model = search.pop("model")
+        search.update({"candidates": candidates, "score_name": score})
+        search_report = report
+        report = lambda fraction: search_report(0.5 + 0.5 * fraction)
+    elif model is None or not model.matches(values):
+        with stage("model"):
+            model = SpeckleModel.from_values(values, progress=lambda fraction: report(0.5 * fraction))
+        if model.parameters["placement"] == "poisson":
+            # Poisson-disk placement took the first half of the progress bar
+            model_report = report
+            report = lambda fraction: model_report(0.5 + 0.5 * fraction)
+    # stamping is most of the work
+    pattern = model.rasterize(values["dpi"], packed=True, progress=lambda fraction: report(0.8 * fraction))
+    # density and MIG in a single pass, unpacking the pattern to grayscale a band of rows at a time
+    metrics = stream_metrics(pattern)
+    report(0.9)
+    # the FFT is run on the centre of large patterns, downsampled if their speckles are large
+    downsample = speckle_size_downsample(values["diameter"] * values["min_diameter"] / 100 * values["dpi"] / 25.4)
+    start = time.perf_counter()
+    speckle_size_mm = speckle_size(pattern, downsample=downsample, max_px=speckle_size_max_px) * 25.4 / values["dpi"]
+    speckle_size_seconds = time.perf_counter() - start
+    quality = None
+    if quality_map:
+        with stage("quality_map"):
+            quality = compute_quality(pattern, subset_size)
+    report(1)
+    return {
+        "values": values,
+        "model": model,
+        "pattern": pattern,
+        "MIG": metrics["MIG"],
+        "density": metrics["density"],
+        "speckle_size": speckle_size_mm,
+        "speckle_size_seconds": speckle_size_seconds,
+        "search": search,
+        "quality": quality
+    }
+
+def compute_quality(pattern, subset_size: int, tables: SubsetQualityTables = None):
+    """
+    Subset quality overlay of a pattern, about one subset per screen pixel of the render window. The summed-area
+    tables hold about two rows and columns per screen pixel, so they take a few MB whatever the size of the pattern,
+    and are returned so the overlay of another subset size is read from them without going through the pattern again.
+    Subset sizes are rounded to the spacing of the tables.
+    :param pattern: full resolution pattern
+    :param subset_size: subset side length in pixels of the full resolution pattern
+    :param tables: tables of the pattern returned by an earlier call, built if None
+    :return: dictionary with the subset size asked for, the tables and the overlay: the SSSIG map, the first pixel
+    of the subset rows and columns, the subset size and the step between subsets. The overlay is None if the subset
+    is larger than the pattern
+    """
+    if tables is None:
+        spacing = max(1, -(-max(pattern.shape) // (2 * ImageWidget.window_side)))
+        tables = SubsetQualityTables(pattern, spacing)
+    step = max(1, max(pattern.shape) // ImageWidget.window_side)
+    try:
+        maps = tables.maps(subset_size, step)
+        overlay = {key: maps[key] for key in ("sssig", "rows", "cols", "subset_size", "step")}
+    except ValueError:
+        overlay = None
+    return {"subset_size": subset_size, "tables": tables, "overlay": overlay}
+
+def preview_values(values: dict, side_px: int):
+    """
+    Parameters of a live preview about side_px pixels across its shorter side. The preview draws the speckle model of
+    the same parameters as the full pattern, whose sizes and positions are in mm, so only the resolution changes and
+    the speckles keep the diameters, spacing and jitter of the full pattern. The resolution never leaves less than
+    PREVIEW_MIN_DIAMETER_PX pixels per minimum diameter, unless the full pattern has less, and previews over
+    PREVIEW_MAX_PIXELS pixels or about PREVIEW_MAX_SPECKLES speckles, PREVIEW_MAX_POISSON_SPECKLES with Poisson-disk
+    placement, show a patch of the plate instead.
+    :param values: parameters as returned by ParameterWidget.get_values
+    :param side_px: target length in pixels of the shorter side of the preview
+    :return: parameters of the preview, with the width and height of the patch and a resolution never above
+    values["dpi"]
+    """
+    # in pixels per mm
+    resolution = side_px / min(values["width"], values["height"])
+    min_diameter = values["diameter"] * values["min_diameter"] / 100
+    resolution = min(values["dpi"] / 25.4, max(resolution, PREVIEW_MIN_DIAMETER_PX / min_diameter))
+    area = values["width"] * values["height"]
+    # speckles of the mean diameter as far apart as the grid step asks
+    mean_diameter = values["diameter"] * (1 + values["min_diameter"] / 100) / 2
+    distance = values["grid_step"] * mean_diameter
+    max_speckles = PREVIEW_MAX_SPECKLES
+    if values.get("placement", "grid") == "poisson":
+        # small speckles fill the gaps between the others, so Poisson-disk speckles are about as many as those of
+        # the mean diameter kept as far from one of the minimum diameter
+        distance = values["grid_step"] * (mean_diameter + min_diameter) / 2
+        max_speckles = PREVIEW_MAX_POISSON_SPECKLES
+    scale = min(1, math.sqrt(PREVIEW_MAX_PIXELS / (area * resolution ** 2)),
+                math.sqrt(max_speckles * distance ** 2 / area))
+    preview = dict(values)
+    preview["width"] = values["width"] * scale
+    preview["height"] = values["height"] * scale
+    preview["dpi"] = resolution * 25.4
+    return preview
+
+def generate_preview(values: dict, side_px: int, progress=None):
+    """
+    Generates a quick grayscale preview of a set of parameters. Previews below the full resolution are anti-aliased
+    so speckles only a few pixels wide keep their area, the ones at the full resolution are drawn as the full pattern.
+    :param values: parameters as returned by ParameterWidget.get_values
+    :param side_px: target length in pixels of the shorter side of the preview
+    :param progress: optional callable receiving the fraction done. It may raise GenerationCancelled to abort
+    :return: dictionary with the values, the preview pattern, its resolution in dpi, the size in mm of the patch it
+    shows and its density
+    """
+    preview = preview_values(values, side_px)
+    report = progress or (lambda fraction: None)
+    # Poisson-disk placement takes the first half of the progress, the grid is drawn at once
+    model = SpeckleModel.from_values(preview, progress=lambda fraction: report(0.5 * fraction))
+    pattern = model.rasterize(preview["dpi"], antialias=preview["dpi"] < values["dpi"],
+                              progress=lambda fraction: report(0.5 + 0.5 * fraction))
+    return {
+        "values": values,
+        "pattern": pattern,
+        "dpi": preview["dpi"],
+        "patch": (preview["width"], preview["height"]),
+        "density": density(pattern)
+    }
+
+class GenerationSignals(QObject):
+    progress = Signal(int)
+    finished = Signal(object)
+    failed = Signal(str)
+
+class GenerationWorker(QRunnable):
+    """
+    Runs generate_pattern in the thread pool. After cancel() the next progress report aborts the generation and
+    nothing is emitted.
+    """
+
+    def __init__(self, values: dict, speckle_size_max_px: int, model: SpeckleModel = None, options: dict = None):
+        """
+        :param options: candidates, score, subset_size and quality_map arguments of generate_pattern
+        """
+        super().__init__()
+        self.values = values
+        self.speckle_size_max_px = speckle_size_max_px
+        self.model = model
+        self.options = options or {}
+        self.signals = GenerationSignals()
+        self.is_cancelled = False
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def report_progress(self, fraction):
+        if self.is_cancelled:
+            raise GenerationCancelled()
+        self.signals.progress.emit(int(fraction * 100))
+
+    def run(self):
+        try:
+            result = generate_pattern(self.values, self.speckle_size_max_px, self.report_progress, self.model,
+                                      **self.options)
+        except GenerationCancelled:
+            return
+        except Exception as error:
+            self.signals.failed.emit(str(error))
+            return
+        if not self.is_cancelled:
+            self.signals.finished.emit(result)
+
+class PreviewWorker(QRunnable):
+    """
+    Runs generate_preview in the thread pool. After cancel() the next progress report aborts the preview and nothing
+    is emitted.
+    """
+
+    def __init__(self, values: dict, side_px: int):
+        super().__init__()
+        self.values = values
+        self.side_px = side_px
+        self.signals = GenerationSignals()
+        self.is_cancelled = False
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def report_progress(self, fraction):
+        if self.is_cancelled:
+            raise GenerationCancelled()
+
+    def run(self):
+        try:
+            result = generate_preview(self.values, self.side_px, self.report_progress)
+        except GenerationCancelled:
+            return
+        except Exception as error:
+            self.signals.failed.emit(str(error))
+            return
+        if not self.is_cancelled:
+            self.signals.finished.emit(result)
+
+class QualityWorker(QRunnable):
+    """
+    Runs compute_quality in the thread pool.
+    """
+
+    def __init__(self, pattern, subset_size: int, tables: SubsetQualityTables = None):
+        super().__init__()
+        self.pattern = pattern
+        self.subset_size = subset_size
+        self.tables = tables
+        self.signals = GenerationSignals()
+
+    def run(self):
+        try:
+            quality = compute_quality(self.pattern, self.subset_size, self.tables)
+        except Exception as error:
+            self.signals.failed.emit(str(error))
+            return
+        self.signals.finished.emit(quality)
+
+class ExportWorker(QRunnable):
+    """
+    Writes a PNG or TIFF image with write_image in the thread pool, so large patterns are saved without blocking the
+    window.
+    """
+
+    def __init__(self, path: str, array, dpi: float, compression: int, bit_depth: int):
+        super().__init__()
+        self.path = path
+        self.array = array
+        self.dpi = dpi
+        self.compression = compression
+        self.bit_depth = bit_depth
+        self.signals = GenerationSignals()
+
+    def run(self):
+        try:
+            write_image(self.path, self.array, self.dpi, self.compression, self.bit_depth,
+                        progress=lambda fraction: self.signals.progress.emit(int(fraction * 100)))
+        except Exception as error:
+            self.signals.failed.emit(str(error))
+            return
+        self.signals.finished.emit(self.path)
+
 class MainWindow(QMainWindow):
 
+    # largest side in pixels the speckle size FFT runs on, larger patterns are measured on their centre
+    speckle_size_max_px = 2048
+
     def __init__(self):
         super().__init__()
+        window_start = time.perf_counter()
         #print(Path(__file__))
         #print(resource_path(WINDOW_LOGO_PATH))
         self.setWindowTitle("Speckle Pattern Generator - Windows - v.1.0")
@@ -323,6 +813,7 @@ class MainWindow(QMainWindow):
         self.save_params_action = self.file_menu.addAction("Save parameters")
         self.load_params_action = self.file_menu.addAction("Load parameters")
         self.print_action = self.file_menu.addAction("Print")
+        self.export_trace_action = self.file_menu.addAction("Export timing trace")
         self.documentation_action = self.menu_bar.addAction("Documentation")
         self.go_to_source_repo_action = self.menu_bar.addAction("Source code")
 
@@ -335,30 +826,48 @@ class MainWindow(QMainWindow):
         self.save = SaveWidget()
         self.author = QLabel("Author: Rodrigo Parrilla Mesas 2025. License: Creative Commons Attribution 4.0 International Public License.")
 
+        # generation running in the thread pool, if any, and the save or print waiting for it, with whether the
+        # pattern is to be inverted
+        self.worker = None
+        self.pending_action = None
+        self.pending_inverted = False
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setFixedWidth(200)
+        self.progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        # image being saved in the thread pool, if any
+        self.export_worker = None
+        self.export_progress_bar = QProgressBar()
+        self.export_progress_bar.setRange(0, 100)
+        self.export_progress_bar.setFixedWidth(200)
+        self.export_progress_bar.setFormat("Saving %p%")
+        self.export_progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.export_progress_bar)
+
+        # live preview shown instead of the full resolution pattern, if any, and the one being generated
+        self.preview = None
+        self.preview_worker = None
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DEBOUNCE_MS)
+        # summed-area tables of the quality overlay of the pattern shown, and the overlay being computed, if any
+        self.quality_tables = None
+        self.quality_worker = None
+        self.quality_timer = QTimer(self)
+        self.quality_timer.setSingleShot(True)
+        self.quality_timer.setInterval(QUALITY_DEBOUNCE_MS)
+
+        # the first pattern is generated in the background once the window is shown
+        self.image = ImageWidget(None)
         self.values = self.gather_values()
-        self.array = image_speckle(
-                self.values["width"],
-                self.values["height"],
-                self.values["diameter"],
-                self.values["dpi"],
-                self.values["grid_step"],
-                self.values["min_diameter"],
-                self.values["rand_pos"]
-            )
-        self.dots_per_meter = self.values["dpi"] * 1000 / 25.4
-        self.image_mem_size = self.array.shape[0] * self.array.shape[1] * 8 * 1E-6
-        self.results.set_mem_size_result(self.image_mem_size)
-
-        self.inverted_array = ~self.array
-
-        self.mig = MIG(self.array)
-        self.update_MIG()
-
-        self.density = density(self.array)
-        self.update_density()
-
-       #Create first image with defaults
-        self.image = ImageWidget(self.array)
+        self.pattern = None
+        # speckles of the pattern shown and the resolution they were rasterized at, None for a loaded model not
+        # rasterized yet
+        self.model = None
+        self.model_dpi = None
+        # stage timings of the last full resolution pattern
+        self.profile = None
         # Flag storing whether the image is inverted. False by default
         self.is_inverted = False
 
@@ -370,7 +879,7 @@ class MainWindow(QMainWindow):
 
         self.wire_connections()
         self.setCentralWidget(self.main_widget)
-        self.setFixedSize(900, 600)
+        self.setFixedSize(900, 630)
         self.show()
         #center screen
         screen = QApplication.primaryScreen().availableGeometry()
@@ -379,10 +888,22 @@ class MainWindow(QMainWindow):
         move_y = (screen.height() - app_window.height()) // 2
         self.move(move_x, move_y)
 
+        # seconds taken by the imports and the window, the first pattern is timed from here
+        self.window_shown = time.perf_counter()
+        self.startup_times = {"import": IMPORT_SECONDS, "window": self.window_shown - window_start}
+        #Create first image with defaults
+        QTimer.singleShot(0, self.update_image)
+
     def wire_connections(self):
         self.parameters.regen_widget.clicked.connect(self.update_image)
         self.parameters.invert_widget.clicked.connect(self.invert_image)
         self.parameters.defaults_button.clicked.connect(self.parameters.set_default_values)
+        self.parameters.values_changed.connect(self.schedule_preview)
+        self.parameters.live_preview_widget.toggled.connect(self.schedule_preview)
+        self.preview_timer.timeout.connect(self.update_preview)
+        self.results.quality_checkbox.toggled.connect(self.update_quality_map)
+        self.results.subset_size_widget.valueChanged.connect(self.quality_timer.start)
+        self.quality_timer.timeout.connect(self.update_quality_map)
 
         self.save.save_params_button.clicked.connect(self.save_parameters)
         self.save.save_button.clicked.connect(self.save_file)
@@ -391,6 +912,7 @@ class MainWindow(QMainWindow):
         self.save_params_action.triggered.connect(self.save_parameters)
         self.save_as_action.triggered.connect(self.save_file)
         self.load_params_action.triggered.connect(self.load_parameters)
+        self.export_trace_action.triggered.connect(self.export_trace)
         self.documentation_action.triggered.connect(self.show_documentation)
         self.go_to_source_repo_action.triggered.connect(self.show_source_repo)
 
@@ -398,54 +920,309 @@ class MainWindow(QMainWindow):
         values = self.parameters.get_values()
         return values
 
-    def update_array(self):
-        self.values  = self.gather_values()
-        # create array
-        self.array = image_speckle(
-            self.values["width"],
-            self.values["height"],
-            self.values["diameter"],
-            self.values["dpi"],
-            self.values["grid_step"],
-            self.values["min_diameter"],
-            self.values["rand_pos"]
-        )
-        self.inverted_array = ~self.array
+    def generation_options(self):
+        """
+        Candidate search and quality map arguments of generate_pattern. Subsets are those of the quality map
+        """
+        return {"candidates": self.parameters.candidates_widget.value(),
+                "score": self.parameters.score_widget.currentData(),
+                "subset_size": self.results.subset_size_widget.value(),
+                "quality_map": self.results.quality_checkbox.isChecked()}
+
+    def reusable_model(self, values: dict):
+        """
+        Model of the current pattern if values only change its resolution, so the same speckles are rasterized again
+        instead of drawing a new pattern. A loaded model is always reused.
+        """
+        if self.model is None or not self.model.matches(values) or values["dpi"] == self.model_dpi:
+            return None
+        return self.model
 
     def update_image(self):
-        self.update_array()
-        self.update_MIG()
-        self.update_density()
+        """
+        Starts generating a pattern with the current parameters in the background, cancelling any generation still
+        running. The image and results are updated when it finishes.
+        """
+        self.preview_timer.stop()
+        self.cancel_preview()
+        if self.worker is not None:
+            self.worker.cancel()
+        values = self.gather_values()
+        worker = GenerationWorker(values, self.speckle_size_max_px, self.reusable_model(values), self.generation_options())
+        worker.signals.progress.connect(self.progress_bar.setValue)
+        worker.signals.finished.connect(lambda result, worker=worker: self.generation_finished(worker, result))
+        worker.signals.failed.connect(lambda message, worker=worker: self.generation_failed(worker, message))
+        self.worker = worker
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.statusBar().showMessage("Generating pattern...")
+        QThreadPool.globalInstance().start(worker)
+
+    def generation_finished(self, worker, result):
+        # results of a cancelled generation may still be queued
+        if worker is not self.worker:
+            return
+        self.worker = None
+        self.progress_bar.hide()
+        self.statusBar().clearMessage()
+        self.apply_result(result)
+        action, self.pending_action = self.pending_action, None
+        if action is not None:
+            if self.pending_inverted:
+                self.invert_image()
+            action()
+
+    def generation_failed(self, worker, message):
+        if worker is not self.worker:
+            return
+        self.worker = None
+        self.pending_action = None
+        self.progress_bar.hide()
+        self.statusBar().showMessage(f"Pattern generation failed: {message}")
+
+    def schedule_preview(self):
+        """
+        Restarts the live preview countdown, so the preview is generated once the parameters stop changing
+        """
+        if self.parameters.live_preview_widget.isChecked():
+            self.preview_timer.start()
+
+    def cancel_preview(self):
+        if self.preview_worker is not None:
+            self.preview_worker.cancel()
+            self.preview_worker = None
+
+    def update_preview(self):
+        """
+        Starts generating a low resolution preview of the current parameters in the background, cancelling any
+        preview still running. Any full resolution generation still running is for outdated parameters and is
+        cancelled too.
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+            self.progress_bar.hide()
+        # a save or print waiting for the full resolution pattern is for outdated parameters
+        self.pending_action = None
+        self.cancel_preview()
+        worker = PreviewWorker(self.gather_values(), ImageWidget.window_side)
+        worker.signals.finished.connect(lambda result, worker=worker: self.preview_finished(worker, result))
+        worker.signals.failed.connect(lambda message, worker=worker: self.preview_failed(worker, message))
+        self.preview_worker = worker
+        QThreadPool.globalInstance().start(worker)
+
+    def preview_failed(self, worker, message):
+        if worker is not self.preview_worker:
+            return
+        self.preview_worker = None
+        self.statusBar().showMessage(f"Preview failed: {message}")
+
+    def preview_finished(self, worker, result):
+        """
+        Shows a preview returned by generate_preview, unless it is outdated
+        """
+        if worker is not self.preview_worker:
+            return
+        self.preview_worker = None
+        self.values = result["values"]
+        self.preview = result["pattern"]
+        self.is_inverted = False
+        self.results.set_preview_results(result["density"])
+        self.image.clear_overlay()
+        self.image.set_image(self.preview)
+        patch_width, patch_height = result["patch"]
+        if (patch_width, patch_height) == (self.values["width"], self.values["height"]):
+            shown = f"Preview at {result['dpi']:.0f} dpi"
+        else:
+            shown = f"Preview of a {patch_width:.0f} x {patch_height:.0f} mm patch at {result['dpi']:.0f} dpi"
+        self.statusBar().showMessage(f"{shown}. The full resolution pattern is generated on Create Pattern, save or "
+                                     f"print")
+
+    def ensure_full_resolution(self, action):
+        """
+        Calls action once the full resolution pattern is shown. If the live preview is shown instead, the pattern is
+        generated in the background first, keeping whether it is inverted, and a generation already running is waited
+        for rather than restarted.
+        :param action: callable saving or printing the pattern
+        """
+        if self.worker is None and self.preview is None and self.pattern is not None:
+            action()
+            return
+        if self.pending_action is None:
+            self.pending_inverted = self.is_inverted
+        self.pending_action = action
+        if self.worker is None:
+            self.update_image()
+        self.statusBar().showMessage("Generating the full resolution pattern before saving or printing...")
+
+    def apply_result(self, result):
+        """
+        Shows a pattern returned by generate_pattern and its results. The regenerated image is a non-inverse one
+        """
+        self.values = result["values"]
+        self.dots_per_meter = self.values["dpi"] * 1000 / 25.4
+        self.model = result["model"]
+        self.model_dpi = self.values["dpi"]
+        self.pattern = result["pattern"]
+        self.mig = result["MIG"]
+        self.density = result["density"]
+        self.speckle_size_mm = result["speckle_size"]
+        self.preview = None
+        self.results.set_MIG_result(self.mig)
+        self.results.set_density_result(self.density)
+        self.results.set_speckle_size_result(self.speckle_size_mm, result["speckle_size_seconds"])
         self.update_image_size()
-        self.image.set_image(self.array)
+        self.is_inverted = False
+        self.profile = result["profile"]
+        # display stages are added to the generation ones
+        with self.profile:
+            self.image.set_image(self.pattern)
+            self.image.render_window.viewport().repaint()
+        self.results.set_timings_result(self.profile.totals())
+        # overlays still being computed are for the previous pattern
+        self.quality_worker = None
+        quality = result.get("quality")
+        self.quality_tables = None if quality is None else quality["tables"]
+        if quality is not None and quality["subset_size"] == self.results.subset_size_widget.value():
+            self.show_quality(quality["overlay"])
+        else:
+            self.update_quality_map()
+        search = result.get("search")
+        if search is not None:
+            self.statusBar().showMessage(f"Best of {search['candidates']} candidates by {search['score_name']}: "
+                                         f"seed {search['seed']}, score {search['score']:.4g}")
+        if "first_pattern" not in self.startup_times:
+            self.startup_times["first_pattern"] = time.perf_counter() - self.window_shown
+            self.startup_times["total"] = time.perf_counter() - STARTUP_START
+            self.report_startup()
+
+    def report_startup(self):
+        """
+        Shows how long the imports, the window and the first pattern took. Started with --startup-report the times are
+        also printed as JSON, so startup regressions can be tracked from scripts
+        """
+        times = self.startup_times
+        self.statusBar().showMessage(f"Started in {times['total']:.2f} s: imports {times['import']:.2f} s, "
+                                     f"window {times['window']:.2f} s, first pattern {times['first_pattern']:.2f} s",
+                                     10000)
+        if "--startup-report" in sys.argv:
+            print(json.dumps(times), flush=True)
 
     def invert_image(self):
         self.is_inverted = not self.is_inverted
-        if self.is_inverted:
-            self.image.set_image(self.inverted_array)
-        else:
-            self.image.set_image(self.array)
+        self.image.set_inverted(self.is_inverted)
 
-    def update_MIG(self):
-        self.mig = MIG(self.array)
-        self.results.set_MIG_result(self.mig)
+    def update_quality_map(self):
+        """
+        Starts computing the quality overlay of the current subset size in the background. The summed-area tables of
+        the pattern are built the first time and reused for every other subset size
+        """
+        # subset sizes are in pixels of the full resolution pattern
+        if not self.results.quality_checkbox.isChecked() or self.preview is not None or self.pattern is None:
+            self.quality_worker = None
+            self.image.clear_overlay()
+            return
+        worker = QualityWorker(self.pattern, self.results.subset_size_widget.value(), self.quality_tables)
+        worker.signals.finished.connect(lambda quality, worker=worker: self.quality_finished(worker, quality))
+        worker.signals.failed.connect(lambda message, worker=worker: self.quality_failed(worker, message))
+        self.quality_worker = worker
+        QThreadPool.globalInstance().start(worker)
+
+    def quality_finished(self, worker, quality):
+        # overlays of an older subset size or pattern may still be queued
+        if worker is not self.quality_worker or worker.pattern is not self.pattern:
+            return
+        self.quality_worker = None
+        self.quality_tables = quality["tables"]
+        self.show_quality(quality["overlay"])
 
-    def update_density(self):
-        self.density = density(self.array)
-        self.results.set_density_result(self.density)
+    def quality_failed(self, worker, message):
+        if worker is not self.quality_worker:
+            return
+        self.quality_worker = None
+        self.statusBar().showMessage(f"Quality map failed: {message}")
+
+    def show_quality(self, overlay: dict):
+        """
+        Shows an overlay returned by compute_quality, or none if it is None
+        """
+        if overlay is None or not self.results.quality_checkbox.isChecked() or self.preview is not None:
+            self.image.clear_overlay()
+            return
+        self.image.set_overlay(overlay["sssig"], overlay["rows"], overlay["cols"], overlay["subset_size"],
+                               overlay["step"])
 
     def update_image_size(self):
-        self.image_mem_size = self.array.shape[0] * self.array.shape[1] * 8 * 1E-6
+        self.image_mem_size = self.pattern.nbytes * 1E-6
         self.results.set_mem_size_result(self.image_mem_size)
 
     def save_file(self):
         save_path, _ = QFileDialog.getSaveFileName(self,  "Save File", str(resource_path(DEFAULT_SAVE_IMAGE_PATH)),
-        "PNG Image (*.png);;JPEG Image (*.jpg);;BMP Image (*.bmp);; TIFF Image (*.tiff);; All Files (*)"
+        "PNG Image (*.png);;JPEG Image (*.jpg);;BMP Image (*.bmp);; TIFF Image (*.tiff);;"
+        "SVG Vector (*.svg);;PDF Vector (*.pdf);; All Files (*)"
         )
+        if not save_path:
+            return
+        self.ensure_full_resolution(lambda: self.write_file(save_path))
+
+    def write_file(self, save_path: str):
+        """
+        Saves the full resolution pattern, in the format of the suffix of save_path
+        """
+        # vector files hold the speckles as circles, so their size doesn't depend on the resolution
+        suffix = Path(save_path).suffix.lower()
+        if suffix == ".svg":
+            write_svg(save_path, self.model, self.is_inverted)
+            return
+        if suffix == ".pdf":
+            write_pdf(save_path, self.model, self.is_inverted)
+            return
+        if suffix in (".png", ".tif", ".tiff"):
+            self.export_image(save_path)
+            return
         self.image.qimage.setDotsPerMeterX(int(self.dots_per_meter))
         self.image.qimage.setDotsPerMeterY(int(self.dots_per_meter))
         self.image.qimage.save(save_path)
 
+    def export_image(self, save_path: str):
+        """
+        Saves the pattern as PNG or TIFF in the background, streamed a band of rows at a time
+        """
+        if self.export_worker is not None:
+            self.statusBar().showMessage("Wait until the previous image is saved", 5000)
+            return
+        pattern = self.pattern.invert() if self.is_inverted else self.pattern
+        bit_depth = 1 if self.save.one_bit_widget.isChecked() else 8
+        worker = ExportWorker(save_path, pattern, self.values["dpi"], self.save.compression_widget.value(), bit_depth)
+        worker.signals.progress.connect(self.export_progress_bar.setValue)
+        worker.signals.finished.connect(self.export_finished)
+        worker.signals.failed.connect(self.export_failed)
+        self.export_worker = worker
+        self.export_progress_bar.setValue(0)
+        self.export_progress_bar.show()
+        QThreadPool.globalInstance().start(worker)
+
+    def export_finished(self, save_path):
+        self.export_worker = None
+        self.export_progress_bar.hide()
+        self.statusBar().showMessage(f"Saved {save_path}", 5000)
+
+    def export_failed(self, message):
+        self.export_worker = None
+        self.export_progress_bar.hide()
+        self.statusBar().showMessage(f"Saving the image failed: {message}")
+
+    def export_trace(self):
+        """
+        Saves the stage timings of the last pattern as a Chrome trace, which chrome://tracing and Perfetto can open
+        """
+        if self.profile is None:
+            return
+        save_path, _ = QFileDialog.getSaveFileName(self, "Save File", "speckle_trace.json", "JSON file (*.json)")
+        if not save_path:
+            return
+        self.profile.save_trace(save_path)
+
     def save_parameters(self):
         save_path, _ = QFileDialog.getSaveFileName(self, "Save File", str(resource_path(DEFAULT_SAVE_PARAMS_PATH)),
             "JSON file (*.json)"
@@ -456,6 +1233,9 @@ class MainWindow(QMainWindow):
             with open(f"{save_path}", "w", encoding="utf8") as outfile:
                 file = json.dumps(self.values)
                 outfile.write(file)
+            # the speckles are saved next to the parameters, so loading them gives back the same pattern
+            if self.model is not None and self.model.matches(self.values):
+                self.model.save(model_path(save_path))
 
     def load_parameters(self):
         load_path, _ = QFileDialog.getOpenFileName(self, "Load File", "",
@@ -466,10 +1246,20 @@ class MainWindow(QMainWindow):
         else:
             with open(f"{load_path}", "r", encoding="utf8") as infile:
                 self.values = json.load(infile)
-                self.parameters.set_values(self.values)
-                self.update_image()
+            saved_model = model_path(load_path)
+            if saved_model.exists():
+                model = SpeckleModel.load(saved_model)
+                if model.matches(self.values):
+                    self.model = model
+                    self.model_dpi = None
+            self.parameters.set_values(self.values)
+            self.update_image()
 
     def print_preview(self):
+        self.ensure_full_resolution(self.open_print_preview)
+
+    def open_print_preview(self):
+        from PySide6.QtPrintSupport import QPrinter, QPrintPreviewDialog
         printer = QPrinter()
         printer.setOutputFormat(QPrinter.OutputFormat.PdfFormat)
         printer.setPageSize(QPageSize.PageSizeId.A4)
@@ -480,15 +1270,32 @@ class MainWindow(QMainWindow):
 
     def render_to_print(self, printer):
         painter = QPainter(printer)
-        image = self.image.qimage
-        image_width = self.image.qimage.width()
-        image_height = self.image.qimage.height()
         dpi = self.values["dpi"]
         mm_to_px = dpi / 25.4
+        image_width = self.values["width"] * mm_to_px
+        image_height = self.values["height"] * mm_to_px
         left_margin = (210 * mm_to_px - image_width) / 2
         top_margin = (270 * mm_to_px - image_height) / 2
         target_rect = QRectF(left_margin, top_margin, image_width, image_height)
-        painter.drawImage(target_rect, image)
+        # speckles are drawn as circles, so the printer rasterizes them at its own resolution
+        background, foreground = (Qt.GlobalColor.black, Qt.GlobalColor.white) if self.is_inverted else \
+            (Qt.GlobalColor.white, Qt.GlobalColor.black)
+        painter.fillRect(target_rect, background)
+        painter.save()
+        painter.setClipRect(target_rect)
+        speckles = self.model.speckles
+        # a point drawn with a round pen is a circle the width of the pen, so all the speckles of a diameter, to the
+        # micrometre, are drawn with a single call
+        diameters_um, group = np.unique(np.rint(speckles["diameter"] * 1000).astype(np.int64), return_inverse=True)
+        order = np.argsort(group, kind="stable")
+        bounds = np.searchsorted(group[order], np.arange(diameters_um.size + 1))
+        x_px = left_margin + speckles["x"].astype(np.float64) * mm_to_px
+        y_px = top_margin + speckles["y"].astype(np.float64) * mm_to_px
+        for diameter_um, first, last in zip(diameters_um.tolist(), bounds[:-1].tolist(), bounds[1:].tolist()):
+            selected = order[first:last]
+            painter.setPen(QPen(foreground, diameter_um / 1000 * mm_to_px, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap))
+            painter.drawPoints(QPolygonF([QPointF(x, y) for x, y in zip(x_px[selected].tolist(), y_px[selected].tolist())]))
+        painter.restore()
         text_target_rect = QRectF(20 * mm_to_px, 280 * mm_to_px, 100 * mm_to_px, 10 * mm_to_px)
         painter.drawText(text_target_rect,
         f"""Density: {self.density:.3f}%, max diameter: {self.values["diameter"]}mm, dpi: {self.values["dpi"]}, position rand: {self.values["rand_pos"]}%,
@@ -500,6 +1307,7 @@ class MainWindow(QMainWindow):
         os.startfile(os.path.normpath(str(resource_path(DOCUMENTATION_PATH))))
 
     def show_source_repo(self):
+        import webbrowser
         webbrowser.open(SOURCE_CODE_URL)
 
 
@@ -515,10 +1323,15 @@ class MainApp(QApplication):
     def __init__(self, sys_argv):
         super().__init__(sys_argv)
         self.id = 'Speckle_Pattern_Generator_v1.0'  # arbitrary string
-        ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(self.id)
+        # sets the taskbar icon, only needed on Windows
+        if sys.platform == "win32":
+            ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(self.id)
         self.setWindowIcon(QIcon(str(resource_path(WINDOW_LOGO_PATH))))
         self.main_window = MainWindow()
         sys.exit(self.exec())
 
 if __name__ == "__main__":
+    # the candidate search starts worker processes, which frozen Windows builds run through this script
+    import multiprocessing
+    multiprocessing.freeze_support()
     App = MainApp(sys.argv)
@@ -0,0 +1,197 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import numpy as np
+from speckle_generator import PackedPattern, read_rows, read_region, gradient_norm_sum
+from profiling import profiled
+
+# number of rows read at once when streaming over an image
+METRICS_BLOCK_ROWS = 512
+# fewest pixels across the smallest speckles once downsampled for the speckle size. Averaging blocks as wide as the
+# speckles widens their autocorrelation: 0.5 mm speckles at 300 dpi measure 1.96, 2.58 and 3.88 px averaged by 1, 2
+# and 4
+SPECKLE_SIZE_MIN_PX = 8
+
+def iter_row_blocks(array, block_rows:int=METRICS_BLOCK_ROWS):
+    """
+    Yields consecutive bands of full-width rows of a grayscale array, memory map or PackedPattern as grayscale arrays.
+    :param array: image to read
+    :param block_rows: number of rows of each band
+    :return: generator of arrays
+    """
+    height = array.shape[0]
+    for first_row in range(0, height, block_rows):
+        yield read_rows(array, first_row, min(first_row + block_rows, height))
+
+class MetricsAccumulator:
+    """
+    Accumulates density, MIG and the intensity histogram of an image fed as consecutive bands of full-width rows,
+    so every metric is computed in a single pass and the image never has to be in memory at once.
+    The gradient of a band needs the first row of the next one, so each band is processed when the next one arrives
+    and the last one when result is called.
+    """
+
+    def __init__(self):
+        self.histogram = np.zeros(256, dtype=np.int64)
+        self.gradient_sum = 0.0
+        self.width = None
+        self.height = 0
+        # band waiting for the first row of the next band, stored with the row above it
+        self._pending = None
+        self._row_above = None
+
+    def update(self, block:np.ndarray):
+        """
+        Adds the next band of rows of the image.
+        :param block: uint8 array of full-width rows. It is kept until the next band arrives, so it must not be
+        overwritten in between
+        """
+        if block.shape[0] == 0:
+            return
+        if self.width is None:
+            self.width = block.shape[1]
+        elif block.shape[1] != self.width:
+            raise ValueError("All blocks must have the same width")
+
+        self.histogram += np.bincount(block.ravel(), minlength=256)
+        self.height += block.shape[0]
+        if self._pending is not None:
+            self._add_gradient(block[0])
+        self._pending = block
+
+    def _add_gradient(self, row_below:np.ndarray):
+        pending = self._pending
+        num_rows = pending.shape[0]
+        extended = np.empty((num_rows + 2, self.width), dtype=np.float32)
+        # the rows past the top and bottom of the image repeat the edge rows
+        extended[0] = pending[0] if self._row_above is None else self._row_above
+        extended[1:-1] = pending
+        extended[-1] = row_below
+        grad_x = np.empty((num_rows, self.width), dtype=np.float32)
+        grad_y = np.empty((num_rows, self.width), dtype=np.float32)
+        self.gradient_sum += gradient_norm_sum(extended, grad_x, grad_y)
+        self._row_above = pending[-1].copy()
+        self._pending = None
+
+    def result(self):
+        """
+        Finishes the pass and returns the metrics of the image fed so far.
+        :return: dictionary with density (%), MIG, black pixel count, pixel count and the 256 bin histogram
+        """
+        if self._pending is not None:
+            self._add_gradient(self._pending[-1])
+        num_pixels = self.height * (self.width or 0)
+        if num_pixels == 0:
+            raise ValueError("No pixels were accumulated")
+        intensity_sum = int(np.dot(self.histogram, np.arange(256, dtype=np.int64)))
+        return {
+            "density": (1 - intensity_sum / (255 * num_pixels)) * 100,
+            "MIG": self.gradient_sum / num_pixels,
+            "black_pixels": int(self.histogram[0]),
+            "pixels": num_pixels,
+            "histogram": self.histogram.copy()
+        }
+
+@profiled("metrics")
+def stream_metrics(source, block_rows:int=METRICS_BLOCK_ROWS):
+    """
+    Computes density, MIG and the intensity histogram in one pass over the image.
+    :param source: grayscale array, memory map, PackedPattern or an iterable of consecutive bands of full-width rows,
+    such as a tile iterator
+    :param block_rows: number of rows read at once from arrays, memory maps and packed patterns
+    :return: dictionary returned by MetricsAccumulator.result
+    """
+    if isinstance(source, (np.ndarray, PackedPattern)):
+        source = iter_row_blocks(source, block_rows)
+    accumulator = MetricsAccumulator()
+    for block in source:
+        accumulator.update(block)
+    return accumulator.result()
+
+def downsample_mean(array:np.ndarray, factor:int):
+    """
+    Shrinks an image by an integer factor averaging factor x factor blocks. Rows and columns that don't fill a whole
+    block are dropped.
+    :param array: 2D array
+    :param factor: downsampling factor
+    :return: float32 array
+    """
+    height = array.shape[0] // factor * factor
+    width = array.shape[1] // factor * factor
+    blocks = array[:height, :width].reshape(height // factor, factor, width // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+def speckle_size_downsample(min_diameter_px:float):
+    """
+    Largest factor speckle_size can average an image down by while its smallest speckles stay SPECKLE_SIZE_MIN_PX
+    pixels wide. It depends on the speckles only, so patterns of the same speckles measure the same whatever the plate
+    size.
+    :param min_diameter_px: diameter in pixels of the smallest speckles
+    :return: downsampling factor, at least 1
+    """
+    return max(1, int(min_diameter_px // SPECKLE_SIZE_MIN_PX))
+
+@profiled("speckle_size")
+def speckle_size(array, downsample:int=1, workers:int=-1, max_px:int=None):
+    """
+    Speckle size as the full width at half maximum of the radially averaged autocorrelation of the image. It is not
+    the mean diameter: isolated discs give about 0.8 times their diameter, and speckles close enough to touch give
+    less, about a third of the maximum diameter for the default pattern.
+    The autocorrelation is computed with scipy.fft, which is periodic, and uses workers threads.
+    :param array: grayscale array, memory map or PackedPattern
+    :param downsample: integer factor the image is averaged down by before the FFT. Blocks about as wide as the
+    speckles widen the result, see speckle_size_downsample
+    :param workers: threads used by scipy.fft, -1 for all the cores
+    :param max_px: largest side in pixels of the downsampled image. Larger images are measured on their centre
+    :return: speckle size in pixels of the original image, nan if the image has no contrast
+    """
+    # scipy is loaded on the first call, so importing the metrics stays cheap
+    from scipy import fft as scipy_fft
+    height, width = array.shape
+    if max_px is None:
+        image = read_rows(array, 0, height)
+    else:
+        # central region, only its bytes of a packed pattern are unpacked
+        side = max_px * max(1, downsample)
+        image = read_region(array, max(0, (height - side) // 2), min(height, (height + side) // 2),
+                            max(0, (width - side) // 2), min(width, (width + side) // 2))
+    if downsample > 1:
+        image = downsample_mean(image, downsample)
+    else:
+        image = image.astype(np.float32)
+    image -= image.mean()
+
+    spectrum = scipy_fft.rfft2(image, workers=workers)
+    # power spectrum in place, its inverse transform is the autocorrelation
+    np.multiply(spectrum, spectrum.conj(), out=spectrum)
+    autocorrelation = scipy_fft.irfft2(spectrum, s=image.shape, workers=workers)
+    if autocorrelation[0, 0] <= 0:
+        return np.nan
+    autocorrelation /= autocorrelation[0, 0]
+
+    height, width = image.shape
+    max_radius = max(1, min(height, width) // 2)
+    radius = min(32, max_radius)
+    while True:
+        # periodic offsets around the zero shift, averaged in rings of one pixel
+        offsets = np.arange(-radius, radius + 1)
+        distance = np.rint(np.hypot(offsets[:, None], offsets[None, :])).astype(np.int64)
+        ring_values = autocorrelation[np.ix_(offsets % height, offsets % width)]
+        inside = distance <= radius
+        profile = (np.bincount(distance[inside], weights=ring_values[inside], minlength=radius + 1) /
+                   np.bincount(distance[inside], minlength=radius + 1))
+        below = np.nonzero(profile <= 0.5)[0]
+        if below.size or radius == max_radius:
+            break
+        radius = min(2 * radius, max_radius)
+    if below.size == 0:
+        return np.nan
+
+    # linear interpolation of the half maximum crossing
+    r1 = below[0]
+    r0 = r1 - 1
+    half_radius = r0 + (profile[r0] - 0.5) / (profile[r0] - profile[r1])
+    return 2 * half_radius * max(1, downsample)
@@ -0,0 +1,250 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import json
+import math
+from pathlib import Path
+import numpy as np
+from speckle_generator import (
+    fill_speckle_buffer, stamp_speckles, check_out, poisson_disk_speckles, render_packed, ANTIALIAS_SUBPIXELS,
+    PLACEMENTS
+)
+from profiling import stage
+
+# centre and diameter of every speckle in mm, the centre measured from the upper left corner of the pattern
+SPECKLE_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("diameter", "<f4")])
+# the model of a parameter file is saved next to it as <name>.speckles.npz
+MODEL_SUFFIX = ".speckles.npz"
+# version of the saved model files
+MODEL_FORMAT_VERSION = 1
+# parameters the random draw depends on, everything but the resolution
+MODEL_PARAMETERS = ("width", "height", "diameter", "grid_step", "min_diameter", "rand_pos", "placement")
+
+def model_path(parameters_path):
+    """
+    Path of the model saved next to a parameter JSON file.
+    """
+    parameters_path = Path(parameters_path)
+    return parameters_path.with_name(parameters_path.stem + MODEL_SUFFIX)
+
+class SpeckleModel:
+    """
+    Resolution independent speckle pattern: the centre and diameter in mm of every speckle, drawn once from a seed.
+    It can be rasterized at any resolution, whole or a region at a time, always giving the same speckles, so changing
+    only the resolution or printing the pattern at two resolutions doesn't need a new random draw.
+    Grid speckles are stored row by row of the grid they are placed on and Poisson-disk speckles sorted by y, so the
+    speckles reaching a region are found without looking at the rest.
+    """
+
+    def __init__(self, speckles:np.ndarray, parameters:dict, seed:int, grid_shape:tuple):
+        """
+        :param speckles: array of SPECKLE_DTYPE with one speckle per grid node, in row-major grid order, or sorted by y
+        for Poisson-disk placement
+        :param parameters: values of MODEL_PARAMETERS the speckles were drawn with
+        :param seed: seed of the draw
+        :param grid_shape: (rows, columns) of grid nodes, (0, 0) for Poisson-disk placement
+        """
+        self.speckles = speckles
+        # models saved before the placement option were all placed on the grid
+        parameters = {"placement": PLACEMENTS[0], **parameters}
+        self.parameters = {key: parameters[key] for key in MODEL_PARAMETERS}
+        self.seed = seed
+        self.grid_shape = tuple(grid_shape)
+
+    @classmethod
+    def generate(cls, width:float, height:float, diameter:float, grid_step:float, min_diameter:float, pos_rand:float,
+                 seed:int=None, placement:str="grid", progress=None):
+        """
+        Draws the speckles of a pattern. Speckles are placed on the same grid as image_speckle, or by Poisson-disk
+        sampling, but positions and diameters are drawn in mm, diameters uniformly between the minimum and the
+        maximum one.
+        :param width: in mm, width of the pattern
+        :param height: in mm, height of the pattern
+        :param diameter: in mm, maximum diameter of the speckles
+        :param grid_step: as times the diameter, separation between speckles
+        :param min_diameter: as % of the diameter, minimum diameter
+        :param pos_rand: as % of the diameter, maximum random position deviation
+        :param seed: seed of the draw, a random one if None
+        :param placement: "grid" jitters the speckles around the nodes of a square grid, "poisson" places them at
+        least grid_step times their mean diameter apart, ignoring pos_rand
+        :param progress: optional callable receiving the fraction of the Poisson-disk placement done, which may raise
+        GenerationCancelled to stop it. The grid is drawn at once without reporting progress
+        :return: SpeckleModel
+        """
+        if placement not in PLACEMENTS:
+            raise ValueError(f"Unknown placement '{placement}', expected 'grid' or 'poisson'")
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        parameters = {"width": width, "height": height, "diameter": diameter, "grid_step": grid_step,
+                      "min_diameter": min_diameter, "rand_pos": pos_rand, "placement": placement}
+        rng = np.random.default_rng(seed)
+        if placement == "poisson":
+            x, y, diameters = poisson_disk_speckles(width, height, diameter, diameter * min_diameter / 100, grid_step, rng,
+                                                    progress=progress)
+            speckles = np.empty(x.size, dtype=SPECKLE_DTYPE)
+            speckles["x"] = x
+            speckles["y"] = y
+            speckles["diameter"] = diameters
+            return cls(speckles, parameters, seed, (0, 0))
+
+        grid_step_mm = diameter * grid_step
+        grid_shape = (max(1, math.ceil(height / grid_step_mm)), max(1, math.ceil(width / grid_step_mm)))
+        random_radius = diameter * pos_rand / 100
+        min_diameter_mm = diameter * min_diameter / 100
+
+        speckles = np.empty(grid_shape, dtype=SPECKLE_DTYPE)
+        # grid nodes are one step apart, the first one a step minus a radius away from the corner as in image_speckle
+        node_y = (np.arange(grid_shape[0], dtype=np.float32)[:, None] + 1) * grid_step_mm - diameter / 2
+        node_x = (np.arange(grid_shape[1], dtype=np.float32)[None, :] + 1) * grid_step_mm - diameter / 2
+        speckles["y"] = node_y + (2 * rng.random(grid_shape, dtype=np.float32) - 1) * random_radius
+        speckles["x"] = node_x + (2 * rng.random(grid_shape, dtype=np.float32) - 1) * random_radius
+        speckles["diameter"] = min_diameter_mm + rng.random(grid_shape, dtype=np.float32) * (diameter - min_diameter_mm)
+        return cls(speckles.ravel(), parameters, seed, grid_shape)
+
+    @classmethod
+    def from_values(cls, values:dict, seed:int=None, progress=None):
+        """
+        Draws the model of a set of parameters as returned by ParameterWidget.get_values.
+        """
+        return cls.generate(values["width"], values["height"], values["diameter"], values["grid_step"],
+                            values["min_diameter"], values["rand_pos"], seed, values.get("placement", PLACEMENTS[0]),
+                            progress)
+
+    def __len__(self):
+        return self.speckles.size
+
+    @property
+    def nbytes(self):
+        return self.speckles.nbytes
+
+    def matches(self, values:dict):
+        """
+        Whether a set of parameters only differs from the ones of the model in the resolution, so the model can be
+        rasterized for it.
+        """
+        values = {"placement": PLACEMENTS[0], **values}
+        return all(values[key] == self.parameters[key] for key in MODEL_PARAMETERS)
+
+    def shape_px(self, resolution:float):
+        """
+        (height, width) in pixels of the pattern rasterized at a resolution, the same as image_speckle.
+        """
+        dpmm = resolution / 25.4
+        return math.floor(self.parameters["height"] * dpmm), math.floor(self.parameters["width"] * dpmm)
+
+    def region_speckles(self, rows_mm:tuple, cols_mm:tuple, margin_mm:float):
+        """
+        Speckles that might reach a region, from the grid nodes around it, or from the range of y around it for
+        Poisson-disk placement, and not the whole model.
+        :param rows_mm: (top, bottom) of the region in mm
+        :param cols_mm: (left, right) of the region in mm
+        :param margin_mm: extra distance around the region speckles may reach it from
+        :return: array of SPECKLE_DTYPE
+        """
+        if self.parameters["placement"] == "poisson":
+            reach = self.parameters["diameter"] / 2 + margin_mm
+            first, last = np.searchsorted(self.speckles["y"], (rows_mm[0] - reach, rows_mm[1] + reach))
+            speckles = self.speckles[first:last]
+            return speckles[(speckles["x"] > cols_mm[0] - reach) & (speckles["x"] < cols_mm[1] + reach)]
+        grid_step_mm = self.parameters["diameter"] * self.parameters["grid_step"]
+        # furthest a speckle centre can be from its node, plus the radius
+        reach = self.parameters["diameter"] * (self.parameters["rand_pos"] / 100 + 1) + margin_mm
+        y_nodes = (max(0, math.floor((rows_mm[0] - reach) / grid_step_mm) - 1),
+                   min(self.grid_shape[0], math.ceil((rows_mm[1] + reach) / grid_step_mm) + 1))
+        x_nodes = (max(0, math.floor((cols_mm[0] - reach) / grid_step_mm) - 1),
+                   min(self.grid_shape[1], math.ceil((cols_mm[1] + reach) / grid_step_mm) + 1))
+        grid = self.speckles.reshape(self.grid_shape)
+        return grid[y_nodes[0]:y_nodes[1], x_nodes[0]:x_nodes[1]].ravel()
+
+    def rasterize(self, resolution:float, rows:tuple=None, cols:tuple=None, antialias:bool=False,
+                  subpixel:int=ANTIALIAS_SUBPIXELS, packed:bool=False, out:np.ndarray=None, progress=None):
+        """
+        Draws the speckles at a resolution, the whole pattern or only the pixels [rows[0], rows[1]) x [cols[0], cols[1]).
+        Speckle diameters are rounded to whole pixels, or to 1 / subpixel pixels if antialias is True.
+        :param resolution: in dot per inch
+        :param rows: (first, last + 1) rows of the full pattern at this resolution, all of them if None
+        :param cols: (first, last + 1) columns of the full pattern at this resolution, all of them if None
+        :param antialias: use grayscale speckles with shaded edges placed with sub-pixel precision
+        :param subpixel: number of anti-aliased centre offsets per pixel and axis
+        :param packed: return a PackedPattern, rendered and packed band by band. Not with antialias or out
+        :param out: optional C-contiguous uint8 array with the shape of the region to draw into
+        :param progress: optional callable receiving the fraction of the region done. It may raise
+        GenerationCancelled to abort
+        :return: array of the region, out if given, or PackedPattern if packed is True
+        """
+        height_px, width_px = self.shape_px(resolution)
+        rows = (0, height_px) if rows is None else rows
+        cols = (0, width_px) if cols is None else cols
+        if packed:
+            if antialias or out is not None:
+                raise ValueError("A packed pattern can't be anti-aliased or drawn into out")
+            return render_packed(lambda band, band_progress, out: self.rasterize(resolution, band, cols, out=out,
+                                                                                 progress=band_progress),
+                                 rows, cols[1] - cols[0], progress)
+
+        dpmm = resolution / 25.4
+        diameter = self.parameters["diameter"]
+        max_diameter_px = max(1, math.ceil(diameter * dpmm))
+        min_diameter_px = max(1, math.floor(diameter * self.parameters["min_diameter"] / 100 * dpmm))
+        subpixel = subpixel if antialias else 1
+        with stage("speckle_buffer"):
+            speckle_buffer, high_index_bound = fill_speckle_buffer(max_diameter_px, min_diameter_px, subpixel)
+        side_len = speckle_buffer.shape[1]
+
+        canvas = check_out(out, (rows[1] - rows[0], cols[1] - cols[0]))
+        canvas.fill(255)
+        speckles = self.region_speckles((rows[0] / dpmm, rows[1] / dpmm), (cols[0] / dpmm, cols[1] / dpmm),
+                                        side_len / dpmm)
+        with stage("placement"):
+            # float64 so large patterns keep sub-pixel precision
+            centre_y = speckles["y"].astype(np.float64) * dpmm
+            centre_x = speckles["x"].astype(np.float64) * dpmm
+            diameter_px = speckles["diameter"].astype(np.float64) * dpmm
+            if subpixel > 1:
+                # anti-aliased stamps centre the disc at side_len / 2 plus an offset of the subpixel grid
+                corner_y = centre_y - side_len / 2
+                corner_x = centre_x - side_len / 2
+                y_coord_px = np.floor(corner_y + 0.5).astype(np.int64)
+                x_coord_px = np.floor(corner_x + 0.5).astype(np.int64)
+                y_offset = np.clip(np.floor((corner_y - y_coord_px + 0.5) * subpixel), 0, subpixel - 1).astype(np.int64)
+                x_offset = np.clip(np.floor((corner_x - x_coord_px + 0.5) * subpixel), 0, subpixel - 1).astype(np.int64)
+                # the buffer holds evenly spaced diameters from the minimum to the maximum one
+                num_diameters = high_index_bound // (subpixel * subpixel)
+                step = (max_diameter_px - min_diameter_px) / max(1, num_diameters - 1)
+                diameter_index = np.clip(np.rint((diameter_px - min_diameter_px) / max(step, 1e-9)), 0, num_diameters - 1)
+                speckle_index = (diameter_index.astype(np.int64) * subpixel + y_offset) * subpixel + x_offset
+            else:
+                # binary stamps centre the disc on pixel side_len / 2
+                y_coord_px = np.floor(centre_y - side_len / 2).astype(np.int64)
+                x_coord_px = np.floor(centre_x - side_len / 2).astype(np.int64)
+                speckle_index = np.clip(np.rint(diameter_px), min_diameter_px, max_diameter_px).astype(np.int64) - min_diameter_px
+            inside = ((y_coord_px > rows[0] - side_len) & (y_coord_px < rows[1]) &
+                      (x_coord_px > cols[0] - side_len) & (x_coord_px < cols[1]))
+        with stage("stamping"):
+            stamp_speckles(canvas, speckle_buffer, y_coord_px[inside] - rows[0], x_coord_px[inside] - cols[0],
+                           speckle_index[inside], progress)
+        return canvas
+
+    def save(self, path):
+        """
+        Saves the speckles, the parameters and the seed as an uncompressed .npz file, 12 bytes per speckle.
+        """
+        metadata = {"version": MODEL_FORMAT_VERSION, "parameters": self.parameters, "seed": self.seed,
+                    "grid_shape": list(self.grid_shape)}
+        with open(path, "wb") as outfile:
+            np.savez(outfile, speckles=self.speckles, metadata=np.array(json.dumps(metadata)))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a model saved by save.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            metadata = json.loads(str(data["metadata"]))
+            speckles = data["speckles"]
+        if metadata.get("version") != MODEL_FORMAT_VERSION or speckles.dtype != SPECKLE_DTYPE:
+            raise ValueError(f"{path}: unsupported speckle model")
+        return cls(speckles, metadata["parameters"], metadata["seed"], metadata["grid_shape"])
@@ -0,0 +1,106 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# profilers active in each thread, innermost last
+_active = threading.local()
+
+class Profiler:
+    """
+    Collects the stages timed with stage() while it's active. It's activated with a with block in one thread at a
+    time, and can be activated again later in another thread, for instance to add the display stages of a pattern
+    generated in a worker thread.
+    """
+
+    def __init__(self, callback=None):
+        """
+        :param callback: optional callable receiving the name and the seconds of every stage as soon as it ends
+        """
+        # (name, start in perf_counter seconds, seconds, thread id) of every stage, in the order they ended
+        self.events = []
+        self.callback = callback
+
+    def __enter__(self):
+        if not hasattr(_active, "profilers"):
+            _active.profilers = []
+        _active.profilers.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active.profilers.remove(self)
+        return False
+
+    def add(self, name:str, start:float, seconds:float):
+        self.events.append((name, start, seconds, threading.get_ident()))
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    def totals(self):
+        """
+        Total seconds of every stage, in the order each stage first ended.
+        :return: dictionary of seconds by stage name
+        """
+        totals = {}
+        for name, _, seconds, _ in self.events:
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def chrome_trace(self):
+        """
+        Stages as a Chrome trace, which chrome://tracing and Perfetto can open.
+        :return: dictionary in the Trace Event Format
+        """
+        origin = min((start for _, start, _, _ in self.events), default=0.0)
+        return {
+            "traceEvents": [
+                {"name": name, "ph": "X", "ts": (start - origin) * 1E6, "dur": seconds * 1E6, "pid": os.getpid(),
+                 "tid": thread}
+                for name, start, seconds, thread in self.events
+            ],
+            "displayTimeUnit": "ms"
+        }
+
+    def save_trace(self, path):
+        with open(path, "w", encoding="utf8") as outfile:
+            json.dump(self.chrome_trace(), outfile)
+
+@contextmanager
+def stage(name:str):
+    """
+    Times the code inside the with block and reports it to every profiler active in the current thread. It does
+    nothing when no profiler is active.
+    :param name: stage name, stages with the same name add up in Profiler.totals
+    """
+    profilers = getattr(_active, "profilers", None)
+    if not profilers:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for profiler in list(profilers):
+            profiler.add(name, start, seconds)
+
+def profiled(name:str):
+    """
+    Decorator timing every call of a function as a stage.
+    :param name: stage name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
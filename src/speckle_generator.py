@@ -5,11 +5,122 @@ See License.txt in the root directory.
 __author__ = "Rodrigo Parrilla Mesas"
 
 import numpy as np
-from scipy import signal
 import math
-import sys
+import threading
+from collections import OrderedDict
+from profiling import stage, profiled
 
-np.set_printoptions(threshold=sys.maxsize, linewidth=np.inf)
+# maximum number of pixel indices built at once when stamping speckles in bulk
+SCATTER_CHUNK_SIZE = 2 ** 22
+# side length, in grid nodes, of the blocks that own an independent random generator in seeded patterns
+SEED_BLOCK_NODES = 64
+# number of pixels rendered at once before packing when generating a packed pattern
+PACKED_BAND_PIXELS = 2 ** 22
+# number of rows processed at once by MIG
+MIG_CHUNK_ROWS = 512
+# memory budget of the cache of speckle buffers
+STAMP_BANK_BYTES = 256 * 2 ** 20
+# sub-pixel centre offsets per pixel and axis of anti-aliased speckles
+ANTIALIAS_SUBPIXELS = 4
+# ways of placing the speckles: a jittered square grid or minimum distance Poisson-disk sampling
+PLACEMENTS = ("grid", "poisson")
+# candidate speckles rejected in a row before Poisson-disk sampling closes a cell
+POISSON_ATTEMPTS = 32
+# neighbour slot values compared at once by Poisson-disk sampling, few enough to stay in the CPU cache
+POISSON_CHUNK_SIZE = 2 ** 16
+
+class GenerationCancelled(Exception):
+    """
+    Raised by a progress callback to abort the generation of a pattern.
+    """
+
+class PackedPattern:
+    """
+    Binary speckle pattern stored with one bit per pixel. Rows are packed with np.packbits (most significant bit
+    first) and a set bit is a speckle (black) pixel, so counting black pixels is a popcount over the bytes.
+    """
+
+    def __init__(self, bits:np.ndarray, width:int):
+        """
+        :param bits: uint8 array of shape (height, ceil(width / 8)). Padding bits of the last byte must be zero
+        :param width: width of the pattern in pixels
+        """
+        self.bits = bits
+        self.width = width
+
+    @classmethod
+    def empty(cls, height:int, width:int):
+        """
+        Creates a pattern of the given size without any speckle.
+        """
+        return cls(np.zeros((height, (width + 7) // 8), dtype=np.uint8), width)
+
+    @classmethod
+    def from_array(cls, array:np.ndarray):
+        """
+        Packs a grayscale array where 0 is speckle and 255 is background.
+        """
+        return cls(np.packbits(array == 0, axis=1), array.shape[1])
+
+    @property
+    def height(self):
+        return self.bits.shape[0]
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    @property
+    def bytes_per_line(self):
+        return self.bits.shape[1]
+
+    def set_rows(self, first_row:int, array:np.ndarray):
+        """
+        Packs a grayscale band of full-width rows into the pattern starting at first_row.
+        """
+        self.bits[first_row:first_row + array.shape[0]] = np.packbits(array == 0, axis=1)
+
+    def unpack(self, first_row:int=0, last_row:int=None, first_col:int=0, last_col:int=None):
+        """
+        Unpacks rows [first_row, last_row) and columns [first_col, last_col) to a grayscale array with 0 for speckles
+        and 255 for the background. Only the bytes holding the columns are unpacked.
+        """
+        last_col = self.width if last_col is None else min(last_col, self.width)
+        first_byte = first_col // 8
+        speckle = np.unpackbits(self.bits[first_row:last_row, first_byte:(last_col + 7) // 8], axis=1,
+                                count=last_col - 8 * first_byte)
+        if first_col > 8 * first_byte:
+            speckle = np.ascontiguousarray(speckle[:, first_col - 8 * first_byte:])
+        # 1 -> 0 and 0 -> 255 without an intermediate wider array
+        speckle -= 1
+        return speckle
+
+    def invert(self):
+        """
+        Returns a new pattern with speckles and background swapped.
+        """
+        bits = ~self.bits
+        padding_bits = 8 * self.bytes_per_line - self.width
+        if padding_bits:
+            # keep the padding bits of the last byte of each row cleared so popcounts stay exact
+            bits[:, -1] &= np.uint8((0xFF << padding_bits) & 0xFF)
+        return PackedPattern(bits, self.width)
+
+    def black_count(self):
+        """
+        Number of speckle pixels.
+        """
+        return int(np.bitwise_count(self.bits).sum(dtype=np.int64))
+
+    def density(self):
+        """
+        Percentage of speckle pixels over the total amount of pixels.
+        """
+        return self.black_count() / (self.height * self.width) * 100
 
 def generate_speckle(side_len:int ,diameter:int):
     """
@@ -30,9 +141,69 @@ def generate_speckle(side_len:int ,diameter:int):
         speckle[mask] = 0
         return speckle.copy()
 
-def image_speckle(width:int=5, height:int=30, diameter:float=0.5, resolution:int=300, grid_step:float=1, min_diameter:int=1, pos_rand:int=100):
+def stamp_speckles(image:np.ndarray, speckle_buffer:np.ndarray, y_coord_px:np.ndarray, x_coord_px:np.ndarray, speckle_index:np.ndarray,
+                   progress=None):
     """
-    Creates an array of speckles using the arrays created by generata_speckle.
+    Stamps many speckles at once into image. All speckles sharing a buffer index are composited together by
+    scattering zeros into the black pixel offsets of their speckle, which is the same as the &= of the legacy loop.
+    Gray pixels of anti-aliased speckles are min-composited with the image instead.
+    Speckles crossing the border of the image are clipped to it, so the image needs no margin around it.
+    :param image: C-contiguous uint8 image, modified in place
+    :param speckle_buffer: array of speckles as built in image_speckle
+    :param y_coord_px: row of the upper left corner of each speckle
+    :param x_coord_px: column of the upper left corner of each speckle
+    :param speckle_index: index in speckle_buffer of each speckle
+    :param progress: optional callable receiving the fraction of speckles stamped after every chunk. It may raise
+    GenerationCancelled to abort
+    :return: None
+    """
+    image_height, image_width = image.shape
+    num_stamped = 0
+    # flat view of the image so a whole group of speckles is written with a single fancy index
+    flat_image = image.reshape(-1)
+    for index in np.unique(speckle_index):
+        speckle = speckle_buffer[index]
+        stamp_y, stamp_x = np.nonzero(speckle < 255)
+        if stamp_y.size == 0:
+            continue
+        stamp_offsets = stamp_y * image_width + stamp_x
+        stamp_values = speckle[stamp_y, stamp_x]
+        binary = not stamp_values.any()
+        selected = speckle_index == index
+        y_origin = y_coord_px[selected]
+        x_origin = x_coord_px[selected]
+        fits = ((y_origin >= 0) & (y_origin + stamp_y[-1] < image_height) &
+                (x_origin >= 0) & (x_origin + stamp_x.max() < image_width))
+        if not fits.all():
+            # the few speckles crossing the border keep only their pixels inside the image
+            pixel_y = (y_origin[~fits, None] + stamp_y).ravel()
+            pixel_x = (x_origin[~fits, None] + stamp_x).ravel()
+            keep = (pixel_y >= 0) & (pixel_y < image_height) & (pixel_x >= 0) & (pixel_x < image_width)
+            clipped_offsets = pixel_y[keep] * image_width + pixel_x[keep]
+            if binary:
+                flat_image[clipped_offsets] = 0
+            else:
+                np.minimum.at(flat_image, clipped_offsets, np.tile(stamp_values, np.count_nonzero(~fits))[keep])
+            num_stamped += np.count_nonzero(~fits)
+            y_origin = y_origin[fits]
+            x_origin = x_origin[fits]
+        origins = y_origin * image_width + x_origin
+        # speckles are scattered in chunks so the index array stays bounded for large diameters
+        chunk_len = max(1, SCATTER_CHUNK_SIZE // stamp_offsets.size)
+        for start in range(0, origins.size, chunk_len):
+            chunk_offsets = (origins[start:start + chunk_len, None] + stamp_offsets).ravel()
+            if binary:
+                flat_image[chunk_offsets] = 0
+            else:
+                # unbuffered minimum so overlapping speckles of the same chunk keep the darkest value
+                np.minimum.at(flat_image, chunk_offsets, np.tile(stamp_values, chunk_offsets.size // stamp_values.size))
+            if progress is not None:
+                num_stamped += chunk_offsets.size // stamp_offsets.size
+                progress(num_stamped / speckle_index.size)
+
+def speckle_geometry(width:float, height:float, diameter:float, resolution:int, grid_step:float, min_diameter:int, pos_rand:int):
+    """
+    Converts the pattern parameters from millimetres and percentages to pixels.
     :param width: in mm, width of the image
     :param height: in mm, height of the image
     :param diameter: in mm, maximum diameter of the speckles
@@ -40,9 +211,8 @@ def image_speckle(width:int=5, height:int=30, diameter:float=0.5, resolution:int
     :param grid_step: as times the diameter, separation between speckles
     :param min_diameter: as % of the diameter, minimum diameter
     :param pos_rand: as % of the diameter, maximum random position deviation
-    :return:array of speckles.
+    :return: dictionary with the pixel sizes used by the generators
     """
-
     # dots per mm
     dpmm = resolution / 25.4
     # target width and height to crop the image to at the end of the function
@@ -58,9 +228,595 @@ def image_speckle(width:int=5, height:int=30, diameter:float=0.5, resolution:int
 
     # position deviation per one diameter
     pos_rand_diam = pos_rand / 100
+    # random position radius
+    random_radius_px = math.ceil(diameter_px * pos_rand_diam)
+
+    return {
+        "width_px": width_px,
+        "height_px": height_px,
+        "diameter_px": diameter_px,
+        "grid_step_px": grid_step_px,
+        "min_diameter_px": min_diameter_px,
+        "num_x_steps": math.ceil(width_px / grid_step_px),
+        "num_y_steps": math.ceil(height_px / grid_step_px),
+        "rand_pos_bound": max(1, random_radius_px)
+    }
+
+def generate_speckles(side_len:int, diameters:np.ndarray):
+    """
+    Vectorized generate_speckle. Creates one speckle per diameter in a single broadcast operation.
+    :param side_len: side length of every speckle
+    :param diameters: speckle diameters in pixels
+    :return: array of shape (len(diameters), side_len, side_len)
+    """
+    diameters = np.asarray(diameters)
+    if np.any(diameters > side_len):
+        raise ValueError("Diameter must be equal or smaller than width and height")
+    y, x = np.ogrid[:side_len, :side_len]
+    squared_distance = 4 * ((x - side_len / 2) ** 2 + (y - side_len / 2) ** 2)
+    mask = squared_distance[None, :, :] <= diameters[:, None, None] ** 2
+    speckles = np.full(mask.shape, 255, dtype=np.uint8)
+    speckles[mask] = 0
+    return speckles
+
+def generate_antialiased_speckles(side_len:int, diameters:np.ndarray, subpixel:int):
+    """
+    Creates grayscale speckles whose edge pixels are shaded by the fraction of the pixel the disc covers, for every
+    diameter and every centre offset of a subpixel x subpixel grid inside one pixel.
+    :param side_len: side length of every speckle, at least the largest diameter plus two pixels
+    :param diameters: speckle diameters in pixels, may be fractional
+    :param subpixel: number of centre offsets per axis
+    :return: array of shape (len(diameters) * subpixel ** 2, side_len, side_len) ordered by diameter, then row offset,
+    then column offset
+    """
+    diameters = np.asarray(diameters, dtype=np.float64)
+    if np.any(diameters + 2 > side_len):
+        raise ValueError("Diameter plus two pixels must be equal or smaller than width and height")
+    # offsets centred around zero, from -0.5 to 0.5 pixels
+    offsets = (np.arange(subpixel) + 0.5) / subpixel - 0.5
+    centre = side_len / 2 + offsets
+    # pixel centres are at i + 0.5
+    pixel = np.arange(side_len) + 0.5
+    y_distance = pixel[None, :] - centre[:, None]
+    x_distance = pixel[None, :] - centre[:, None]
+    # distance of every pixel to every centre, shape (subpixel, subpixel, side_len, side_len)
+    distance = np.hypot(y_distance[:, None, :, None], x_distance[None, :, None, :])
+    speckles = np.empty((diameters.size,) + distance.shape, dtype=np.uint8)
+    # a few diameters at a time so the float temporaries stay bounded
+    chunk_len = max(1, SCATTER_CHUNK_SIZE // distance.size)
+    for start in range(0, diameters.size, chunk_len):
+        radius = diameters[start:start + chunk_len, None, None, None, None] / 2
+        # coverage approximated by the signed distance to the disc edge over a one pixel wide ramp
+        coverage = np.clip(radius - distance[None] + 0.5, 0, 1)
+        speckles[start:start + chunk_len] = np.rint(255 * (1 - coverage))
+    return speckles.reshape(-1, side_len, side_len)
+
+class StampBank:
+    """
+    Least recently used cache of speckle buffers, so regenerating a pattern with the same diameters reuses the
+    speckles instead of rasterizing them again. Entries are keyed by (diameter_px, min_diameter_px, shape) plus the
+    sub-pixel count of anti-aliased buffers, are read only and the cache drops the least recently used ones when it
+    grows over max_bytes. The bank is shared by the worker threads of the GUI, so lookups and stores take a lock;
+    buffers are built outside of it, and when two threads build the same one the first stored is kept.
+    """
+
+    def __init__(self, max_bytes:int=STAMP_BANK_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, diameter_px:int, min_diameter_px:int, subpixel:int=1):
+        """
+        Returns the speckle buffer of a diameter range, building it on a miss.
+        :param diameter_px: maximum diameter in pixels, also the side length of every binary speckle
+        :param min_diameter_px: minimum diameter in pixels
+        :param subpixel: 1 for binary speckles, otherwise the number of anti-aliased centre offsets per axis. The
+        anti-aliased buffer holds diameters every 1 / subpixel pixels and is 2 pixels wider than diameter_px
+        :return: read-only speckle buffer and the exclusive upper bound for picking a random speckle from it
+        """
+        if subpixel > 1:
+            return self._get_antialiased(diameter_px, min_diameter_px, subpixel)
+        shape = (diameter_px, diameter_px, diameter_px)
+        key = (diameter_px, min_diameter_px, shape)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry
+
+        speckle_buffer = np.zeros(shape, dtype=np.uint8)
+        # every diameter of the range at once. Side_len is adjusted to maximum diameter size.
+        diameters = np.arange(min_diameter_px, diameter_px + 1)
+        speckle_buffer[:diameters.size] = generate_speckles(diameter_px, diameters)
+        speckle_buffer.flags.writeable = False
+        # higher index bound for selecting random speckle must be between 1 (inclusive) and buffer_poss (exclusive)
+        high_index_bound = diameters.size
+        return self._store(key, (speckle_buffer, high_index_bound))
+
+    def _get_antialiased(self, diameter_px:int, min_diameter_px:int, subpixel:int):
+        side_len = diameter_px + 2
+        stamp_bytes = subpixel * subpixel * side_len * side_len
+        # diameters every 1 / subpixel pixels, fewer if the buffer wouldn't fit in the cache
+        num_diameters = (diameter_px - min_diameter_px) * subpixel + 1
+        num_diameters = max(1, min(num_diameters, self.max_bytes // stamp_bytes))
+        shape = (num_diameters * subpixel * subpixel, side_len, side_len)
+        key = (diameter_px, min_diameter_px, shape, subpixel)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry
+
+        diameters = np.linspace(min_diameter_px, diameter_px, num_diameters)
+        speckle_buffer = generate_antialiased_speckles(side_len, diameters, subpixel)
+        speckle_buffer.flags.writeable = False
+        # diameter and centre offset are picked together with a single uniform index
+        return self._store(key, (speckle_buffer, speckle_buffer.shape[0]))
+
+    def _lookup(self, key:tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key:tuple, entry:tuple):
+        speckle_buffer = entry[0]
+        if speckle_buffer.nbytes > self.max_bytes:
+            return entry
+        with self._lock:
+            stored = self._entries.get(key)
+            if stored is not None:
+                # built by another thread meanwhile, its bytes are already counted
+                self._entries.move_to_end(key)
+                return stored
+            self._entries[key] = entry
+            self.nbytes += speckle_buffer.nbytes
+            while self.nbytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        :return: dictionary with the hit and miss counts, the number of cached buffers and their size in bytes
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "nbytes": self.nbytes}
+
+# speckle buffers shared by every pattern generated in this process
+STAMP_BANK = StampBank()
+
+def fill_speckle_buffer(diameter_px:int, min_diameter_px:int, subpixel:int=1):
+    """
+    Gets the buffer of unique speckles, one per diameter between min_diameter_px and diameter_px, from STAMP_BANK.
+    :param diameter_px: maximum diameter in pixels, also the side length of every speckle
+    :param min_diameter_px: minimum diameter in pixels
+    :param subpixel: 1 for binary speckles, otherwise the number of anti-aliased centre offsets per axis
+    :return: read-only speckle buffer and the exclusive upper bound for picking a random speckle from it
+    """
+    return STAMP_BANK.get(diameter_px, min_diameter_px, subpixel)
+
+def check_out(out:np.ndarray, shape:tuple):
+    """
+    Returns out after checking it can hold an image of the given shape, or a new array if out is None.
+    """
+    if out is None:
+        return np.empty(shape, dtype=np.uint8)
+    if out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        raise ValueError(f"out must be a C-contiguous uint8 array of shape {shape}")
+    return out
+
+def draw_grid_speckles(geometry:dict, high_index_bound:int, seed:int, y_nodes:tuple, x_nodes:tuple):
+    """
+    Draws the position and buffer index of the speckles of a rectangular range of grid nodes.
+    The grid is divided in blocks of SEED_BLOCK_NODES x SEED_BLOCK_NODES nodes and every block owns a random
+    generator spawned from seed, so the draw of a node never depends on which region is being rendered.
+    :param geometry: dictionary returned by speckle_geometry
+    :param high_index_bound: exclusive upper bound for the speckle buffer index
+    :param seed: master seed of the pattern
+    :param y_nodes: (first, last + 1) rows of grid nodes
+    :param x_nodes: (first, last + 1) columns of grid nodes
+    :return: row and column of the upper left corner of each speckle in the final image and its buffer index
+    """
+    y_first, y_last = y_nodes
+    x_first, x_last = x_nodes
+    grid_shape = (y_last - y_first, x_last - x_first)
+    y_rand_delta = np.empty(grid_shape, dtype=np.int64)
+    x_rand_delta = np.empty(grid_shape, dtype=np.int64)
+    rand_speckle_index = np.empty(grid_shape, dtype=np.int64)
+    rand_pos_bound = geometry["rand_pos_bound"]
+
+    for y_block in range(y_first // SEED_BLOCK_NODES, (y_last - 1) // SEED_BLOCK_NODES + 1):
+        for x_block in range(x_first // SEED_BLOCK_NODES, (x_last - 1) // SEED_BLOCK_NODES + 1):
+            # nodes covered by the whole block, clipped to the grid
+            block_y0 = y_block * SEED_BLOCK_NODES
+            block_x0 = x_block * SEED_BLOCK_NODES
+            block_y1 = min(block_y0 + SEED_BLOCK_NODES, geometry["num_y_steps"])
+            block_x1 = min(block_x0 + SEED_BLOCK_NODES, geometry["num_x_steps"])
+            block_shape = (block_y1 - block_y0, block_x1 - block_x0)
+            # spawn_key makes this the (y_block, x_block) child of SeedSequence(seed)
+            rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(y_block, x_block)))
+            block_y_delta = rng.integers(low=-rand_pos_bound, high=rand_pos_bound, size=block_shape)
+            block_x_delta = rng.integers(low=-rand_pos_bound, high=rand_pos_bound, size=block_shape)
+            block_index = rng.integers(low=0, high=high_index_bound, size=block_shape)
+            # part of the block inside the requested range
+            y0 = max(block_y0, y_first)
+            y1 = min(block_y1, y_last)
+            x0 = max(block_x0, x_first)
+            x1 = min(block_x1, x_last)
+            target = (slice(y0 - y_first, y1 - y_first), slice(x0 - x_first, x1 - x_first))
+            source = (slice(y0 - block_y0, y1 - block_y0), slice(x0 - block_x0, x1 - block_x0))
+            y_rand_delta[target] = block_y_delta[source]
+            x_rand_delta[target] = block_x_delta[source]
+            rand_speckle_index[target] = block_index[source]
+
+    grid_step_px = geometry["grid_step_px"]
+    diameter_px = geometry["diameter_px"]
+    # same placement as the padded canvas in image_speckle once the crop offset is removed
+    y_coord_px = (np.arange(y_first, y_last)[:, None] + 1) * grid_step_px + y_rand_delta - diameter_px
+    x_coord_px = (np.arange(x_first, x_last)[None, :] + 1) * grid_step_px + x_rand_delta - diameter_px
+    y_coord_px, x_coord_px = np.broadcast_arrays(y_coord_px, x_coord_px)
+    return y_coord_px.ravel(), x_coord_px.ravel(), rand_speckle_index.ravel()
+
+def poisson_disk_speckles(width:float, height:float, diameter:float, min_diameter:float, grid_step:float, rng,
+                          attempts:int=POISSON_ATTEMPTS, progress=None):
+    """
+    Places speckles of random diameters so that no two centres are closer than grid_step times their mean
+    diameter, which spreads them evenly without the clusters and holes of a strongly jittered grid.
+    Candidates are checked against a spatial hash grid of cells of side grid_step * diameter, the largest distance
+    two speckles must keep, so a conflicting speckle is always in one of the 3 x 3 cells around a candidate whatever
+    the minimum diameter. A cell holds as many speckles as fit in it, in slots grown when one fills up. Cells are
+    split in 4 phases of cells two cells apart, whose candidates can't conflict, and every round all the open cells
+    of a phase throw a candidate at once with vectorized calls. Once few cells are open each one throws several
+    candidates in a round and keeps the first accepted. A cell is closed after attempts candidates in a row are
+    rejected, so the number of rounds depends on the speckles per cell and not on the area.
+    :param width: width of the pattern, in any unit
+    :param height: height of the pattern, in the same unit
+    :param diameter: maximum diameter of the speckles
+    :param min_diameter: minimum diameter of the speckles, in the same unit
+    :param grid_step: as times the mean diameter of two speckles, minimum distance between their centres
+    :param rng: numpy Generator the speckles are drawn from
+    :param attempts: candidates rejected in a row before a cell is closed
+    :param progress: optional callable receiving an estimate of the fraction of the placement done after every
+    round. It may raise GenerationCancelled to stop the placement
+    :return: x, y and diameter arrays of the speckles, sorted by y
+    """
+    cell = grid_step * diameter
+    num_rows = max(1, math.ceil(height / cell))
+    num_cols = max(1, math.ceil(width / cell))
+    # a border of one empty cell, so the 3 x 3 neighbours of every cell are gathered with one flat offset
+    padded_cols = num_cols + 2
+    num_cells = (num_rows + 2) * padded_cols
+    neighbour_offsets = np.array([dy * padded_cols + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+    # slots per cell to start with, as many speckles of the mean diameter as fit in a cell
+    num_slots = max(1, math.ceil(2 * diameter / (diameter + min_diameter)) ** 2)
+    # x, y and diameter of the speckles of every cell, nan in the empty slots. The three values of a slot are
+    # side by side, so the neighbour slots of a candidate are gathered as contiguous rows
+    slots = np.full((num_cells, num_slots, 3), np.nan)
+    filled = np.zeros(num_cells, dtype=np.int64)
+    rejected = np.zeros(num_cells, dtype=np.int64)
+    is_open = np.zeros(num_cells, dtype=bool)
+    phases = []
+    for row in range(2):
+        for col in range(2):
+            phase_rows = np.arange(row, num_rows, 2) + 1
+            phase_cols = np.arange(col, num_cols, 2) + 1
+            phases.append((phase_rows[:, None] * padded_cols + phase_cols[None, :]).ravel())
+    for phase in phases:
+        is_open[phase] = True
+    num_open = num_rows * num_cols
+    done_fraction = 0
+
+    while num_open:
+        # a new phase order every round so no phase is always first
+        for phase in rng.permutation(len(phases)):
+            index = phases[phase]
+            index = index[is_open[index]]
+            # elements compared per candidate, and as many candidates per cell as the chunk holds once few cells are
+            # open, so the last rounds of the placement aren't one candidate per call
+            candidate_size = neighbour_offsets.size * slots.shape[1] * 3
+            num_candidates = min(attempts, max(1, POISSON_CHUNK_SIZE // (candidate_size * max(1, index.size))))
+            chunk_len = max(1, POISSON_CHUNK_SIZE // (candidate_size * num_candidates))
+            for start in range(0, index.size, chunk_len):
+                chunk = index[start:start + chunk_len]
+                shape = (chunk.size, num_candidates)
+                left = (chunk % padded_cols - 1) * cell
+                top = (chunk // padded_cols - 1) * cell
+                x = left[:, None] + rng.random(shape) * cell
+                y = top[:, None] + rng.random(shape) * cell
+                d = min_diameter + rng.random(shape) * (diameter - min_diameter)
+                neighbour_index = chunk[:, None] + neighbour_offsets
+                # slots past those of the fullest neighbour are empty in all of them
+                neighbours = slots[neighbour_index, :filled[neighbour_index].max()].reshape(chunk.size, 1, -1, 3)
+                # comparisons with empty slots are False
+                limit = grid_step * (d[..., None] + neighbours[..., 2]) / 2
+                distance_x = neighbours[..., 0] - x[..., None]
+                distance_y = neighbours[..., 1] - y[..., None]
+                conflict = distance_x * distance_x + distance_y * distance_y < limit * limit
+                # the candidates of a cell are thrown one after the other: the first one accepted is placed, unless
+                # the cell would have been closed before it, and the ones after it are never thrown
+                accepted = (x < width) & (y < height) & ~conflict.any(axis=2)
+                accepted &= np.arange(num_candidates) < attempts - rejected[chunk, None]
+                is_placed = accepted.any(axis=1)
+                first = accepted.argmax(axis=1)[is_placed]
+                rejected[chunk] += num_candidates
+                chunk, rows = chunk[is_placed], np.flatnonzero(is_placed)
+                rejected[chunk] = 0
+                if chunk.size and filled[chunk].max() == slots.shape[1]:
+                    slots = np.concatenate((slots, np.full_like(slots, np.nan)), axis=1)
+                slots[chunk, filled[chunk]] = np.stack((x[rows, first], y[rows, first], d[rows, first]), axis=1)
+                filled[chunk] += 1
+        is_open &= rejected < attempts
+        num_open = int(np.count_nonzero(is_open))
+        if progress is not None:
+            # open cells count by their rejections in a row, which drop back to 0 on every speckle placed
+            done = 1 - (num_open - np.sum(rejected[is_open]) / attempts) / (num_rows * num_cols)
+            done_fraction = max(done_fraction, float(done))
+            progress(done_fraction)
+
+    speckles = slots[~np.isnan(slots[..., 2])]
+    x, y, d = speckles[:, 0], speckles[:, 1], speckles[:, 2]
+    order = np.argsort(y, kind="stable")
+    return x[order], y[order], d[order]
+
+def render_region(geometry:dict, speckle_buffer:np.ndarray, high_index_bound:int, seed:int, rows:tuple, cols:tuple,
+                  progress=None, out:np.ndarray=None):
+    """
+    Renders the pixels [rows[0], rows[1]) x [cols[0], cols[1]) of a seeded pattern. Speckles of neighbouring
+    regions that overlap this one are drawn too, clipped to the region, so adjacent regions join without seams.
+    :param geometry: dictionary returned by speckle_geometry
+    :param speckle_buffer: speckle buffer returned by fill_speckle_buffer
+    :param high_index_bound: upper bound returned by fill_speckle_buffer
+    :param seed: master seed of the pattern
+    :param rows: (first, last + 1) rows of the final image
+    :param cols: (first, last + 1) columns of the final image
+    :param progress: optional callable passed to stamp_speckles
+    :param out: optional C-contiguous uint8 array with the shape of the region the region is rendered into
+    :return: array of the region, out if given
+    """
+    row_first, row_last = rows
+    col_first, col_last = cols
+    # anti-aliased speckles are wider than the diameter
+    diameter_px = speckle_buffer.shape[1]
+    grid_step_px = geometry["grid_step_px"]
+    rand_pos_bound = geometry["rand_pos_bound"]
+
+    # grid nodes whose speckle might reach the region, refined speckle by speckle below
+    y_nodes = (max(0, (row_first - rand_pos_bound) // grid_step_px - 1),
+               min(geometry["num_y_steps"], (row_last + rand_pos_bound + diameter_px) // grid_step_px + 1))
+    x_nodes = (max(0, (col_first - rand_pos_bound) // grid_step_px - 1),
+               min(geometry["num_x_steps"], (col_last + rand_pos_bound + diameter_px) // grid_step_px + 1))
+
+    canvas = check_out(out, (row_last - row_first, col_last - col_first))
+    canvas.fill(255)
+    if y_nodes[0] < y_nodes[1] and x_nodes[0] < x_nodes[1]:
+        y_coord_px, x_coord_px, speckle_index = draw_grid_speckles(geometry, high_index_bound, seed, y_nodes, x_nodes)
+        inside = ((y_coord_px > row_first - diameter_px) & (y_coord_px < row_last) &
+                  (x_coord_px > col_first - diameter_px) & (x_coord_px < col_last))
+        stamp_speckles(canvas, speckle_buffer,
+                       y_coord_px[inside] - row_first,
+                       x_coord_px[inside] - col_first,
+                       speckle_index[inside],
+                       progress)
+    return canvas
+
+def render_packed(render_band, rows:tuple, width_px:int, progress=None):
+    """
+    Renders rows [rows[0], rows[1]) of a pattern band by band and packs each band as soon as it is drawn, so the
+    grayscale pattern is never held in memory.
+    :param render_band: callable drawing a band, called with its (first, last + 1) rows, the progress callable of the
+    band and the uint8 array of the band to draw into, and returning it
+    :param rows: (first, last + 1) rows to render
+    :param width_px: width of the bands in pixels
+    :param progress: optional callable receiving the fraction of the rows done
+    :return: PackedPattern of the rows
+    """
+    num_rows = rows[1] - rows[0]
+    pattern = PackedPattern.empty(num_rows, width_px)
+    band_rows = max(1, PACKED_BAND_PIXELS // max(1, width_px))
+    # one band buffer reused for every band
+    band_buffer = np.empty((min(band_rows, num_rows), width_px), dtype=np.uint8)
+    for row in range(rows[0], rows[1], band_rows):
+        band = (row, min(row + band_rows, rows[1]))
+        band_progress = None
+        if progress is not None:
+            # fraction of the band scaled to the fraction of all the rows
+            band_progress = lambda fraction, band=band: progress((band[0] - rows[0] + fraction * (band[1] - band[0])) / num_rows)
+        image = render_band(band, band_progress, band_buffer[:band[1] - band[0]])
+        with stage("pack"):
+            pattern.set_rows(band[0] - rows[0], image)
+    return pattern
+
+def _render_band(shm_name:str, shape:tuple, geometry:dict, seed:int, rows:tuple, subpixel:int):
+    """
+    Process pool task of render_parallel. Renders a band of full-width rows into the shared image.
+    """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        speckle_buffer, high_index_bound = fill_speckle_buffer(geometry["diameter_px"], geometry["min_diameter_px"], subpixel)
+        # bands of full rows are contiguous, so they are rendered straight into the shared image
+        render_region(geometry, speckle_buffer, high_index_bound, seed, rows, (0, shape[1]), out=image[rows[0]:rows[1]])
+        del image
+    finally:
+        shm.close()
+
+def render_parallel(geometry:dict, seed:int, workers:int, subpixel:int=1, progress=None):
+    """
+    Renders a seeded pattern in a process pool. The grid nodes are split in bands of rows, each band is rendered by
+    one task and written straight into a shared memory image, so no image data is pickled between processes.
+    Every block of nodes draws from its own SeedSequence child of seed, which makes the image independent of the
+    number of workers and bands.
+    :param geometry: dictionary returned by speckle_geometry
+    :param seed: master seed of the pattern
+    :param workers: number of processes
+    :param subpixel: 1 for binary speckles, otherwise the number of anti-aliased centre offsets per axis
+    :param progress: optional callable receiving the fraction of bands finished. If it raises GenerationCancelled
+    the pending bands are cancelled
+    :return: array of speckles
+    """
+    # process pools are only loaded when used, so importing the generator stays fast
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from multiprocessing import shared_memory
+    shape = (geometry["height_px"], geometry["width_px"])
+    num_y_steps = geometry["num_y_steps"]
+    grid_step_px = geometry["grid_step_px"]
+    # a few bands per worker so uneven bands don't leave processes idle
+    num_bands = max(1, min(num_y_steps, 4 * workers))
+    band_nodes = math.ceil(num_y_steps / num_bands)
+    band_rows = [(node * grid_step_px, min((node + band_nodes) * grid_step_px, shape[0]))
+                 for node in range(0, num_y_steps, band_nodes)]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1]))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tasks = [pool.submit(_render_band, shm.name, shape, geometry, seed, rows, subpixel)
+                     for rows in band_rows if rows[0] < rows[1]]
+            try:
+                for num_finished, task in enumerate(as_completed(tasks), start=1):
+                    task.result()
+                    if progress is not None:
+                        progress(num_finished / len(tasks))
+            except GenerationCancelled:
+                for task in tasks:
+                    task.cancel()
+                raise
+        image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return image
+
+def image_speckle(width:int=5, height:int=30, diameter:float=0.5, resolution:int=300, grid_step:float=1, min_diameter:int=1, pos_rand:int=100,
+                  engine:str="batched", seed:int=None, workers:int=1, packed:bool=False, antialias:bool=False,
+                  subpixel:int=ANTIALIAS_SUBPIXELS, progress=None, out:np.ndarray=None, placement:str="grid"):
+    """
+    Creates an array of speckles using the arrays created by generata_speckle.
+    :param width: in mm, width of the image
+    :param height: in mm, height of the image
+    :param diameter: in mm, maximum diameter of the speckles
+    :param resolution: in dot per inch, resolution of the image
+    :param grid_step: as times the diameter, separation between speckles
+    :param min_diameter: as % of the diameter, minimum diameter
+    :param pos_rand: as % of the diameter, maximum random position deviation
+    :param engine: "batched" draws and stamps all speckles with vectorized calls, "legacy" places them one by one
+    from the global numpy random state, so it takes neither seed nor workers
+    :param seed: if given, the batched engine draws from generators spawned from it and the pattern is the same
+    one image_speckle_tiled writes for that seed. Otherwise the global numpy random state is used
+    :param workers: number of processes rendering the batched engine. With more than one the pattern is always seeded
+    and the result is bit-identical for any number of workers
+    :param packed: return a PackedPattern. Seeded patterns are then rendered in bands and packed band by band, so the
+    full grayscale image is never held in memory. Without a seed one is drawn from the global numpy random state
+    :param antialias: use grayscale speckles with shaded edges, placed with sub-pixel precision and picked from a
+    precomputed bank of diameters and centre offsets. Only with the batched engine and not packed
+    :param subpixel: number of anti-aliased centre offsets per pixel and axis
+    :param progress: optional callable receiving the fraction of the pattern done while stamping. It may raise
+    GenerationCancelled to abort the generation
+    :param out: optional C-contiguous uint8 array of height_px x width_px the pattern is drawn into, so a caller
+    generating many patterns of the same size can reuse one buffer. Not with packed
+    :param placement: "grid" jitters the speckles around the nodes of a square grid, "poisson" places them at least
+    grid_step times their mean diameter apart with poisson_disk_speckles, ignoring pos_rand, engine and workers.
+    Poisson-disk speckles are drawn in mm by SpeckleModel and stamped the same way
+    :return:array of speckles, out if given, or PackedPattern if packed is True.
+    """
+    if placement == "poisson":
+        # imported here since pattern_model builds on this module
+        from pattern_model import SpeckleModel
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        # the placement takes the first half of the progress, the rasterization the second one
+        model_progress = raster_progress = None
+        if progress is not None:
+            model_progress = lambda fraction: progress(0.5 * fraction)
+            raster_progress = lambda fraction: progress(0.5 + 0.5 * fraction)
+        with stage("model"):
+            model = SpeckleModel.generate(width, height, diameter, grid_step, min_diameter, pos_rand, seed, placement,
+                                          model_progress)
+        return model.rasterize(resolution, antialias=antialias, subpixel=subpixel, packed=packed, out=out,
+                               progress=raster_progress)
+    if placement != "grid":
+        raise ValueError(f"Unknown placement '{placement}', expected 'grid' or 'poisson'")
+    if antialias and (engine != "batched" or packed):
+        raise ValueError("Anti-aliased speckles need the batched engine and can't be packed")
+    if engine == "legacy" and (seed is not None or workers > 1):
+        raise ValueError("The legacy engine draws from the global numpy random state, so it can't be seeded or run "
+                         "in workers")
+    if packed and out is not None:
+        raise ValueError("A packed pattern can't be drawn into out")
+    geometry = speckle_geometry(width, height, diameter, resolution, grid_step, min_diameter, pos_rand)
+    width_px = geometry["width_px"]
+    height_px = geometry["height_px"]
+    diameter_px = geometry["diameter_px"]
+    grid_step_px = geometry["grid_step_px"]
+    num_x_steps = geometry["num_x_steps"]
+    num_y_steps = geometry["num_y_steps"]
+    rand_pos_bound = geometry["rand_pos_bound"]
+
+    subpixel = subpixel if antialias else 1
+    with stage("speckle_buffer"):
+        speckle_buffer, high_index_bound = fill_speckle_buffer(diameter_px, geometry["min_diameter_px"], subpixel)
+
+    if packed and engine == "batched" and workers <= 1:
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+
+        def render_band(rows, band_progress, out):
+            with stage("stamping"):
+                return render_region(geometry, speckle_buffer, high_index_bound, seed, rows, (0, width_px),
+                                     band_progress, out=out)
+        return render_packed(render_band, (0, height_px), width_px, progress)
+    if packed:
+        image = image_speckle(width, height, diameter, resolution, grid_step, min_diameter, pos_rand,
+                              engine=engine, seed=seed, workers=workers, progress=progress)
+        with stage("pack"):
+            return PackedPattern.from_array(image)
+    if engine == "batched" and workers > 1:
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        with stage("stamping"):
+            image = render_parallel(geometry, seed, workers, subpixel, progress)
+        if out is None:
+            return image
+        check_out(out, (height_px, width_px))
+        np.copyto(out, image)
+        return out
+    if engine == "batched" and seed is not None:
+        with stage("stamping"):
+            return render_region(geometry, speckle_buffer, high_index_bound, seed, (0, height_px), (0, width_px), progress,
+                                 out=out)
+
+    # speckle coordinates in number of steps. index of row and column of speckle
+    y_step_coord = np.arange(num_y_steps)
+    x_step_coord = np.arange(num_x_steps)
+
+    if engine == "batched":
+        # the canvas is exactly the final image, speckles crossing its border are clipped while stamping
+        with stage("canvas"):
+            image = check_out(out, (height_px, width_px))
+            image.fill(255)
+        with stage("stamping"):
+            grid_shape = (num_y_steps, num_x_steps)
+            # every random delta and buffer index is drawn at once, one value per grid node
+            y_rand_delta = np.random.randint(low=-rand_pos_bound, high=rand_pos_bound, size=grid_shape)
+            x_rand_delta = np.random.randint(low=-rand_pos_bound, high=rand_pos_bound, size=grid_shape)
+            rand_speckle_index = np.random.randint(low=0, high=high_index_bound, size=grid_shape)
+            # coordinates of the upper left corner of every speckle in the final image
+            y_coord_px = (y_step_coord[:, None] + 1) * grid_step_px + y_rand_delta - diameter_px
+            x_coord_px = (x_step_coord[None, :] + 1) * grid_step_px + x_rand_delta - diameter_px
+            stamp_speckles(image, speckle_buffer, y_coord_px.ravel(), x_coord_px.ravel(), rand_speckle_index.ravel(), progress)
+        return image
+    if engine != "legacy":
+        raise ValueError(f"Unknown engine '{engine}', expected 'batched' or 'legacy'")
 
-    num_x_steps = math.ceil(width_px / grid_step_px)
-    num_y_steps = math.ceil(height_px / grid_step_px)
     #print("num_x_steps", num_x_steps)
     #print("num_y_steps", num_y_steps)
     padding = 10 * grid_step_px
@@ -70,66 +826,202 @@ def image_speckle(width:int=5, height:int=30, diameter:float=0.5, resolution:int
 
     #print("init_W", initial_width_px)
     #print("init_H", initial_height_px)
-    image = np.full((initial_height_px, initial_width_px), 255, dtype=np.uint8)
-
-    # speckle coordinates in number of steps. index of row and column of speckle
-    y_step_coord = np.arange(num_y_steps)
-    x_step_coord = np.arange(num_x_steps)
-
-    speckle_buffer = np.zeros((diameter_px, diameter_px, diameter_px), dtype=np.uint8)
-    buffer_pos = 0
-    # filling the buffer
-    for d in range(min_diameter_px, diameter_px + 1):  # 1 is added so star-stop is at least always one
-        # Speckle side_len is adjusted to maximum diameter size.
-        speckle_buffer[buffer_pos] = generate_speckle(side_len=diameter_px, diameter=d)
+    with stage("canvas"):
+        image = np.full((initial_height_px, initial_width_px), 255, dtype=np.uint8)
 
-        if min_diameter_px == diameter_px:
-            buffer_pos = 0
-        else:
-            buffer_pos += 1
-
-    # higher index bound for selecting random speckle must be between 1 (inclusive) and buffer_poss (exclusive)
-    high_index_bound = max(1, buffer_pos)
-    # random position radius
-    random_radius_px = math.ceil(diameter_px * pos_rand_diam)
-    rand_pos_bound = max(1, random_radius_px)
-
-    for y_coord in y_step_coord:
-        for x_coord in x_step_coord:
-            # random delta is calculated twice so random increment is decoupled in x and y
-            y_rand_delta = np.random.randint(low=-rand_pos_bound, high=rand_pos_bound)
-            x_rand_delta = np.random.randint(low=-rand_pos_bound, high=rand_pos_bound)
-            # coordinates of the upper left corner of the speckle in the complete image
-            y_coord_px = (y_coord + 1) * grid_step_px + y_rand_delta + padding
-            x_coord_px = (x_coord + 1) * grid_step_px + x_rand_delta + padding
-            # select a random speckle from speckle buffer
-            rand_speckle_index = np.random.randint(low=0, high=high_index_bound)
-            # &= is the bitwise AND operator
-            image[y_coord_px: y_coord_px + diameter_px, x_coord_px : x_coord_px + diameter_px] &= speckle_buffer[rand_speckle_index]
-            #print(y_coord, x_coord)
+    with stage("stamping"):
+        for y_coord in y_step_coord:
+            for x_coord in x_step_coord:
+                # random delta is calculated twice so random increment is decoupled in x and y
+                y_rand_delta = np.random.randint(low=-rand_pos_bound, high=rand_pos_bound)
+                x_rand_delta = np.random.randint(low=-rand_pos_bound, high=rand_pos_bound)
+                # coordinates of the upper left corner of the speckle in the complete image
+                y_coord_px = (y_coord + 1) * grid_step_px + y_rand_delta + padding
+                x_coord_px = (x_coord + 1) * grid_step_px + x_rand_delta + padding
+                # select a random speckle from speckle buffer
+                rand_speckle_index = np.random.randint(low=0, high=high_index_bound)
+                # &= is the bitwise AND operator
+                image[y_coord_px: y_coord_px + diameter_px, x_coord_px : x_coord_px + diameter_px] &= speckle_buffer[rand_speckle_index]
+                #print(y_coord, x_coord)
+            if progress is not None:
+                progress((y_coord + 1) / num_y_steps)
 
     # image crop
     init_crop = padding + diameter_px
     image = image[init_crop : init_crop + height_px, init_crop : init_crop + width_px]
-    return image.copy()
-
-def MIG(array:np.ndarray):
-    kernel_x = np.array([[0, 0, 0],
-                         [-0.5, 0, 0.5],
-                         [0, 0, 0]], dtype=np.float32)
-    # transpose of kernel_x
-    kernel_y = kernel_x.T
-    # images containing gradient values
-    grad_x = signal.convolve2d(array, kernel_x, mode='same', boundary='symm')
-    grad_y = signal.convolve2d(array, kernel_y, mode='same', boundary='symm')
-    grad_norm = np.sqrt(np.square(grad_x) + np.square(grad_y))
-    shape = array.shape
-    MIG = np.sum(grad_norm) / (shape[0] * shape[1])
-    return MIG
+    with stage("crop"):
+        if out is None:
+            return image.copy()
+        check_out(out, (height_px, width_px))
+        np.copyto(out, image)
+        return out
+
+def image_speckle_tiled(path, width:int=5, height:int=30, diameter:float=0.5, resolution:int=300, grid_step:float=1,
+                        min_diameter:int=1, pos_rand:int=100, seed:int=None, tile_size:int=2048, progress=None):
+    """
+    Creates the same pattern as image_speckle with the given seed, but renders it tile by tile straight into a .npy
+    memory map on disk, so the peak memory depends on tile_size and not on the size of the image.
+    :param path: path of the .npy file to write
+    :param width: in mm, width of the image
+    :param height: in mm, height of the image
+    :param diameter: in mm, maximum diameter of the speckles
+    :param resolution: in dot per inch, resolution of the image
+    :param grid_step: as times the diameter, separation between speckles
+    :param min_diameter: as % of the diameter, minimum diameter
+    :param pos_rand: as % of the diameter, maximum random position deviation
+    :param seed: master seed of the pattern. A random one is used if None
+    :param tile_size: side length of the tiles in pixels
+    :param progress: optional callable receiving the fraction of rows written after every band of tiles. It may
+    raise GenerationCancelled to abort
+    :return: read-only memory map of the image
+    """
+    if tile_size < 1:
+        raise ValueError("tile_size must be at least one pixel")
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    geometry = speckle_geometry(width, height, diameter, resolution, grid_step, min_diameter, pos_rand)
+    height_px = geometry["height_px"]
+    width_px = geometry["width_px"]
+    speckle_buffer, high_index_bound = fill_speckle_buffer(geometry["diameter_px"], geometry["min_diameter_px"])
+
+    image = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(height_px, width_px))
+    for row in range(0, height_px, tile_size):
+        for col in range(0, width_px, tile_size):
+            rows = (row, min(row + tile_size, height_px))
+            cols = (col, min(col + tile_size, width_px))
+            image[rows[0]:rows[1], cols[0]:cols[1]] = render_region(geometry, speckle_buffer, high_index_bound, seed, rows, cols)
+        # hand the finished band of tiles over to the OS so dirty pages don't pile up in memory
+        image.flush()
+        if progress is not None:
+            progress(min(row + tile_size, height_px) / height_px)
+    del image
+    return np.load(path, mmap_mode="r")
+
+def read_rows(array, first_row:int, last_row:int):
+    """
+    Returns rows [first_row, last_row) of a grayscale array, memory map or PackedPattern as a grayscale array.
+    """
+    if isinstance(array, PackedPattern):
+        return array.unpack(first_row, last_row)
+    return array[first_row:last_row]
+
+def read_region(array, first_row:int, last_row:int, first_col:int, last_col:int):
+    """
+    Returns rows [first_row, last_row) and columns [first_col, last_col) of a grayscale array, memory map or
+    PackedPattern as a grayscale array.
+    """
+    if isinstance(array, PackedPattern):
+        return array.unpack(first_row, last_row, first_col, last_col)
+    return array[first_row:last_row, first_col:last_col]
+
+def read_extended_rows(array, first_row:int, last_row:int, extended:np.ndarray):
+    """
+    Reads rows [first_row, last_row) of an image with the row above and the row below them, as central_differences
+    takes them. Past the top and bottom of the image the edge rows are repeated.
+    :param array: grayscale array, memory map or PackedPattern
+    :param first_row: first row of the band
+    :param last_row: last row of the band + 1
+    :param extended: float32 buffer of at least last_row - first_row + 2 rows of the image width, overwritten
+    :return: view of the rows of extended that were filled
+    """
+    height = array.shape[0]
+    num_rows = last_row - first_row
+    extended[0] = read_rows(array, max(first_row - 1, 0), max(first_row, 1))[0]
+    extended[1:num_rows + 1] = read_rows(array, first_row, last_row)
+    extended[num_rows + 1] = read_rows(array, min(last_row, height - 1), min(last_row, height - 1) + 1)[0]
+    return extended[:num_rows + 2]
+
+def central_differences(extended:np.ndarray, diff_x:np.ndarray, diff_y:np.ndarray):
+    """
+    Differences across two pixels (twice the central difference gradient) of a band of rows, with symmetric
+    boundaries at the left and right.
+    :param extended: float32 band with one extra row above and one below, which are the rows next to the band in the
+    image or the repeated edge rows at the top and bottom of the image
+    :param diff_x: float32 buffer with the shape of the band without the extra rows, overwritten
+    :param diff_y: float32 buffer with the shape of the band without the extra rows, overwritten
+    :return: None
+    """
+    rows = extended[1:-1]
+    width = rows.shape[1]
+    if width > 1:
+        # interior columns, then the symmetric boundary: the pixel beyond the edge mirrors the edge pixel
+        np.subtract(rows[:, 2:], rows[:, :-2], out=diff_x[:, 1:-1])
+        np.subtract(rows[:, 1], rows[:, 0], out=diff_x[:, 0])
+        np.subtract(rows[:, -1], rows[:, -2], out=diff_x[:, -1])
+    else:
+        diff_x.fill(0)
+    np.subtract(extended[2:], extended[:-2], out=diff_y)
+
+def gradient_norm_sum(extended:np.ndarray, grad_x:np.ndarray, grad_y:np.ndarray):
+    """
+    Sum of the central difference gradient norm of a band of rows, with symmetric boundaries at the left and right.
+    :param extended: float32 band with one extra row above and one below, as in central_differences
+    :param grad_x: float32 buffer with the shape of the band without the extra rows, overwritten
+    :param grad_y: float32 buffer with the shape of the band without the extra rows, overwritten
+    :return: sum of the gradient norm of the band
+    """
+    central_differences(extended, grad_x, grad_y)
+    # |g| = 0.5 * sqrt(dx^2 + dy^2) with dx and dy the differences across two pixels
+    np.square(grad_x, out=grad_x)
+    np.square(grad_y, out=grad_y)
+    grad_x += grad_y
+    np.sqrt(grad_x, out=grad_x)
+    return 0.5 * grad_x.sum(dtype=np.float64)
+
+@profiled("MIG")
+def MIG(array:np.ndarray, chunk_rows:int=MIG_CHUNK_ROWS, method:str="fast"):
+    """
+    Mean Intensity Gradient of the image, with central differences and symmetric boundaries.
+    The fast method computes the differences with array slicing in float32, chunk_rows rows at a time and reusing the
+    same buffers, so the temporaries are bounded by the chunk size. It matches the convolve method, kept as the
+    reference implementation, within a relative error of 1e-6.
+    :param array: grayscale array, memory map or PackedPattern
+    :param chunk_rows: number of rows processed at once by the fast method
+    :param method: "fast" or "convolve"
+    :return: MIG of the image
+    """
+    if method == "convolve":
+        # scipy is only needed by the reference method, so it isn't loaded at import
+        from scipy import signal
+        if isinstance(array, PackedPattern):
+            array = array.unpack()
+        kernel_x = np.array([[0, 0, 0],
+                             [-0.5, 0, 0.5],
+                             [0, 0, 0]], dtype=np.float32)
+        # transpose of kernel_x
+        kernel_y = kernel_x.T
+        # images containing gradient values
+        grad_x = signal.convolve2d(array, kernel_x, mode='same', boundary='symm')
+        grad_y = signal.convolve2d(array, kernel_y, mode='same', boundary='symm')
+        grad_norm = np.sqrt(np.square(grad_x) + np.square(grad_y))
+        shape = array.shape
+        MIG = np.sum(grad_norm) / (shape[0] * shape[1])
+        return MIG
+    elif method != "fast":
+        raise ValueError(f"Unknown method '{method}', expected 'fast' or 'convolve'")
+
+    height, width = array.shape
+    chunk_rows = max(1, min(chunk_rows, height))
+    extended = np.empty((chunk_rows + 2, width), dtype=np.float32)
+    grad_x = np.empty((chunk_rows, width), dtype=np.float32)
+    grad_y = np.empty((chunk_rows, width), dtype=np.float32)
+    total = 0.0
+    for first_row in range(0, height, chunk_rows):
+        last_row = min(first_row + chunk_rows, height)
+        num_rows = last_row - first_row
+        total += gradient_norm_sum(read_extended_rows(array, first_row, last_row, extended), grad_x[:num_rows],
+                                   grad_y[:num_rows])
+    return total / (height * width)
 
+@profiled("density")
 def density(array:np.ndarray):
+    if isinstance(array, PackedPattern):
+        return array.density()
     shape = array.shape
-    return (1-np.sum(np.divide(array, 255) / (shape[0]*shape[1]))) * 100
+    # integer sum, no float copy of the image
+    intensity_sum = int(np.sum(array, dtype=np.uint64))
+    return (1 - intensity_sum / (255 * shape[0] * shape[1])) * 100
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import math
+from collections import OrderedDict
+import numpy as np
+from PySide6.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsItem, QGraphicsPixmapItem, QStyleOptionGraphicsItem
+from PySide6.QtGui import QImage, QPixmap, QPainter, QTransform
+from PySide6.QtCore import Qt, QRectF
+from speckle_generator import read_region
+from profiling import stage
+
+# side length in pixels of the tiles of every pyramid level
+VIEWER_TILE_SIZE = 256
+# memory the cached pyramid tiles may take
+VIEWER_CACHE_BYTES = 128 * 2**20
+# largest zoom in screen pixels per image pixel
+VIEWER_MAX_ZOOM = 32
+# zoom factor of one wheel step
+VIEWER_ZOOM_STEP = 1.25
+
+class MipmapPyramid:
+    """
+    Area-averaged mipmap pyramid of a grayscale array, memory map or PackedPattern. Every level halves the one below
+    averaging 2 x 2 blocks, so speckles fade to gray when zoomed out instead of aliasing away.
+    Tiles are built on request from the four tiles below them, so only the areas and levels actually shown are computed.
+    Level 0 is read straight from the image and the other levels are cached, evicting the least recently used tiles of
+    the finest level first: building a coarse tile caches the finer ones below it, which must not push out the few
+    coarse tiles of the zoomed out view.
+    """
+
+    def __init__(self, array, tile_size:int=VIEWER_TILE_SIZE, max_bytes:int=VIEWER_CACHE_BYTES):
+        self.array = array
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # (height, width) of every level, down to a single tile
+        height, width = array.shape
+        self.shapes = [(height, width)]
+        while max(height, width) > tile_size:
+            height = (height + 1) // 2
+            width = (width + 1) // 2
+            self.shapes.append((height, width))
+        # cached tiles of every level by (tile row, tile column), in least recently used order
+        self.tiles = [OrderedDict() for _ in self.shapes]
+
+    @property
+    def num_levels(self):
+        return len(self.shapes)
+
+    def level_for_scale(self, scale:float):
+        """
+        Coarsest level that still has at least one pixel per screen pixel.
+        :param scale: zoom in screen pixels per image pixel
+        :return: pyramid level
+        """
+        if scale >= 1:
+            return 0
+        return min(self.num_levels - 1, int(math.floor(math.log2(1 / scale))))
+
+    def num_tiles(self, level:int):
+        """
+        Number of tile rows and columns of a level.
+        """
+        height, width = self.shapes[level]
+        return -(-height // self.tile_size), -(-width // self.tile_size)
+
+    def tile(self, level:int, tile_row:int, tile_col:int):
+        """
+        Returns one tile of a level, building it and the tiles below it that aren't cached.
+        :param level: pyramid level, 0 is the full resolution image
+        :param tile_row: tile row in the level
+        :param tile_col: tile column in the level
+        :return: uint8 array of at most tile_size x tile_size, smaller at the bottom and right edges
+        """
+        key = (tile_row, tile_col)
+        tile = self.tiles[level].get(key)
+        if tile is not None:
+            self.tiles[level].move_to_end(key)
+            return tile
+        height, width = self.shapes[level]
+        first_row = tile_row * self.tile_size
+        first_col = tile_col * self.tile_size
+        last_row = min(first_row + self.tile_size, height)
+        last_col = min(first_col + self.tile_size, width)
+        if level == 0:
+            return np.ascontiguousarray(read_region(self.array, first_row, last_row, first_col, last_col), dtype=np.uint8)
+        tile = self._downsample(level, tile_row, tile_col, last_row - first_row, last_col - first_col)
+        self._store(level, key, tile)
+        return tile
+
+    def _downsample(self, level:int, tile_row:int, tile_col:int, num_rows:int, num_cols:int):
+        below_height, below_width = self.shapes[level - 1]
+        block = np.empty((2 * num_rows, 2 * num_cols), dtype=np.uint16)
+        # the 2 x 2 tiles of the level below covering this one
+        for child_row in (2 * tile_row, 2 * tile_row + 1):
+            for child_col in (2 * tile_col, 2 * tile_col + 1):
+                if child_row * self.tile_size >= below_height or child_col * self.tile_size >= below_width:
+                    continue
+                child = self.tile(level - 1, child_row, child_col)
+                row = (child_row - 2 * tile_row) * self.tile_size
+                col = (child_col - 2 * tile_col) * self.tile_size
+                block[row:row + child.shape[0], col:col + child.shape[1]] = child
+        # odd sized levels repeat their last row and column
+        filled_rows = min(2 * num_rows, below_height - 2 * tile_row * self.tile_size)
+        filled_cols = min(2 * num_cols, below_width - 2 * tile_col * self.tile_size)
+        block[filled_rows:] = block[filled_rows - 1]
+        block[:, filled_cols:] = block[:, filled_cols - 1:filled_cols]
+        summed = block[0::2, 0::2] + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2]
+        return ((summed + 2) // 4).astype(np.uint8)
+
+    def _store(self, level:int, key:tuple, tile:np.ndarray):
+        for tiles in self.tiles:
+            while tiles and self.nbytes + tile.nbytes > self.max_bytes:
+                _, evicted = tiles.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        self.tiles[level][key] = tile
+        self.nbytes += tile.nbytes
+
+class PyramidItem(QGraphicsItem):
+    """
+    Scene item that draws only the tiles of a MipmapPyramid inside the exposed area, from the level matching the
+    current zoom. One scene unit is one image pixel.
+    """
+
+    def __init__(self, pyramid:MipmapPyramid):
+        super().__init__()
+        self.pyramid = pyramid
+        self.inverted = False
+        # paint receives the exposed area, so tiles outside the view are skipped
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        height, width = self.pyramid.shapes[0]
+        return QRectF(0, 0, width, height)
+
+    def set_inverted(self, inverted:bool):
+        self.inverted = inverted
+        self.update()
+
+    def paint(self, painter, option, widget=None):
+        with stage("viewer_tiles"):
+            self._paint_tiles(painter, option)
+
+    def _paint_tiles(self, painter, option):
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.pyramid.level_for_scale(scale)
+        factor = 2 ** level
+        tile_span = self.pyramid.tile_size * factor
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        num_tile_rows, num_tile_cols = self.pyramid.num_tiles(level)
+        first_tile_row = max(0, int(exposed.top() // tile_span))
+        first_tile_col = max(0, int(exposed.left() // tile_span))
+        last_tile_row = min(num_tile_rows, int(math.ceil(exposed.bottom() / tile_span)))
+        last_tile_col = min(num_tile_cols, int(math.ceil(exposed.right() / tile_span)))
+
+        # pixels stay sharp when zoomed in, levels are blended when zoomed out between two of them
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, scale < 1)
+        # the last tiles of odd sized levels overhang the image by less than one level pixel
+        painter.setClipRect(self.boundingRect())
+        for tile_row in range(first_tile_row, last_tile_row):
+            for tile_col in range(first_tile_col, last_tile_col):
+                tile = self.pyramid.tile(level, tile_row, tile_col)
+                if self.inverted:
+                    tile = 255 - tile
+                image = QImage(tile.data, tile.shape[1], tile.shape[0], tile.strides[0], QImage.Format.Format_Grayscale8)
+                target = QRectF(tile_col * tile_span, tile_row * tile_span, tile.shape[1] * factor, tile.shape[0] * factor)
+                painter.drawImage(target, image)
+
+class PatternViewer(QGraphicsView):
+    """
+    Zoom and pan viewer for patterns of any size, memory maps included. The wheel zooms around the cursor, dragging
+    pans and a double click fits the image back to the view.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.setScene(QGraphicsScene(self))
+        self.setDragMode(QGraphicsView.DragMode.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.pyramid = None
+        self.pattern_item = None
+        self.overlay_item = None
+
+    def set_pattern(self, array):
+        """
+        Shows a new pattern. The zoom and position are kept if it has the same size as the previous one, so a
+        regenerated pattern can be compared at pixel level
+        :param array: grayscale array, memory map or PackedPattern, None for an empty view
+        :return:
+        """
+        same_size = (self.pyramid is not None and array is not None and
+                     self.pyramid.shapes[0] == tuple(array.shape))
+        self.scene().clear()
+        self.overlay_item = None
+        if array is None:
+            self.pyramid = None
+            self.pattern_item = None
+            return
+        self.pyramid = MipmapPyramid(array)
+        self.pattern_item = PyramidItem(self.pyramid)
+        self.scene().addItem(self.pattern_item)
+        self.scene().setSceneRect(self.pattern_item.boundingRect())
+        if not same_size:
+            self.fit()
+
+    def set_inverted(self, inverted:bool):
+        if self.pattern_item is not None:
+            self.pattern_item.set_inverted(inverted)
+
+    def set_overlay(self, overlay:QImage, rect:QRectF):
+        """
+        Shows an image stretched over a rectangle of the pattern, in image pixels
+        """
+        self.clear_overlay()
+        self.overlay_item = QGraphicsPixmapItem(QPixmap.fromImage(overlay))
+        self.overlay_item.setPos(rect.topLeft())
+        self.overlay_item.setTransform(QTransform.fromScale(rect.width() / overlay.width(), rect.height() / overlay.height()))
+        self.overlay_item.setZValue(1)
+        self.scene().addItem(self.overlay_item)
+
+    def clear_overlay(self):
+        if self.overlay_item is not None:
+            self.scene().removeItem(self.overlay_item)
+            self.overlay_item = None
+
+    def fit_scale(self, mode:Qt.AspectRatioMode):
+        rect = self.sceneRect()
+        viewport = self.viewport().rect()
+        if rect.isEmpty():
+            return 1
+        scale_x = viewport.width() / rect.width()
+        scale_y = viewport.height() / rect.height()
+        if mode == Qt.AspectRatioMode.KeepAspectRatioByExpanding:
+            return max(scale_x, scale_y)
+        return min(scale_x, scale_y)
+
+    def fit(self):
+        """
+        Scales the image to fully fill the view, like the original render window
+        """
+        scale = self.fit_scale(Qt.AspectRatioMode.KeepAspectRatioByExpanding)
+        self.setTransform(QTransform.fromScale(scale, scale))
+        self.centerOn(self.sceneRect().center())
+
+    def wheelEvent(self, event):
+        factor = VIEWER_ZOOM_STEP ** (event.angleDelta().y() / 120)
+        scale = self.transform().m11()
+        # from the whole image inside the view down to VIEWER_MAX_ZOOM screen pixels per image pixel
+        min_scale = min(1, self.fit_scale(Qt.AspectRatioMode.KeepAspectRatio))
+        factor = min(max(scale * factor, min_scale), VIEWER_MAX_ZOOM) / scale
+        self.scale(factor, factor)
+
+    def mouseDoubleClickEvent(self, event):
+        self.fit()
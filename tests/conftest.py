@@ -0,0 +1,11 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import sys
+from pathlib import Path
+
+# the modules in src import each other as top level modules, as when the application is run from there
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
@@ -0,0 +1,53 @@
+"""
+Creative Commons Attribution 4.0 International Public License.
+See License.txt in the root directory.
+"""
+__author__ = "Rodrigo Parrilla Mesas"
+
+import numpy as np
+import pytest
+from speckle_generator import image_speckle, image_speckle_tiled, MIG
+
+# 80 x 60 grid nodes, more than one block of seeded nodes along each axis
+PATTERN = {"width": 40, "height": 30, "diameter": 0.5, "resolution": 300, "grid_step": 1, "min_diameter": 60,
+           "pos_rand": 50}
+SEED = 1234
+
+@pytest.fixture(scope="module")
+def seeded():
+    return image_speckle(**PATTERN, seed=SEED)
+
+def test_seeded_pattern_is_reproducible(seeded):
+    assert np.array_equal(image_speckle(**PATTERN, seed=SEED), seeded)
+    assert not np.array_equal(image_speckle(**PATTERN, seed=SEED + 1), seeded)
+
+@pytest.mark.parametrize("workers", [1, 3, 4])
+def test_workers_give_the_same_pattern(seeded, workers):
+    assert np.array_equal(image_speckle(**PATTERN, seed=SEED, workers=workers), seeded)
+
+@pytest.mark.parametrize("tile_size", [100, 2048])
+def test_tiled_pattern_is_the_same(seeded, tmp_path, tile_size):
+    tiled = image_speckle_tiled(tmp_path / "pattern.npy", **PATTERN, seed=SEED, tile_size=tile_size)
+    assert np.array_equal(tiled, seeded)
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_packed_pattern_is_the_same(seeded, workers):
+    packed = image_speckle(**PATTERN, seed=SEED, workers=workers, packed=True)
+    assert np.array_equal(packed.unpack(), seeded)
+
+def test_legacy_engine_rejects_seed_and_workers():
+    with pytest.raises(ValueError):
+        image_speckle(**PATTERN, engine="legacy", seed=SEED)
+    with pytest.raises(ValueError):
+        image_speckle(**PATTERN, engine="legacy", workers=2)
+
+@pytest.mark.parametrize("antialias", [False, True])
+@pytest.mark.parametrize("chunk_rows", [1, 37, 512])
+def test_fast_MIG_matches_the_convolution(antialias, chunk_rows):
+    pattern = image_speckle(**PATTERN, seed=SEED, antialias=antialias)
+    reference = MIG(pattern, method="convolve")
+    assert MIG(pattern, chunk_rows=chunk_rows) == pytest.approx(reference, rel=1e-6)
+
+def test_packed_MIG_matches_the_convolution(seeded):
+    packed = image_speckle(**PATTERN, seed=SEED, packed=True)
+    assert MIG(packed) == pytest.approx(MIG(seeded, method="convolve"), rel=1e-6)